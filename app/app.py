@@ -8,12 +8,24 @@ from flask import abort
 from flask import g
 from flask import request
 
+from app.helpers.profiler import profiler
+from app.helpers.utils import INTERNAL_ENDPOINTS
+from app.helpers.utils import get_cache_policy
 from app.helpers.utils import get_redirect_param
 from app.helpers.utils import get_registered_method
+from app.helpers.utils import get_response_log_extra
 from app.helpers.utils import is_domain_allowed
 from app.helpers.utils import make_error_msg
-from app.settings import CACHE_CONTROL
-from app.settings import CACHE_CONTROL_4XX
+from app.helpers.utils import make_exception_error_msg
+from app.helpers.utils import set_cache_headers
+from app.middlewares import AdmissionControlMiddleware
+from app.middlewares import CorsPreflightMiddleware
+from app.middlewares import RedirectFastPathMiddleware
+from app.middlewares import ResponseCacheMiddleware
+from app.settings import CORS_MAX_AGE
+from app.settings import LOAD_SHEDDING
+from app.settings import REDIRECT_FAST_PATH
+from app.settings import RESPONSE_CACHE
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +34,15 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 app.config.from_mapping({"TRAP_HTTP_EXCEPTIONS": True})
 
+if REDIRECT_FAST_PATH:
+    app.wsgi_app = RedirectFastPathMiddleware(app, app.wsgi_app)
+# The cached responses are replayed without admission control
+if LOAD_SHEDDING:
+    app.wsgi_app = AdmissionControlMiddleware(app, app.wsgi_app)
+if RESPONSE_CACHE:
+    app.wsgi_app = ResponseCacheMiddleware(app, app.wsgi_app)
+app.wsgi_app = CorsPreflightMiddleware(app, app.wsgi_app)
+
 
 @app.before_request
 # Add quick log of the routes used to all request.
@@ -30,6 +51,8 @@ app.config.from_mapping({"TRAP_HTTP_EXCEPTIONS": True})
 def log_route():
     g.setdefault('request_started', time.time())
     logger.debug('%s %s', request.method, request.path)
+    if profiler is not None:
+        profiler.start_request(request.endpoint, request.headers)
 
 
 # Reject request from non allowed origins
@@ -83,8 +106,8 @@ def add_charset(response):
 # Add CORS Headers to all request
 @app.after_request
 def add_generic_cors_header(response):
-    # Do not add CORS header to internal /checker endpoint.
-    if request.endpoint == 'checker':
+    # Do not add CORS header to internal endpoints (e.g. /checker).
+    if request.endpoint in INTERNAL_ENDPOINTS:
         return response
 
     if request.endpoint == 'get_shortlink' and get_redirect_param(ignore_errors=True):
@@ -101,17 +124,25 @@ def add_generic_cors_header(response):
         'Access-Control-Allow-Methods', ', '.join(get_registered_method(app, request.url_rule))
     )
     response.headers.set('Access-Control-Allow-Headers', '*')
+    if request.method == 'OPTIONS':
+        response.headers.set('Access-Control-Max-Age', str(CORS_MAX_AGE))
     return response
 
 
 @app.after_request
 def add_cache_control_header(response):
-    # For /checker route we let the frontend proxy decide how to cache it.
-    if request.method == 'GET' and request.endpoint != 'checker':
-        if response.status_code >= 400:
-            response.headers.set('Cache-Control', CACHE_CONTROL_4XX)
-        else:
-            response.headers.set('Cache-Control', CACHE_CONTROL)
+    # For internal routes (e.g. /checker) we let the frontend proxy decide how to cache it.
+    if request.method == 'GET' and request.endpoint not in INTERNAL_ENDPOINTS:
+        shortlink_id = None
+        if request.endpoint == 'get_shortlink':
+            shortlink_id = request.view_args['shortlink_id']
+        policy = get_cache_policy(
+            response.status_code, shortlink_id, get_redirect_param(ignore_errors=True)
+        )
+        set_cache_headers(response, policy, shortlink_id)
+        # Strong ETag of the shortlink json information, also sent with the 304 answers
+        if response.status_code < 400 and 'etag' in g:
+            response.set_etag(g.etag)
     return response
 
 
@@ -122,15 +153,10 @@ def log_response(response):
         request.method,
         request.path,
         response.status,
-        extra={
-            'response': {
-                "status_code": response.status_code,
-                "headers": dict(response.headers.items()),
-                "json": response.json,
-            },
-            "duration": time.time() - g.get('request_started', time.time())
-        }
+        extra=get_response_log_extra(response, g.get('request_started', time.time()))
     )
+    if profiler is not None:
+        profiler.stop_request()
     return response
 
 
@@ -140,7 +166,11 @@ def handle_exception(err):
     """Return JSON instead of HTML for HTTP errors."""
     if isinstance(err, HTTPException):
         logger.error(err)
-        return make_error_msg(err.code, err.description)
+        response = make_error_msg(err.code, err.description)
+        # Keep the headers specific to the error (e.g. Retry-After)
+        for key, value in err.get_headers():
+            if key != 'Content-Type':
+                response.headers[key] = value
+        return response
 
-    logger.exception('Unexpected exception: %s', err)
-    return make_error_msg(500, "Internal server error, please consult logs")
+    return make_exception_error_msg(err)
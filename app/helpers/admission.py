@@ -0,0 +1,115 @@
+import logging
+import time
+from collections import deque
+
+from gevent.event import Event
+from opentelemetry import metrics
+
+from app.settings import LOAD_SHEDDING
+from app.settings import LOAD_SHEDDING_MAX_INFLIGHT
+from app.settings import LOAD_SHEDDING_MAX_INFLIGHT_CREATE
+from app.settings import LOAD_SHEDDING_MAX_QUEUE
+from app.settings import LOAD_SHEDDING_QUEUE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+admitted_counter = meter.create_counter(
+    'shortlink.admission.admitted',
+    unit='{request}',
+    description='Number of requests admitted per priority (read, create or bypass)'
+)
+shed_counter = meter.create_counter(
+    'shortlink.admission.shed',
+    unit='{request}',
+    description='Number of requests shed per priority and reason (queue_full or timeout)'
+)
+queue_wait_histogram = meter.create_histogram(
+    'shortlink.admission.queue_wait',
+    unit='s',
+    description='Time spent by the queued requests waiting for an in-flight slot'
+)
+
+# Priorities of the admitted requests, in the order in which the queued requests are served
+PRIORITIES = ('read', 'create')
+
+
+class AdmissionController:
+    '''Concurrency bound of the requests of a gevent worker
+
+    At most `max_inflight` requests are in flight, the shortlink creations being only admitted
+    while fewer than `max_inflight_create` requests are in flight, which keeps some slots for the
+    reads. Beyond that the requests wait at most `queue_timeout` seconds for a slot, with at most
+    `max_queue` waiting requests, and are shed otherwise. A released slot is handed over to the
+    oldest waiting read first, then to the oldest waiting creation.
+
+    The controller is not thread safe, it relies on the cooperative scheduling of gevent.
+    '''
+
+    def __init__(self, max_inflight, max_inflight_create, queue_timeout, max_queue):
+        self.limits = {'read': max_inflight, 'create': min(max_inflight_create, max_inflight)}
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self.inflight = 0
+        self.queues = {priority: deque() for priority in PRIORITIES}
+
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def acquire(self, priority):
+        '''Acquire an in-flight slot, waiting for it if needed
+
+        Returns:
+            None if the request is admitted (release() must then be called once the request is
+            done), otherwise the reason why the request is shed.
+        '''
+        if self.inflight < self.limits[priority] and not self.queues[priority]:
+            self.inflight += 1
+            admitted_counter.add(1, {'priority': priority})
+            return None
+        if self.queue_timeout <= 0 or self.queued() >= self.max_queue:
+            return self.shed(priority, 'queue_full')
+        event = Event()
+        queue = self.queues[priority]
+        queue.append(event)
+        started = time.perf_counter()
+        try:
+            event.wait(self.queue_timeout)
+        except BaseException:
+            # e.g. greenlet killed, the slot possibly handed over meanwhile is given back
+            self.abandon(queue, event)
+            raise
+        queue_wait_histogram.record(time.perf_counter() - started, {'priority': priority})
+        if event.is_set():
+            admitted_counter.add(1, {'priority': priority})
+            return None
+        queue.remove(event)
+        return self.shed(priority, 'timeout')
+
+    def abandon(self, queue, event):
+        if event.is_set():
+            self.release()
+        else:
+            queue.remove(event)
+
+    def shed(self, priority, reason):
+        shed_counter.add(1, {'priority': priority, 'reason': reason})
+        logger.debug('Request shed, priority=%s, reason=%s', priority, reason)
+        return reason
+
+    def release(self):
+        '''Release an in-flight slot, handing it over to the next waiting request if any'''
+        self.inflight -= 1
+        for priority in PRIORITIES:
+            queue = self.queues[priority]
+            while queue and self.inflight < self.limits[priority]:
+                self.inflight += 1
+                queue.popleft().set()
+
+
+admission_controller = AdmissionController(
+    LOAD_SHEDDING_MAX_INFLIGHT,
+    LOAD_SHEDDING_MAX_INFLIGHT_CREATE,
+    LOAD_SHEDDING_QUEUE_TIMEOUT,
+    LOAD_SHEDDING_MAX_QUEUE,
+) if LOAD_SHEDDING else None
@@ -0,0 +1,268 @@
+import fcntl
+import hashlib
+import logging
+import math
+import mmap
+import struct
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+
+import gevent
+from opentelemetry import metrics
+
+from app.helpers.worker_greenlet import WorkerGreenlet
+
+logger = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+url_filter_lookups_counter = meter.create_counter(
+    'shortlink.url_filter.lookups',
+    unit='{lookup}',
+    description='Number of URL dedup lookups per filter result (absent, present or '
+    'false_positive), the absent ones skip the UrlIndex query'
+)
+url_filter_rebuild_duration = meter.create_histogram(
+    'shortlink.url_filter.rebuild.duration', unit='s', description='URL filter rebuild duration'
+)
+url_filter_memory_gauge = meter.create_gauge(
+    'shortlink.url_filter.memory', unit='By', description='URL filter memory size'
+)
+url_filter_false_positive_gauge = meter.create_gauge(
+    'shortlink.url_filter.false_positive_rate',
+    description='URL filter estimated false positive rate'
+)
+
+# Room left in the filter for the URLs created between two rebuilds
+CAPACITY_HEADROOM = 1.25
+# Header of the filter file: size, hash_count, count and scan start time, followed by the bits
+FILE_HEADER = struct.Struct('<QQQd')
+# Maximum interval in seconds between two checks for a new filter file
+CHECK_INTERVAL = 60
+
+
+class BloomFilter:
+    '''Bloom filter over the hash of strings
+
+    The k bit positions are derived from a single 128 bits digest with double hashing.
+    '''
+
+    def __init__(self, size, hash_count, bits=None, count=0):
+        self.size = size
+        self.hash_count = hash_count
+        self.bits = bytearray(math.ceil(size / 8)) if bits is None else bits
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate, max_memory):
+        '''Returns a filter with the optimal size and number of hashes for the capacity
+
+        The size is limited to `max_memory` bytes, in which case the false positive rate is higher
+        than requested.
+        '''
+        capacity = max(capacity, 1)
+        size = -capacity * math.log(false_positive_rate) / math.log(2)**2
+        size = max(8, min(math.ceil(size), max_memory * 8))
+        hash_count = max(1, round(size / capacity * math.log(2)))
+        return cls(size, hash_count)
+
+    @property
+    def memory(self):
+        return len(self.bits)
+
+    def positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(value)
+        )
+
+    def false_positive_rate(self):
+        '''Returns the estimated false positive rate for the current number of items'''
+        return (1 - math.exp(-self.hash_count * self.count / self.size))**self.hash_count
+
+    def save(self, path, started):
+        '''Write the filter to the file atomically, `started` being the time of its scan start'''
+        tmp_path = path.with_name(f'.{path.name}.{uuid.uuid4().hex[:8]}.tmp')
+        with open(tmp_path, 'wb') as fd:
+            fd.write(FILE_HEADER.pack(self.size, self.hash_count, self.count, started))
+            fd.write(self.bits)
+        tmp_path.rename(path)
+
+    @classmethod
+    def load(cls, path):
+        '''Returns the filter of the file and the time of its scan start
+
+        The file is mapped copy-on-write, the workers share its memory pages until they add a URL
+        to their filter.
+        '''
+        with open(path, 'rb') as fd:
+            mapped = mmap.mmap(fd.fileno(), 0, flags=mmap.MAP_PRIVATE)
+        size, hash_count, count, started = FILE_HEADER.unpack_from(mapped)
+        bits = memoryview(mapped)[FILE_HEADER.size:]
+        return cls(size, hash_count, bits=bits, count=count), started
+
+
+class UrlFilter(WorkerGreenlet):
+    '''Bloom filter of the URLs of the table, built once per host and shared by its workers
+
+    The filter is built from a scan of the URLs by one worker of the host and saved in
+    `directory`, from where the background greenlet of each worker loads it. The worker holding
+    the lock file of the directory rebuilds the filter once the saved one is older than
+    `rebuild_interval` seconds. In between, the URLs created by the worker are added to its own
+    filter. URLs created by other workers since the last rebuild are not known by the filter, in
+    the worst case a duplicate shortlink is created for such URL.
+
+    The DynamoDB accesses are given as functions:
+        count_urls(): returns the (approximate) number of URLs in the table
+        scan_urls(): yields the pages of URLs of the table
+    '''
+
+    def __init__(
+        self,
+        count_urls,
+        scan_urls,
+        *,
+        directory,
+        false_positive_rate,
+        max_memory,
+        rebuild_interval,
+    ):
+        super().__init__()
+        self.count_urls = count_urls
+        self.scan_urls = scan_urls
+        self.directory = Path(directory)
+        self.path = self.directory / 'url-filter.bin'
+        self.false_positive_rate = false_positive_rate
+        self.max_memory = max_memory
+        self.rebuild_interval = rebuild_interval
+        self.filter = None
+        self.building = None
+        self.loaded = None
+        # URLs added by the worker (time, url), re-added to a newly loaded filter whose scan
+        # started after their creation
+        self.added = deque()
+
+    def on_start(self):
+        self.filter = None
+        self.loaded = None
+        self.added.clear()
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error('Failed to refresh the URL filter: %s', error)
+            gevent.sleep(min(self.rebuild_interval, CHECK_INTERVAL))
+
+    def get_stat(self):
+        try:
+            return self.path.stat()
+        except FileNotFoundError:
+            return None
+
+    def is_outdated(self):
+        stat = self.get_stat()
+        return stat is None or time.time() - stat.st_mtime >= self.rebuild_interval
+
+    def refresh(self):
+        '''Rebuild the filter of the host if outdated and load it if new'''
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if self.is_outdated():
+            with open(self.directory / 'url-filter.lock', 'wb') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Rebuilt by another worker, loaded on a later refresh
+                    pass
+                else:
+                    # Another worker might have rebuilt it while the lock was being taken
+                    if self.is_outdated():
+                        self.rebuild()
+        stat = self.get_stat()
+        # Each saved filter is a new file
+        if stat is not None and (stat.st_ino, stat.st_mtime_ns) != self.loaded:
+            self.load((stat.st_ino, stat.st_mtime_ns))
+
+    def load(self, loaded):
+        bloom, started = BloomFilter.load(self.path)
+        while self.added and self.added[0][0] < started:
+            self.added.popleft()
+        for _, url in self.added:
+            bloom.add(url)
+        self.filter = bloom
+        self.loaded = loaded
+        url_filter_memory_gauge.set(bloom.memory)
+        url_filter_false_positive_gauge.set(bloom.false_positive_rate())
+
+    def rebuild(self):
+        '''Build the filter from a scan of the URLs and save it for all workers of the host'''
+        started = time.monotonic()
+        scan_started = time.time()
+        capacity = max(self.count_urls(), self.filter.count if self.filter else 0)
+        bloom = BloomFilter.for_capacity(
+            int(capacity * CAPACITY_HEADROOM) + 1000, self.false_positive_rate, self.max_memory
+        )
+        # URLs added during the scan are also added to the new filter
+        self.building = bloom
+        try:
+            for urls in self.scan_urls():
+                for url in urls:
+                    bloom.add(url)
+                # Let the requests be served between two pages
+                gevent.sleep(0)
+        finally:
+            self.building = None
+        bloom.save(self.path, scan_started)
+        duration = time.monotonic() - started
+        url_filter_rebuild_duration.record(duration)
+        logger.info(
+            'URL filter rebuilt in %.1fs: %d urls, %d bytes, %d hashes, '
+            'estimated false positive rate %.4f',
+            duration,
+            bloom.count,
+            bloom.memory,
+            bloom.hash_count,
+            bloom.false_positive_rate()
+        )
+
+    def add(self, url):
+        now = time.time()
+        # The URLs older than two rebuild intervals are part of any filter not yet outdated
+        while self.added and self.added[0][0] < now - 2 * self.rebuild_interval:
+            self.added.popleft()
+        self.added.append((now, url))
+        for bloom in (self.filter, self.building):
+            if bloom is not None:
+                bloom.add(url)
+        if self.filter is not None:
+            url_filter_false_positive_gauge.set(self.filter.false_positive_rate())
+
+    def might_contain(self, url):
+        '''Returns False if the URL is definitely not in the table
+
+        Returns True as long as the filter is not built.
+        '''
+        self.start()
+        if self.filter is None:
+            return True
+        if url in self.filter:
+            return True
+        url_filter_lookups_counter.add(1, {'result': 'absent'})
+        return False
+
+    def record_lookup(self, found):
+        '''Record the outcome of a lookup that was not filtered out'''
+        if self.filter is not None:
+            url_filter_lookups_counter.add(1, {'result': 'present' if found else 'false_positive'})
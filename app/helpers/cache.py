@@ -0,0 +1,57 @@
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    '''Bounded least recently used cache with an optional time to live
+
+    Expired items are kept until evicted, so they can still be served as stale copies (for
+    example when the DB is not available).
+    '''
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None, stale=False):
+        '''Returns the cached value
+
+        Args:
+            key: str
+                Cache key
+            default:
+                Value returned if the key is not cached or expired
+            stale: bool
+                Returns the value even if it is expired
+        '''
+        item = self.items.get(key)
+        if item is None:
+            return default
+        value, expires = item
+        if not stale and expires is not None and expires < time.monotonic():
+            return default
+        self.items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self.items[key] = (value, expires)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self.items.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        self.items.clear()
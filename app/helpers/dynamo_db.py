@@ -1,23 +1,491 @@
 import json
 import logging
 import logging.config
+import time
+import zlib
 from datetime import datetime
 from datetime import timezone
 
 import boto3
 from boto3.dynamodb.conditions import Attr
 from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import Binary
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError
+from opentelemetry import metrics
 
 from flask import g
+from flask import has_request_context
+from flask import request
 
+from app.helpers.bloom_filter import UrlFilter
+from app.helpers.cache import LRUCache
+from app.helpers.hedging import HedgedCall
+from app.helpers.resilience import CircuitOpenError
+from app.helpers.resilience import dynamodb_background_circuit_breaker
+from app.helpers.resilience import dynamodb_circuit_breaker
+from app.helpers.snapshot import SnapshotIndex
 from app.helpers.utils import generate_short_id
+from app.helpers.utils import get_url_digest
+from app.helpers.utils import is_valid_short_id
+from app.helpers.write_behind import BATCH_GET_SIZE
+from app.helpers.write_behind import WriteBehindJournal
 from app.settings import AWS_DEFAULT_REGION
+from app.settings import AWS_DYNAMODB_COLD_TABLE_NAME
 from app.settings import AWS_DYNAMODB_TABLE_NAME
 from app.settings import AWS_ENDPOINT_URL
+from app.settings import BLOOM_FILTER
+from app.settings import BLOOM_FILTER_DIR
+from app.settings import BLOOM_FILTER_FALSE_POSITIVE_RATE
+from app.settings import BLOOM_FILTER_MAX_MEMORY
+from app.settings import BLOOM_FILTER_REBUILD_INTERVAL
 from app.settings import COLLISION_MAX_RETRY
+from app.settings import DYNAMODB_CONNECT_TIMEOUT
+from app.settings import DYNAMODB_MAX_ATTEMPTS
+from app.settings import DYNAMODB_MAX_POOL_CONNECTIONS
+from app.settings import DYNAMODB_READ_TIMEOUT
+from app.settings import DYNAMODB_RETRY_MODE
+from app.settings import DYNAMODB_RETURN_CONSUMED_CAPACITY
+from app.settings import DYNAMODB_WRITE_TIMEOUT
+from app.settings import ENTRY_CACHE_SIZE
+from app.settings import ENTRY_CACHE_TTL
+from app.settings import HEDGED_READS
+from app.settings import HEDGED_READS_BUDGET
+from app.settings import HEDGED_READS_PERCENTILE
+from app.settings import NEGATIVE_CACHE_SIZE
+from app.settings import NEGATIVE_CACHE_TTL
+from app.settings import SHORT_ID_CHECK
+from app.settings import SNAPSHOT_MODE
+from app.settings import SNAPSHOT_PATH
+from app.settings import SNAPSHOT_RELOAD_INTERVAL
 from app.settings import STAGING
+from app.settings import TIERING
+from app.settings import TIERING_ACCESS_GRANULARITY
+from app.settings import TIERING_TTL
+from app.settings import URL_DIGEST_BACKFILLED
+from app.settings import URL_DIGEST_INDEX
+from app.settings import WRITE_BEHIND
+from app.settings import WRITE_BEHIND_FLUSH_INTERVAL
+from app.settings import WRITE_BEHIND_FLUSH_SIZE
+from app.settings import WRITE_BEHIND_FSYNC
+from app.settings import WRITE_BEHIND_JOURNAL_DIR
+from app.settings import WRITE_BEHIND_RESERVED_IDS
 
 logger = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+stale_entries_counter = meter.create_counter(
+    'shortlink.entry_cache.stale',
+    unit='{entry}',
+    description='Number of stale entries served while DynamoDB was unavailable, per source '
+    '(cache or snapshot)'
+)
+consumed_capacity_counter = meter.create_counter(
+    'shortlink.dynamodb.consumed_capacity',
+    unit='{capacity_unit}',
+    description='DynamoDB capacity units consumed per endpoint and operation'
+)
+archived_entries_counter = meter.create_counter(
+    'shortlink.tiering.archived_lookups',
+    unit='{request}',
+    description='Number of lookups of the cold table per result (promoted or missing)'
+)
+url_index_lookups_counter = meter.create_counter(
+    'shortlink.url_index.lookups',
+    unit='{request}',
+    description='Number of existing shortlink lookups per index (digest or url, the url one being '
+    'the fallback of the digest one until its backfill)'
+)
+collisions_counter = meter.create_counter(
+    'shortlink.create.collisions',
+    unit='{collision}',
+    description='Number of generated shortlink_id already used on creation, per table (table or '
+    'cold)'
+)
+collision_retries_histogram = meter.create_histogram(
+    'shortlink.create.collision_retries',
+    unit='{retry}',
+    description='Number of PutItem retries after a shortlink_id collision per synchronous '
+    'creation, per result (created or failed)',
+    explicit_bucket_boundaries_advisory=list(range(COLLISION_MAX_RETRY + 1))
+)
+unknown_ids_counter = meter.create_counter(
+    'shortlink.unknown_ids',
+    unit='{request}',
+    description='Number of unknown shortlink_id rejected without DynamoDB lookup, per reason '
+    '(invalid syntax or negative_cache)'
+)
+
+# Attributes read from the table, these are the ones needed by the routes (hits are only set
+# when the hit counters are enabled). Note that a projection
+# only reduces the response size, the capacity consumed by a GetItem depends on the item size.
+ENTRY_ATTRIBUTES = ['shortlink_id', 'url', 'created', 'hits']
+# Attributes read from the UrlIndex and UrlDigestIndex, these are the ones projected into the
+# indexes in order to avoid fetching the non projected attributes from the table.
+URL_INDEX_ATTRIBUTES = ['shortlink_id', 'url']
+
+# Shortlink entries are immutable and can therefore be cached by each worker
+entry_cache = LRUCache(ENTRY_CACHE_SIZE, ENTRY_CACHE_TTL)
+# Unknown shortlink ids, a short time to live limits the time a newly created entry might not be
+# found by other workers
+negative_cache = LRUCache(NEGATIVE_CACHE_SIZE, NEGATIVE_CACHE_TTL)
+
+snapshot = SnapshotIndex(SNAPSHOT_PATH, SNAPSHOT_RELOAD_INTERVAL) if SNAPSHOT_PATH else None
+
+hedged_get_item = HedgedCall(
+    'GetItem', HEDGED_READS_PERCENTILE, HEDGED_READS_BUDGET
+) if HEDGED_READS else None
+
+# The resources are shared by all requests of a worker, this avoid the costly boto3 resource
+# creation on each request and keeps the state of the adaptive retry mode.
+_resources = {}
+_tables = {}
+_local_indexes = {}
+
+
+def get_resource(operation):
+    '''Returns the DynamoDB resource to use for the operation type (read or write)
+
+    Each operation type has its own timeouts.
+    '''
+    if operation not in _resources:
+        config = Config(
+            retries={
+                'mode': DYNAMODB_RETRY_MODE, 'max_attempts': DYNAMODB_MAX_ATTEMPTS
+            },
+            connect_timeout=DYNAMODB_CONNECT_TIMEOUT,
+            read_timeout=DYNAMODB_READ_TIMEOUT if operation == 'read' else DYNAMODB_WRITE_TIMEOUT,
+            max_pool_connections=DYNAMODB_MAX_POOL_CONNECTIONS,
+        )
+        resource = boto3.resource(
+            'dynamodb',
+            region_name=AWS_DEFAULT_REGION,
+            endpoint_url=AWS_ENDPOINT_URL,
+            config=config
+        )
+        _resources[operation] = resource
+    return _resources[operation]
+
+
+def get_table(operation):
+    '''Returns the table resource to use for the operation type (read or write)'''
+    if operation not in _tables:
+        _tables[operation] = get_resource(operation).Table(AWS_DYNAMODB_TABLE_NAME)
+    return _tables[operation]
+
+
+def get_cold_table(operation):
+    '''Returns the cold table resource to use for the operation type (read or write)'''
+    key = f'{operation}-cold'
+    if key not in _tables:
+        _tables[key] = get_resource(operation).Table(AWS_DYNAMODB_COLD_TABLE_NAME)
+    return _tables[key]
+
+
+def is_local_index(index_name):
+    '''Returns True if the index is a local secondary index of the table
+
+    DynamoDB only supports strongly consistent reads on the table and its local secondary
+    indexes. The index type is described once per worker.
+    '''
+    if index_name not in _local_indexes:
+        try:
+            indexes = get_table('read').local_secondary_indexes or []
+        except (BotoCoreError, ClientError) as error:
+            logger.error('Failed to describe the indexes of the table: %s', error)
+            return False
+        _local_indexes[index_name] = any(index['IndexName'] == index_name for index in indexes)
+        if not _local_indexes[index_name]:
+            logger.warning(
+                'Strongly consistent reads are not possible on the %s, which is not a local '
+                'secondary index, it is read with eventual consistency',
+                index_name
+            )
+    return _local_indexes[index_name]
+
+
+def get_projection(attributes):
+    '''Returns the ProjectionExpression and ExpressionAttributeNames parameters
+
+    The attribute names are always substituted as some of them might be DynamoDB reserved words.
+    '''
+    return {
+        'ProjectionExpression': ', '.join(f'#{attribute}' for attribute in attributes),
+        'ExpressionAttributeNames': {
+            f'#{attribute}': attribute for attribute in attributes
+        }
+    }
+
+
+def record_consumed_capacity(operation, response, endpoint=None):
+    '''Aggregate the capacity units consumed by the DynamoDB call per endpoint
+
+    The endpoint is taken from the request when not given.
+    '''
+    capacity = response.get('ConsumedCapacity')
+    if not capacity:
+        return
+    if endpoint is None and has_request_context():
+        endpoint = request.endpoint
+    elif endpoint is None:
+        # Requests handled by a WSGI middleware set their endpoint in the app context
+        endpoint = g.get('endpoint')
+    # Batch operations return the consumed capacity per table
+    units = sum(item.get('CapacityUnits', 0) for item in capacity) \
+        if isinstance(capacity, list) else capacity.get('CapacityUnits', 0)
+    consumed_capacity_counter.add(units, {'endpoint': str(endpoint), 'operation': operation})
+
+
+def write_entries(entries):
+    '''Write the entries one by one with a conditional PutItem, an entry never overwrites
+    another one
+
+    An entry already written with the same URL (e.g. journal replayed after a crash) counts as
+    written.
+
+    Returns:
+        The set of shortlink_id of the entries not written as already used by another entry
+    '''
+    used = set()
+    for entry in entries:
+        try:
+            response = dynamodb_background_circuit_breaker.call(
+                get_table('write').put_item,
+                Item=entry,
+                ConditionExpression=Attr('shortlink_id').not_exists(),
+                ReturnConsumedCapacity=DYNAMODB_RETURN_CONSUMED_CAPACITY
+            )
+        except get_table('write').meta.client.exceptions.ConditionalCheckFailedException:
+            item = dynamodb_background_circuit_breaker.call(
+                get_table('write').get_item,
+                Key={
+                    'shortlink_id': entry['shortlink_id']
+                },
+                ConsistentRead=True,
+                **get_projection(['url'])
+            ).get('Item')
+            if item is None or item.get('url') != entry['url']:
+                used.add(entry['shortlink_id'])
+            continue
+        record_consumed_capacity('PutItem', response, endpoint='write_behind')
+    return used
+
+
+def get_existing_ids(short_ids):
+    '''Returns the set of the given shortlink_id already used in the table
+
+    In tiering mode the ids of the archived entries are also used.
+    '''
+    existing = get_table_existing_ids(AWS_DYNAMODB_TABLE_NAME, short_ids)
+    if TIERING:
+        existing.update(get_table_existing_ids(AWS_DYNAMODB_COLD_TABLE_NAME, short_ids))
+    return existing
+
+
+def get_table_existing_ids(table_name, short_ids):
+    existing = set()
+    for i in range(0, len(short_ids), BATCH_GET_SIZE):
+        response = dynamodb_background_circuit_breaker.call(
+            get_resource('read').batch_get_item,
+            RequestItems={
+                table_name: {
+                    'Keys': [{
+                        'shortlink_id': short_id
+                    } for short_id in short_ids[i:i + BATCH_GET_SIZE]],
+                    'ConsistentRead': True,
+                    **get_projection(['shortlink_id'])
+                }
+            },
+            ReturnConsumedCapacity=DYNAMODB_RETURN_CONSUMED_CAPACITY
+        )
+        record_consumed_capacity('BatchGetItem', response, endpoint='write_behind')
+        items = response.get('Responses', {}).get(table_name, [])
+        existing.update(item['shortlink_id'] for item in items)
+        # The unprocessed keys can not be considered as unused
+        unprocessed = response.get('UnprocessedKeys', {}).get(table_name, {})
+        existing.update(key['shortlink_id'] for key in unprocessed.get('Keys', []))
+    return existing
+
+
+def add_hits(short_id, count):
+    '''Add count to the hits of the shortlink
+
+    Returns:
+        False if the shortlink is not (yet) in the table
+    '''
+    try:
+        response = dynamodb_background_circuit_breaker.call(
+            get_table('write').update_item,
+            Key={'shortlink_id': short_id},
+            UpdateExpression='ADD #hits :count',
+            ConditionExpression=Attr('shortlink_id').exists(),
+            ExpressionAttributeNames={'#hits': 'hits'},
+            ExpressionAttributeValues={':count': count},
+            ReturnConsumedCapacity=DYNAMODB_RETURN_CONSUMED_CAPACITY
+        )
+    except get_table('write').meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    record_consumed_capacity('UpdateItem', response, endpoint='hit_counters')
+    return True
+
+
+def get_tiering_attributes(now=None):
+    '''Returns the coarse last_access and the expires attributes of an entry accessed now'''
+    now = int(time.time() if now is None else now)
+    last_access = now - now % TIERING_ACCESS_GRANULARITY
+    return {'last_access': last_access, 'expires': last_access + TIERING_TTL}
+
+
+def touch_entry(short_id, _count):
+    '''Update the last access of the shortlink and postpone its expiration (tiering mode)
+
+    Returns:
+        False if the shortlink is not (yet) in the table
+    '''
+    attributes = get_tiering_attributes()
+    try:
+        response = dynamodb_background_circuit_breaker.call(
+            get_table('write').update_item,
+            Key={'shortlink_id': short_id},
+            UpdateExpression='SET #last_access = :last_access, #expires = :expires',
+            ConditionExpression=Attr('shortlink_id').exists(),
+            ExpressionAttributeNames={
+                '#last_access': 'last_access', '#expires': 'expires'
+            },
+            ExpressionAttributeValues={
+                ':last_access': attributes['last_access'], ':expires': attributes['expires']
+            },
+            ReturnConsumedCapacity=DYNAMODB_RETURN_CONSUMED_CAPACITY
+        )
+    except get_table('write').meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    record_consumed_capacity('UpdateItem', response, endpoint='tiering')
+    return True
+
+
+def encode_cold_item(entry):
+    '''Returns the cold table item of an entry, its attributes are stored compressed'''
+    data = json.dumps(entry, default=int, separators=(',', ':')).encode('utf-8')
+    return {'shortlink_id': entry['shortlink_id'], 'entry': Binary(zlib.compress(data, 9))}
+
+
+def decode_cold_item(item):
+    return json.loads(zlib.decompress(item['entry'].value))
+
+
+def archive_entries(entries):
+    '''Write the entries in the cold table'''
+    with get_cold_table('write').batch_writer() as batch:
+        for entry in entries:
+            batch.put_item(Item=encode_cold_item(entry))
+
+
+def get_cold_entry(short_id, attributes=None):
+    '''Returns the archived entry of the shortlink or None'''
+    response = dynamodb_circuit_breaker.call(
+        get_cold_table('read').get_item,
+        Key={'shortlink_id': short_id},
+        ReturnConsumedCapacity=DYNAMODB_RETURN_CONSUMED_CAPACITY,
+        **get_projection(attributes or ['shortlink_id', 'entry'])
+    )
+    record_consumed_capacity('GetItem', response)
+    item = response.get('Item')
+    if item is None or 'entry' not in item:
+        return item
+    return decode_cold_item(item)
+
+
+def promote_entry(entry):
+    '''Write back an archived entry in the table'''
+    try:
+        response = dynamodb_circuit_breaker.call(
+            get_table('write').put_item,
+            Item={
+                **entry, 'url_digest': get_url_digest(entry['url']), **get_tiering_attributes()
+            },
+            ConditionExpression=Attr('shortlink_id').not_exists(),
+            ReturnConsumedCapacity=DYNAMODB_RETURN_CONSUMED_CAPACITY
+        )
+    except get_table('write').meta.client.exceptions.ConditionalCheckFailedException:
+        # Already promoted by another worker
+        return
+    record_consumed_capacity('PutItem', response)
+
+
+def count_urls():
+    '''Returns the approximate number of items of the table (updated every 6 hours by AWS)'''
+    table = get_table('read')
+    table.reload()
+    return table.item_count
+
+
+def scan_urls():
+    '''Yields the pages of URLs of the table
+
+    The UrlIndex is scanned as its items are smaller than the table items.
+    '''
+    kwargs = {}
+    while True:
+        response = dynamodb_background_circuit_breaker.call(
+            get_table('read').scan,
+            IndexName='UrlIndex',
+            ReturnConsumedCapacity=DYNAMODB_RETURN_CONSUMED_CAPACITY,
+            **get_projection(['url']),
+            **kwargs
+        )
+        record_consumed_capacity('Scan', response, endpoint='url_filter')
+        yield [item['url'] for item in response.get('Items', [])]
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+url_filter = UrlFilter(
+    count_urls,
+    scan_urls,
+    directory=BLOOM_FILTER_DIR,
+    false_positive_rate=BLOOM_FILTER_FALSE_POSITIVE_RATE,
+    max_memory=BLOOM_FILTER_MAX_MEMORY,
+    rebuild_interval=BLOOM_FILTER_REBUILD_INTERVAL
+) if BLOOM_FILTER else None
+
+write_behind_journal = WriteBehindJournal(
+    WRITE_BEHIND_JOURNAL_DIR,
+    generate_short_id,
+    write_entries,
+    get_existing_ids,
+    flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+    flush_size=WRITE_BEHIND_FLUSH_SIZE,
+    reserved_ids=WRITE_BEHIND_RESERVED_IDS,
+    fsync=WRITE_BEHIND_FSYNC
+) if WRITE_BEHIND else None
+
+
+def is_unknown_short_id(short_id):
+    '''Returns True if the shortlink_id is known to not exist without DynamoDB lookup'''
+    if SHORT_ID_CHECK and not is_valid_short_id(short_id):
+        logger.debug('Invalid shortlink_id %s', short_id)
+        unknown_ids_counter.add(1, {'reason': 'invalid'})
+        return True
+    if short_id in negative_cache:
+        logger.debug('Unknown shortlink_id %s in negative cache', short_id)
+        unknown_ids_counter.add(1, {'reason': 'negative_cache'})
+        return True
+    return False
+
+
+def get_stale_entry(short_id):
+    '''Returns the entry to serve while DynamoDB is not available, or None'''
+    entry = entry_cache.get(short_id, stale=True)
+    if entry is not None:
+        stale_entries_counter.add(1, {'source': 'cache'})
+        return entry
+    if snapshot is not None and SNAPSHOT_MODE == 'fallback':
+        entry = snapshot.get(short_id)
+        if entry is not None:
+            stale_entries_counter.add(1, {'source': 'snapshot'})
+    return entry
 
 
 def get_db():
@@ -29,54 +497,174 @@ def get_db():
 class DynamoDB():
 
     def __init__(self):
-        self.resource = boto3.resource(
-            'dynamodb', region_name=AWS_DEFAULT_REGION, endpoint_url=AWS_ENDPOINT_URL
-        )
-        self.table = self.resource.Table(AWS_DYNAMODB_TABLE_NAME)
+        self.read_table = get_table('read')
+        self.table = get_table('write')
 
-    def get_entry_by_url(self, url):
+    def get_entry_by_url(self, url, consistent_read=False):
         """Get a DB entry by full url
 
         Arguments:
             url: str
                 full url to get from DB
+            consistent_read: bool
+                Use a strongly consistent read, only possible if the UrlIndex is a local
+                secondary index
 
         Returns:
-            Table entry or None if ULR is not found in Table
+            Table entry, with only the shortlink_id and url attributes, or None if ULR is not
+            found in Table
         """
-        response = self.table.query(
+        if write_behind_journal is not None:
+            entry = write_behind_journal.get_by_url(url)
+            if entry is not None:
+                return entry
+        if url_filter is not None and not url_filter.might_contain(url):
+            logger.debug("The url '%s' is not in the URL filter", url)
+            return None
+        consistent_read = consistent_read and is_local_index('UrlIndex')
+        # Strongly consistent reads are not possible on the UrlDigestIndex (global secondary index)
+        if URL_DIGEST_INDEX and not consistent_read:
+            entry = self.query_url_digest_index(url)
+            if entry is None and not URL_DIGEST_BACKFILLED:
+                entry = self.query_url_index(url, consistent_read)
+        else:
+            entry = self.query_url_index(url, consistent_read)
+        if url_filter is not None:
+            url_filter.record_lookup(entry is not None)
+        if entry is None:
+            logger.debug("The following url '%s' was not found in dynamodb", url)
+        return entry
+
+    def query_url_index(self, url, consistent_read=False):
+        url_index_lookups_counter.add(1, {'index': 'url'})
+        response = dynamodb_circuit_breaker.call(
+            self.read_table.query,
             IndexName="UrlIndex",
             KeyConditionExpression=Key('url').eq(url),
+            Limit=1,
+            ConsistentRead=consistent_read,
+            ReturnConsumedCapacity=DYNAMODB_RETURN_CONSUMED_CAPACITY,
+            **get_projection(URL_INDEX_ATTRIBUTES)
         )
-        try:
-            return response['Items'][0]
-        except IndexError:
-            logger.debug(
-                "The following url '%s' was not found in dynamodb",
-                url,
-                extra={"db_response": response}
-            )
-            return None
+        record_consumed_capacity('Query', response)
+        return next(iter(response['Items']), None)
 
-    def get_entry_by_shortlink(self, short_id):
+    def query_url_digest_index(self, url):
+        '''Returns the entry of the URL found by digest, its full URL being verified'''
+        url_index_lookups_counter.add(1, {'index': 'digest'})
+        response = dynamodb_circuit_breaker.call(
+            self.read_table.query,
+            IndexName="UrlDigestIndex",
+            KeyConditionExpression=Key('url_digest').eq(get_url_digest(url)),
+            ReturnConsumedCapacity=DYNAMODB_RETURN_CONSUMED_CAPACITY,
+            **get_projection(URL_INDEX_ATTRIBUTES)
+        )
+        record_consumed_capacity('Query', response)
+        for item in response['Items']:
+            if item['url'] == url:
+                return item
+        if response['Items']:
+            logger.warning("URL digest collision for the url '%s'", url)
+        return None
+
+    def get_entry_by_shortlink(self, short_id, consistent_read=False, cached=True):
         '''Get an entry by shortlink_id
 
+        The entry is taken from the worker cache if available. When DynamoDB is not available,
+        an expired cached entry is returned if any. In write-behind mode, the entries not yet
+        flushed are taken from the journals. In tiering mode, the entries missing from the table
+        are looked up in the cold table and promoted back to the table. Unknown ids are rejected
+        without DynamoDB lookup when they are syntactically invalid or in the negative cache.
+
         Args:
             short_id: str
                 shortlink_id to get from the table
+            consistent_read: bool
+                Use a strongly consistent read when the entry is not cached
+            cached: bool
+                Use the cached entry if any, otherwise the cache is only used when DynamoDB is
+                not available
         Returns:
             Table entry or None if shortlink_id is not found in Table
         '''
-        response = self.table.get_item(Key={'shortlink_id': short_id})
+        entry = entry_cache.get(short_id) if cached else None
+        if entry is None and write_behind_journal is not None:
+            entry = write_behind_journal.get(short_id)
+        if entry is None and cached and snapshot is not None and SNAPSHOT_MODE == 'first':
+            # Entries created after the snapshot fall through to DynamoDB
+            entry = snapshot.get(short_id)
+        if entry is not None:
+            return entry
+        if is_unknown_short_id(short_id):
+            return None
+        try:
+            response = dynamodb_circuit_breaker.call(
+                self.get_item,
+                Key={'shortlink_id': short_id},
+                ConsistentRead=consistent_read,
+                ReturnConsumedCapacity=DYNAMODB_RETURN_CONSUMED_CAPACITY,
+                **get_projection(ENTRY_ATTRIBUTES)
+            )
+        except (CircuitOpenError, BotoCoreError, ClientError) as error:
+            entry = get_stale_entry(short_id)
+            if entry is None:
+                raise
+            logger.warning(
+                'DynamoDB not available, serve stale shortlink_id %s: %s', short_id, error
+            )
+            return entry
+        record_consumed_capacity('GetItem', response)
         try:
-            return response['Item']
+            entry = response['Item']
         except KeyError:
+            entry = self.find_missing_entry(short_id)
+            if entry is not None:
+                return entry
+            negative_cache.set(short_id, True)
             logger.error(
                 'The following shortlink_id not found in dynamodb: %s',
                 short_id,
                 extra={"db_response": response}
             )
             return None
+        entry_cache.set(short_id, entry)
+        return entry
+
+    def find_missing_entry(self, short_id):
+        '''Returns the entry missing from the table, if any
+
+        Entries are missing when created by another worker and not yet flushed (write-behind
+        mode) or when archived (tiering mode).
+        '''
+        if write_behind_journal is not None:
+            entry = write_behind_journal.find(short_id)
+            if entry is not None:
+                return entry
+        if TIERING:
+            return self.get_archived_entry(short_id)
+        return None
+
+    def get_archived_entry(self, short_id):
+        '''Returns the entry of the cold table, promoted back to the table, or None'''
+        entry = get_cold_entry(short_id)
+        if entry is None:
+            archived_entries_counter.add(1, {'result': 'missing'})
+            return None
+        archived_entries_counter.add(1, {'result': 'promoted'})
+        logger.info('Promote the archived shortlink_id %s', short_id)
+        try:
+            promote_entry(entry)
+        except (CircuitOpenError, BotoCoreError, ClientError) as error:
+            logger.error('Failed to promote the archived shortlink_id %s: %s', short_id, error)
+        entry = {name: entry[name] for name in ENTRY_ATTRIBUTES if name in entry}
+        entry_cache.set(short_id, entry)
+        return entry
+
+    def get_item(self, **kwargs):
+        '''GetItem call, hedged if enabled'''
+        if hedged_get_item is None:
+            return self.read_table.get_item(**kwargs)
+        return hedged_get_item.call(self.read_table.get_item, **kwargs)
 
     def add_url_to_table(self, url):
         '''Add URL in table
@@ -89,17 +677,60 @@ class DynamoDB():
             Table entry
         '''
         now = datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+        if write_behind_journal is not None:
+            short_id = write_behind_journal.reserve_short_id()
+            # Without reserved id (e.g. on worker startup) the entry is written synchronously
+            if short_id is not None:
+                entry = {
+                    'shortlink_id': short_id,
+                    'url': url,
+                    'created': now,
+                    'staging': STAGING,
+                    'url_digest': get_url_digest(url),
+                    **(get_tiering_attributes() if TIERING else {})
+                }
+                logger.debug('Adding DB entry to the write-behind journal: %s', json.dumps(entry))
+                write_behind_journal.add(entry)
+                negative_cache.pop(short_id)
+                if url_filter is not None:
+                    url_filter.add(url)
+                entry_cache.set(
+                    short_id,
+                    {
+                        attribute: entry[attribute]
+                        for attribute in ENTRY_ATTRIBUTES
+                        if attribute in entry
+                    }
+                )
+                return entry
         collision_retry = 0
         while True:
             try:
                 short_id = generate_short_id()
-                entry = {'shortlink_id': short_id, 'url': url, 'created': now, 'staging': STAGING}
+                while TIERING and get_cold_entry(short_id, ['shortlink_id']) is not None:
+                    logger.warning('Short ID %s collision with an archived entry', short_id)
+                    collisions_counter.add(1, {'table': 'cold'})
+                    short_id = generate_short_id()
+                entry = {
+                    'shortlink_id': short_id,
+                    'url': url,
+                    'created': now,
+                    'staging': STAGING,
+                    'url_digest': get_url_digest(url),
+                    **(get_tiering_attributes() if TIERING else {})
+                }
                 logger.debug('Adding DB entry: %s', json.dumps(entry))
-                self.table.put_item(
-                    Item=entry, ConditionExpression=Attr('shortlink_id').not_exists()
+                response = dynamodb_circuit_breaker.call(
+                    self.table.put_item,
+                    Item=entry,
+                    ConditionExpression=Attr('shortlink_id').not_exists(),
+                    ReturnConsumedCapacity=DYNAMODB_RETURN_CONSUMED_CAPACITY
                 )
+                record_consumed_capacity('PutItem', response)
+                collision_retries_histogram.record(collision_retry, {'result': 'created'})
                 break
             except self.table.meta.client.exceptions.ConditionalCheckFailedException as error:
+                collisions_counter.add(1, {'table': 'table'})
                 if collision_retry < 1:
                     logger.warning(
                         'Short ID %s collision, retry=%d: %s', short_id, collision_retry, error
@@ -115,7 +746,15 @@ class DynamoDB():
                         error
                     )
                 else:
+                    collision_retries_histogram.record(collision_retry, {'result': 'failed'})
                     raise
                 collision_retry += 1
 
+        entry_cache.set(
+            short_id,
+            {attribute: entry[attribute] for attribute in ENTRY_ATTRIBUTES if attribute in entry}
+        )
+        negative_cache.pop(short_id)
+        if url_filter is not None:
+            url_filter.add(url)
         return entry
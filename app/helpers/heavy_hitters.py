@@ -0,0 +1,192 @@
+import json
+import logging
+import time
+from pathlib import Path
+
+import gevent
+
+from app.helpers.worker_greenlet import WorkerGreenlet
+from app.settings import HEAVY_HITTERS
+from app.settings import HEAVY_HITTERS_CAPACITY
+from app.settings import HEAVY_HITTERS_DIR
+from app.settings import HEAVY_HITTERS_MAX_AGE
+from app.settings import HEAVY_HITTERS_PERSIST_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class SpaceSaving:
+    '''Space-Saving sketch of the most frequent keys of a stream
+
+    At most `capacity` keys are counted, when a new key comes in and the sketch is full it replaces
+    the key with the smallest count and inherits its count as error. The estimated count of a key
+    is an upper bound of its real count, and `count - error` a lower bound.
+
+    The counters are grouped into buckets of same count (stream summary), which gives an O(1)
+    update.
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.total = 0
+        # key -> [count, error]
+        self.counters = {}
+        # count -> keys with this count (dict used as ordered set)
+        self.buckets = {}
+        self.min_count = 0
+
+    def __len__(self):
+        return len(self.counters)
+
+    def add(self, key):
+        self.total += 1
+        counter = self.counters.get(key)
+        if counter is not None:
+            self.remove_from_bucket(key, counter[0])
+        elif len(self.counters) < self.capacity:
+            counter = self.counters[key] = [0, 0]
+        else:
+            evicted = next(iter(self.buckets[self.min_count]))
+            self.remove_from_bucket(evicted, self.min_count)
+            del self.counters[evicted]
+            counter = self.counters[key] = [self.min_count, self.min_count]
+        previous = counter[0]
+        counter[0] += 1
+        self.buckets.setdefault(counter[0], {})[key] = None
+        if previous == 0:
+            self.min_count = 1
+        elif previous == self.min_count and previous not in self.buckets:
+            self.min_count = counter[0]
+
+    def remove_from_bucket(self, key, count):
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+
+    def smallest_count(self):
+        '''Returns the count of the keys not in the sketch (upper bound)'''
+        return self.min_count if len(self.counters) >= self.capacity else 0
+
+    def to_dict(self):
+        return {
+            'total': self.total,
+            'min_count': self.smallest_count(),
+            'counters': [[key, count, error] for key, (count, error) in self.counters.items()]
+        }
+
+
+def merge_sketches(sketches, top):
+    '''Merge Space-Saving sketches (as returned by SpaceSaving.to_dict)
+
+    A key missing from a sketch may have been counted up to the smallest count of that sketch,
+    which is therefore added to both its count and its error.
+
+    Returns:
+        The total number of hits and the `top` keys as list of dict with shortlink_id, count and
+        error.
+    '''
+    merged = {}
+    for sketch in sketches:
+        for key, count, error in sketch['counters']:
+            merged.setdefault(key, [0, 0, 0])
+            merged[key][0] += count
+            merged[key][1] += error
+            merged[key][2] += sketch['min_count']
+    min_count_sum = sum(sketch['min_count'] for sketch in sketches)
+    items = []
+    for key, (count, error, own_min_count) in merged.items():
+        # own_min_count is the sum of the min counts of the sketches counting this key
+        missing = min_count_sum - own_min_count
+        items.append({'shortlink_id': key, 'count': count + missing, 'error': error + missing})
+    items.sort(key=lambda item: (-item['count'], item['error']))
+    return sum(sketch['total'] for sketch in sketches), items[:top]
+
+
+class HeavyHitters(WorkerGreenlet):
+    '''Per worker heavy hitters of the shortlink hits
+
+    The sketch of each worker is periodically persisted in `directory`, the sketches of all
+    workers being merged from there.
+    '''
+
+    def __init__(self, capacity, directory, persist_interval, max_age):
+        super().__init__()
+        self.capacity = capacity
+        self.directory = Path(directory)
+        self.persist_interval = persist_interval
+        self.max_age = max_age
+        self.sketch = SpaceSaving(capacity)
+        self.path = None
+
+    def on_start(self):
+        self.path = self.directory / f'heavy-hitters-{self.pid}.json'
+        self.sketch = SpaceSaving(self.capacity)
+
+    def on_stop(self):
+        self.persist()
+
+    def run(self):
+        while True:
+            gevent.sleep(self.persist_interval)
+            try:
+                self.persist()
+            except OSError as error:
+                logger.error('Failed to persist the heavy hitters sketch: %s', error)
+
+    def add(self, shortlink_id):
+        self.start()
+        self.sketch.add(shortlink_id)
+
+    def persist(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'wt', encoding='utf-8') as fd:
+            json.dump({'pid': self.pid, 'updated': time.time(), **self.sketch.to_dict()}, fd)
+        tmp_path.replace(self.path)
+
+    def load_sketches(self):
+        '''Returns the persisted sketches of the other workers'''
+        sketches = []
+        if not self.directory.exists():
+            return sketches
+        for path in self.directory.glob('heavy-hitters-*.json'):
+            if path == self.path:
+                continue
+            try:
+                if time.time() - path.stat().st_mtime > self.max_age:
+                    # Sketch of a worker that is gone since long
+                    continue
+                with open(path, 'rt', encoding='utf-8') as fd:
+                    sketches.append(json.load(fd))
+            except (OSError, ValueError) as error:
+                logger.warning('Failed to load the heavy hitters sketch %s: %s', path, error)
+        return sketches
+
+    def top(self, count):
+        '''Returns the merged heavy hitters of all workers
+
+        Returns:
+            The number of sketches, the total number of hits and the top heavy hitters
+        '''
+        sketches = self.load_sketches() + [self.sketch.to_dict()]
+        total, items = merge_sketches(sketches, count)
+        return len(sketches), total, items
+
+
+heavy_hitters = HeavyHitters(
+    HEAVY_HITTERS_CAPACITY,
+    HEAVY_HITTERS_DIR,
+    HEAVY_HITTERS_PERSIST_INTERVAL,
+    HEAVY_HITTERS_MAX_AGE
+) if HEAVY_HITTERS else None
+
+
+def get_heavy_hitters(top):
+    '''Returns the merged heavy hitters of all workers, see HeavyHitters.top()
+
+    Returns None if the heavy hitters sketch is not enabled.
+    '''
+    if heavy_hitters is None:
+        return None
+    return heavy_hitters.top(top)
@@ -0,0 +1,188 @@
+import logging
+import time
+from collections import deque
+
+import gevent
+from opentelemetry import metrics
+
+logger = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+hedge_reads_counter = meter.create_counter(
+    'shortlink.dynamodb.hedge.reads',
+    unit='{call}',
+    description='Number of DynamoDB reads eligible to hedging'
+)
+hedge_fired_counter = meter.create_counter(
+    'shortlink.dynamodb.hedge.fired',
+    unit='{call}',
+    description='Number of hedged DynamoDB reads fired, the hedge rate is fired/reads'
+)
+hedge_won_counter = meter.create_counter(
+    'shortlink.dynamodb.hedge.won',
+    unit='{call}',
+    description='Number of hedged DynamoDB reads that answered first, the win rate is won/fired'
+)
+
+
+class LatencyTracker:
+    '''Tracks the latency percentile of the recent calls'''
+
+    def __init__(self, percentile, size=1000, min_samples=100, refresh=50):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.refresh = refresh
+        self.samples = deque(maxlen=size)
+        self.new_samples = 0
+        self._value = None
+
+    def add(self, latency):
+        self.samples.append(latency)
+        self.new_samples += 1
+
+    def value(self):
+        '''Returns the latency percentile or None if there is not enough samples'''
+        if len(self.samples) < self.min_samples:
+            return None
+        # Sorting the samples on each call would be too costly, the value is only refreshed
+        # every few samples
+        if self._value is None or self.new_samples >= self.refresh:
+            ordered = sorted(self.samples)
+            index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+            self._value = ordered[index]
+            self.new_samples = 0
+        return self._value
+
+
+class HedgeBudget:
+    '''Limits the hedged calls to a ratio of all calls
+
+    Each call earns `ratio` tokens and each hedge costs one token, the number of tokens being
+    capped to allow small bursts only.
+    '''
+
+    def __init__(self, ratio, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = 0
+
+    def earn(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def spend(self):
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class HedgeWon(BaseException):
+    '''Thrown into the primary call when the hedged call answered first
+
+    As gevent.Timeout, it is not an Exception in order to not be caught by the primary call.
+    '''
+
+    def __init__(self, result):
+        super().__init__()
+        self.result = result
+
+
+class HedgeAttempt:
+    '''Hedged call fired after `delay` seconds in its own greenlet, unless the primary call
+    answered in the meantime
+
+    A successful hedged call interrupts the primary call running in the greenlet that created the
+    attempt.
+    '''
+
+    def __init__(self, hedged_call, delay, func, args, kwargs):
+        self.hedged_call = hedged_call
+        self.caller = gevent.getcurrent()
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.primary_done = False
+        self.fired = False
+        self.succeeded = False
+        self.result = None
+        self.greenlet = gevent.spawn_later(delay, self.run)
+
+    def run(self):
+        if self.primary_done or not self.hedged_call.budget.spend():
+            return
+        self.fired = True
+        name = self.hedged_call.name
+        logger.debug('%s did not answer in time, fire a hedged call', name)
+        hedge_fired_counter.add(1, {'operation': name})
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception as error:  # pylint: disable=broad-except
+            # The answer of the primary call is used
+            logger.debug('Hedged call %s failed: %s', name, error)
+            return
+        self.succeeded = True
+        if not self.primary_done:
+            # Thrown from the hub, as gevent.Timeout does, once the primary call is waiting
+            gevent.get_hub().loop.run_callback(self.interrupt)
+
+    def interrupt(self):
+        if not self.primary_done:
+            self.caller.throw(HedgeWon(self.result))
+
+    def join(self):
+        '''Returns True if the hedged call fired and succeeded, waiting for its answer'''
+        if self.fired:
+            self.greenlet.join()
+        return self.succeeded
+
+    def cancel(self):
+        self.primary_done = True
+        self.greenlet.kill(block=False)
+
+
+class HedgedCall:
+    '''Hedges slow calls with a second identical call
+
+    The primary call runs in the calling greenlet. When it did not answer within the given
+    percentile of the recent latencies, a second identical call is fired in its own greenlet
+    (and therefore on its own pooled connection). The first successful answer is used and the
+    other call is cancelled.
+
+    The latency of the primary call is always recorded, when the hedged call answered first it is
+    the time until then: a lower bound above the hedge delay, which keeps its rank among the
+    samples of the percentile.
+    '''
+
+    def __init__(self, name, percentile, budget_ratio):
+        self.name = name
+        self.latency = LatencyTracker(percentile)
+        self.budget = HedgeBudget(budget_ratio)
+
+    def call(self, func, *args, **kwargs):
+        hedge_reads_counter.add(1, {'operation': self.name})
+        self.budget.earn()
+        delay = self.latency.value()
+        started = time.monotonic()
+        if delay is None:
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.latency.add(time.monotonic() - started)
+
+        attempt = HedgeAttempt(self, delay, func, args, kwargs)
+        try:
+            return func(*args, **kwargs)
+        except HedgeWon as won:
+            attempt.primary_done = True
+            hedge_won_counter.add(1, {'operation': self.name})
+            return won.result
+        except Exception:
+            attempt.primary_done = True
+            # Use the answer of the hedged call if any, the error of the primary call otherwise
+            if attempt.join():
+                hedge_won_counter.add(1, {'operation': self.name})
+                return attempt.result
+            raise
+        finally:
+            attempt.cancel()
+            self.latency.add(time.monotonic() - started)
@@ -0,0 +1,161 @@
+import logging
+
+import gevent.event
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError
+from opentelemetry import metrics
+
+from app.helpers.cache import LRUCache
+from app.helpers.dynamo_db import add_hits
+from app.helpers.dynamo_db import touch_entry
+from app.helpers.heavy_hitters import heavy_hitters
+from app.helpers.resilience import CircuitOpenError
+from app.helpers.worker_greenlet import WorkerGreenlet
+from app.settings import HIT_COUNTERS
+from app.settings import HIT_COUNTERS_FLUSH_INTERVAL
+from app.settings import HIT_COUNTERS_MAX_KEYS
+from app.settings import TIERING
+from app.settings import TIERING_ACCESS_GRANULARITY
+from app.settings import TIERING_FLUSH_INTERVAL
+from app.settings import TIERING_MAX_KEYS
+
+logger = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+hit_counters_flushed_counter = meter.create_counter(
+    'shortlink.hit_counters.flushed',
+    unit='{hit}',
+    description='Number of shortlink hits (or accesses, see the counter attribute) written to '
+    'DynamoDB'
+)
+hit_counters_dropped_counter = meter.create_counter(
+    'shortlink.hit_counters.dropped',
+    unit='{hit}',
+    description='Number of shortlink hits dropped because they could not be written in time'
+)
+
+
+class HitCounters(WorkerGreenlet):
+    '''Per worker shortlink hit counters written to DynamoDB in batches
+
+    The hits are counted in memory and flushed by a background greenlet every `flush_interval`
+    seconds, or as soon as `max_keys` shortlinks have been hit, with one aggregated update per
+    shortlink. The hits of new shortlinks are dropped while `max_keys` shortlinks are waiting for
+    a late flush. The counters are only accessed from greenlets of the worker, therefore they don't
+    need any lock.
+
+    The DynamoDB update is given as function:
+        update(shortlink_id, count): adds count to the hits of the shortlink
+
+    The counters are also used to batch the last access updates of the tiering mode, `name`
+    being the counter attribute of the metrics.
+    '''
+
+    def __init__(self, update, flush_interval, max_keys, name='hits'):
+        super().__init__()
+        self.update = update
+        self.name = name
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self.counts = {}
+        self.flushing = {}
+        self.flush_event = gevent.event.Event()
+
+    def on_start(self):
+        self.counts = {}
+        self.flushing = {}
+
+    def on_stop(self):
+        # Flush the pending hits
+        self.flush()
+
+    def run(self):
+        while True:
+            self.flush_event.wait(timeout=self.flush_interval)
+            self.flush_event.clear()
+            try:
+                self.flush()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.exception('Failed to flush the %s: %s', self.name, error)
+
+    def add(self, shortlink_id):
+        self.start()
+        if shortlink_id not in self.counts and len(self.counts) >= self.max_keys:
+            hit_counters_dropped_counter.add(1, {'counter': self.name})
+            return
+        self.counts[shortlink_id] = self.counts.get(shortlink_id, 0) + 1
+        if len(self.counts) >= self.max_keys:
+            self.flush_event.set()
+
+    def pending(self, shortlink_id):
+        '''Returns the number of hits of the shortlink not yet written to DynamoDB'''
+        return self.counts.get(shortlink_id, 0) + self.flushing.get(shortlink_id, 0)
+
+    def flush(self):
+        # Swap the counters, the hits counted during the flush go to the new counters
+        self.flushing, self.counts = self.counts, {}
+        failed = {}
+        try:
+            for shortlink_id, count in list(self.flushing.items()):
+                try:
+                    written = self.update(shortlink_id, count)
+                except (CircuitOpenError, BotoCoreError, ClientError) as error:
+                    logger.error(
+                        'Failed to write the %s of %d shortlinks: %s',
+                        self.name,
+                        len(self.flushing),
+                        error
+                    )
+                    break
+                if written:
+                    hit_counters_flushed_counter.add(count, {'counter': self.name})
+                else:
+                    # Entry not yet written to DynamoDB (write-behind mode), retry later
+                    failed[shortlink_id] = count
+                del self.flushing[shortlink_id]
+        finally:
+            failed.update(self.flushing)
+            self.flushing = {}
+            self.requeue(failed)
+
+    def requeue(self, failed):
+        '''Add the hits that could not be written to the next flush, within the memory bound'''
+        dropped = 0
+        for shortlink_id, count in failed.items():
+            if shortlink_id in self.counts or len(self.counts) < self.max_keys:
+                self.counts[shortlink_id] = self.counts.get(shortlink_id, 0) + count
+            else:
+                dropped += count
+        if dropped:
+            logger.error('Drop %d %s that could not be written to DynamoDB', dropped, self.name)
+            hit_counters_dropped_counter.add(dropped, {'counter': self.name})
+
+
+hit_counters = HitCounters(
+    add_hits, HIT_COUNTERS_FLUSH_INTERVAL, HIT_COUNTERS_MAX_KEYS
+) if HIT_COUNTERS else None
+
+# Last access updates of the tiering mode, a shortlink is updated at most once per
+# TIERING_ACCESS_GRANULARITY by each worker
+access_counters = HitCounters(
+    touch_entry, TIERING_FLUSH_INTERVAL, TIERING_MAX_KEYS, name='accesses'
+) if TIERING else None
+recent_accesses = LRUCache(TIERING_MAX_KEYS, TIERING_ACCESS_GRANULARITY)
+
+
+def record_hit(shortlink_id):
+    '''Record a hit of an existing shortlink'''
+    if heavy_hitters is not None:
+        heavy_hitters.add(shortlink_id)
+    if hit_counters is not None:
+        hit_counters.add(shortlink_id)
+    if access_counters is not None and shortlink_id not in recent_accesses:
+        recent_accesses.set(shortlink_id, True)
+        access_counters.add(shortlink_id)
+
+
+def get_pending_hits(shortlink_id):
+    '''Returns the number of hits of the shortlink counted by the worker but not yet written'''
+    if hit_counters is None:
+        return 0
+    return hit_counters.pending(shortlink_id)
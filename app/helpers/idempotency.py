@@ -0,0 +1,243 @@
+import ctypes
+import hashlib
+import logging
+import multiprocessing
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import gevent
+from opentelemetry import metrics
+
+from flask import abort
+from flask import request
+
+from app.helpers.rate_limiter import get_client_key
+from app.settings import IDEMPOTENCY
+from app.settings import IDEMPOTENCY_MAX_KEYS
+from app.settings import IDEMPOTENCY_SHARED
+from app.settings import IDEMPOTENCY_TTL
+from app.settings import IDEMPOTENCY_WAIT_TIMEOUT
+
+logger = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+idempotent_requests_counter = meter.create_counter(
+    'shortlink.idempotency.requests',
+    unit='{request}',
+    description='Number of shortlink creations with an Idempotency-Key per result (new, replayed, '
+    'conflict or mismatch)'
+)
+
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+# Status of the records whose request is still being processed
+PENDING = 0
+# A pending record is forgotten after the gunicorn worker timeout, its worker being dead by then
+PENDING_TTL = 60
+POLL_INTERVAL = 0.01
+# The shared store lock is only held for a few memory accesses, it is polled instead of blocking
+# the worker (and all its greenlets) while another worker holds it
+LOCK_POLL_INTERVAL = 0.001
+
+
+class IdempotencyStore:
+    '''Per worker store of the recent Idempotency-Key of the shortlink creations
+
+    A record maps a key to the fingerprint of the request body and to the shortlink_id and status
+    code of its response, the status being PENDING while the request is processed. At most
+    `max_keys` records are kept `ttl` seconds, the least recently used ones being forgotten.
+    A request finding a pending record waits at most `wait_timeout` seconds for its completion.
+    '''
+
+    def __init__(self, max_keys, ttl, wait_timeout):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        # key -> (fingerprint, status, shortlink_id, expires)
+        self.records = OrderedDict()
+
+    def get(self, key, now):
+        record = self.records.get(key)
+        if record is None or record[3] < now:
+            return None
+        return record[:3]
+
+    def set(self, key, record, now):
+        ttl = PENDING_TTL if record[1] == PENDING else self.ttl
+        self.records[key] = (*record, now + ttl)
+        self.records.move_to_end(key)
+        while len(self.records) > self.max_keys:
+            self.records.popitem(last=False)
+
+    def remove(self, key):
+        self.records.pop(key, None)
+
+    def claim(self, key, fingerprint):
+        '''Returns the record of the key, or None after having created a pending record'''
+        now = time.time()
+        record = self.get(key, now)
+        if record is None:
+            self.set(key, (fingerprint, PENDING, ''), now)
+        return record
+
+    def begin(self, key, fingerprint):
+        '''Start a request with an Idempotency-Key
+
+        Returns:
+            None if the request must be processed, otherwise the (fingerprint, status,
+            shortlink_id) record of the original request, with a PENDING status if it is still
+            being processed after `wait_timeout` seconds (or if its fingerprint differs).
+        '''
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            record = self.claim(key, fingerprint)
+            if record is None or record[1] != PENDING or record[0] != fingerprint:
+                return record
+            if time.monotonic() >= deadline:
+                return record
+            gevent.sleep(POLL_INTERVAL)
+
+    def complete(self, key, fingerprint, status, shortlink_id):
+        self.set(key, (fingerprint, status, shortlink_id), time.time())
+
+    def release(self, key):
+        '''Forget the pending record of a failed request, so that it can be retried'''
+        self.remove(key)
+
+
+class SlotRecord(ctypes.Structure):
+    _fields_ = [
+        ('key', ctypes.c_char * 32),
+        ('fingerprint', ctypes.c_char * 32),
+        ('status', ctypes.c_int),
+        ('shortlink_id', ctypes.c_char * 64),
+        ('expires', ctypes.c_double),
+    ]
+
+
+class SharedIdempotencyStore(IdempotencyStore):
+    '''Idempotency-Key store shared by all forked processes (gunicorn workers)
+
+    The records are stored in a fixed size shared memory array that must be created before the
+    workers are forked. Keys are hashed into `max_keys` slots, a new key replacing the record of
+    another key sharing its slot.
+    '''
+
+    def __init__(self, max_keys, ttl, wait_timeout):
+        super().__init__(max_keys, ttl, wait_timeout)
+        self.slots = multiprocessing.RawArray(SlotRecord, max_keys)
+        self.lock = multiprocessing.Lock()
+
+    def get_slot(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32].encode('ascii')
+        return self.slots[zlib.crc32(digest) % self.max_keys], digest
+
+    def get(self, key, now):
+        slot, digest = self.get_slot(key)
+        if slot.key != digest or slot.expires < now:
+            return None
+        return (slot.fingerprint.decode('ascii'), slot.status, slot.shortlink_id.decode('utf-8'))
+
+    def set(self, key, record, now):
+        slot, digest = self.get_slot(key)
+        fingerprint, status, shortlink_id = record
+        slot.key = digest
+        slot.fingerprint = fingerprint.encode('ascii')
+        slot.status = status
+        slot.shortlink_id = shortlink_id.encode('utf-8')
+        slot.expires = now + (PENDING_TTL if status == PENDING else self.ttl)
+
+    @contextmanager
+    def locked(self):
+        '''Hold the lock of the store, yielding to the other greenlets while waiting for it'''
+        while not self.lock.acquire(block=False):
+            gevent.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        with self.locked():
+            slot, digest = self.get_slot(key)
+            if slot.key == digest:
+                slot.expires = 0
+
+    def claim(self, key, fingerprint):
+        with self.locked():
+            return super().claim(key, fingerprint)
+
+    def complete(self, key, fingerprint, status, shortlink_id):
+        with self.locked():
+            super().complete(key, fingerprint, status, shortlink_id)
+
+
+def init_idempotency_store():
+    if not IDEMPOTENCY:
+        return None
+    store_class = SharedIdempotencyStore if IDEMPOTENCY_SHARED else IdempotencyStore
+    return store_class(IDEMPOTENCY_MAX_KEYS, IDEMPOTENCY_TTL, IDEMPOTENCY_WAIT_TIMEOUT)
+
+
+# NOTE: the store needs to be created at import time, in order for the shared memory to be
+# created before forking the workers.
+idempotency_store = init_idempotency_store()
+
+
+def get_request_fingerprint():
+    return hashlib.sha256(request.get_data()).hexdigest()[:32]
+
+
+def get_idempotency_key():
+    '''Returns the store key of the request Idempotency-Key or None if not given or not supported
+
+    The keys are scoped by client (see RATE_LIMIT_KEY), so that a client cannot replay the
+    response of another client using the same key.
+    '''
+    if idempotency_store is None:
+        return None
+    key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+    if not key:
+        return None
+    if len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        abort(
+            400,
+            f'{IDEMPOTENCY_KEY_HEADER} header too long '
+            f'(limit is {MAX_IDEMPOTENCY_KEY_LENGTH} characters)'
+        )
+    return f'{get_client_key()} {key}'
+
+
+def begin_idempotent_request(key):
+    '''Start the processing of a request with an Idempotency-Key
+
+    Returns:
+        None if the request must be processed, otherwise the (status, shortlink_id) of the
+        original response to replay. Abort with a 409 if the original request is still being
+        processed and with a 422 if the key has been used with another request body.
+    '''
+    fingerprint = get_request_fingerprint()
+    record = idempotency_store.begin(key, fingerprint)
+    if record is None:
+        idempotent_requests_counter.add(1, {'result': 'new'})
+        return None
+    original_fingerprint, status, shortlink_id = record
+    if original_fingerprint != fingerprint:
+        idempotent_requests_counter.add(1, {'result': 'mismatch'})
+        abort(422, f'{IDEMPOTENCY_KEY_HEADER} already used with another request')
+    if status == PENDING:
+        idempotent_requests_counter.add(1, {'result': 'conflict'})
+        abort(409, f'A request with the same {IDEMPOTENCY_KEY_HEADER} is still being processed')
+    idempotent_requests_counter.add(1, {'result': 'replayed'})
+    logger.debug('Replay the response of %s %s', IDEMPOTENCY_KEY_HEADER, key)
+    return status, shortlink_id
+
+
+def complete_idempotent_request(key, status, shortlink_id):
+    idempotency_store.complete(key, get_request_fingerprint(), status, shortlink_id)
+
+
+def release_idempotent_request(key):
+    idempotency_store.release(key)
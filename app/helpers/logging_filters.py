@@ -0,0 +1,92 @@
+import logging
+from collections import OrderedDict
+
+
+class DeduplicationFilter(logging.Filter):
+    '''Logging filter suppressing the repeated records of hot failure paths
+
+    Records of at least `level` are deduplicated by logger, message template (not the formatted
+    message, or the exception type and code for exceptions logged as message) and the optional
+    `key_fields` record attributes (which must be hashable): within `window` seconds only the
+    first record of a key passes. Once the window of a key is over, the number of suppressed
+    records is logged in a summary record of the same logger and level. The expired windows are
+    checked on each record going through the filter, whatever its level.
+
+    The filter should be the first one of the handlers, so that the suppressed records are
+    dropped before any costly filter (e.g. the flask request attributes). When the filter is
+    shared by several handlers, the decision is taken once per record.
+
+    Configuration example:
+
+        filters:
+          dedup:
+            (): app.helpers.logging_filters.DeduplicationFilter
+            window: 10
+            level: WARNING
+            key_fields: []
+            max_keys: 1000
+    '''
+
+    def __init__(self, window=10, level='WARNING', key_fields=None, max_keys=1000):
+        super().__init__()
+        self.window = float(window)
+        self.level = logging.getLevelName(level) if isinstance(level, str) else level
+        self.key_fields = tuple(key_fields or [])
+        self.max_keys = max_keys
+        # key -> [window start, number of suppressed records, level]
+        self.keys = OrderedDict()
+
+    def filter(self, record):
+        passed = getattr(record, 'dedup_passed', None)
+        if passed is not None:
+            return passed
+        self.expire(record.created)
+        passed = record.levelno < self.level or self.check(record)
+        record.dedup_passed = passed
+        return passed
+
+    def get_key(self, record):
+        if isinstance(record.msg, str):
+            template = record.msg
+        elif isinstance(record.msg, BaseException):
+            # The message of an exception contains its arguments (e.g. the shortlink_id)
+            template = (type(record.msg).__name__, getattr(record.msg, 'code', None))
+        else:
+            template = str(record.msg)
+        return (record.name,
+                template) + tuple(getattr(record, field, None) for field in self.key_fields)
+
+    def check(self, record):
+        key = self.get_key(record)
+        state = self.keys.get(key)
+        if state is not None and record.created - state[0] < self.window:
+            state[1] += 1
+            return False
+        self.keys[key] = [record.created, 0, record.levelno]
+        self.keys.move_to_end(key)
+        while len(self.keys) > self.max_keys:
+            self.summarize(*self.keys.popitem(last=False))
+        return True
+
+    def expire(self, now):
+        '''Forget the keys whose window is over, logging their number of suppressed records'''
+        # The keys are ordered by window start
+        while self.keys:
+            key, state = next(iter(self.keys.items()))
+            if now - state[0] < self.window:
+                return
+            self.summarize(*self.keys.popitem(last=False))
+
+    def summarize(self, key, state):
+        _, suppressed, level = state
+        if not suppressed:
+            return
+        name, template = key[:2]
+        logging.getLogger(name).log(
+            level,
+            '%s [%d similar messages suppressed in the last %gs]',
+            template if isinstance(template, str) else ' '.join(map(str, template)),
+            suppressed,
+            self.window,
+            extra={'dedup_passed': True}
+        )
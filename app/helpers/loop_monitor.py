@@ -0,0 +1,127 @@
+import logging
+import time
+import warnings
+from collections import deque
+
+import gevent
+import gevent.events
+from opentelemetry import metrics
+
+from app.helpers.worker_greenlet import WorkerGreenlet
+from app.settings import LOOP_MONITOR
+from app.settings import LOOP_MONITOR_BLOCKING_THRESHOLD
+from app.settings import LOOP_MONITOR_INTERVAL
+
+logger = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+loop_lag_histogram = meter.create_histogram(
+    'shortlink.gevent.loop_lag',
+    unit='s',
+    description='Delay of the gevent hub in running a greenlet that is ready to run'
+)
+loop_lag_gauge = meter.create_gauge(
+    'shortlink.gevent.loop_lag.percentile',
+    unit='s',
+    description='Percentiles (p50, p95 and p99) of the recent gevent hub loop lags'
+)
+loop_blocked_counter = meter.create_counter(
+    'shortlink.gevent.blocked',
+    unit='{event}',
+    description='Number of times a greenlet blocked the gevent hub longer than the threshold'
+)
+
+PERCENTILES = (50, 95, 99)
+# The percentiles are computed over the last samples and refreshed every few samples
+LAG_SAMPLES = 600
+LAG_REFRESH = 50
+
+
+class LoopMonitor(WorkerGreenlet):
+    '''Gevent hub loop lag and blocking greenlets monitor of a worker
+
+    A probe greenlet sleeps `interval` seconds in loop, the extra time it takes to be scheduled
+    again is the loop lag: the time during which other greenlets held the hub.
+
+    The greenlets holding the hub longer than `blocking_threshold` are detected by the gevent
+    monitoring thread (see gevent.config.monitor_thread). As this runs in a native thread, the
+    blocking events are only queued there, and logged with the stack of the blocking greenlet by
+    the probe greenlet once the hub is released.
+    '''
+
+    def __init__(self, interval, blocking_threshold):
+        super().__init__()
+        self.interval = interval
+        self.blocking_threshold = blocking_threshold
+        self.lags = deque(maxlen=LAG_SAMPLES)
+        self.new_lags = 0
+        self.blocked_events = deque(maxlen=100)
+
+    def on_start(self):
+        self.lags.clear()
+        self.blocked_events.clear()
+        gevent.config.monitor_thread = True
+        gevent.config.max_blocking_time = self.blocking_threshold
+        # The blocking reports are logged by the monitor instead of printed to stderr
+        gevent.config.print_blocking_reports = False
+        if self.on_event not in gevent.events.subscribers:
+            gevent.events.subscribers.append(self.on_event)
+        with warnings.catch_warnings():
+            # The memory monitoring requires psutil and is not used
+            warnings.filterwarnings('ignore', message='Unable to monitor memory usage')
+            gevent.get_hub().start_periodic_monitoring_thread()
+
+    def on_stop(self):
+        if self.on_event in gevent.events.subscribers:
+            gevent.events.subscribers.remove(self.on_event)
+        hub = gevent.get_hub()
+        if hub.periodic_monitoring_thread is not None:
+            hub.periodic_monitoring_thread.kill()
+            hub.periodic_monitoring_thread = None
+
+    def on_event(self, event):
+        # Called from the gevent monitoring thread, only thread safe operations here
+        if isinstance(event, gevent.events.EventLoopBlocked):
+            self.blocked_events.append((repr(event.greenlet), list(event.info)))
+
+    def run(self):
+        while True:
+            started = time.perf_counter()
+            gevent.sleep(self.interval)
+            self.record_lag(max(0.0, time.perf_counter() - started - self.interval))
+            self.report_blocked()
+
+    def record_lag(self, lag):
+        loop_lag_histogram.record(lag)
+        self.lags.append(lag)
+        self.new_lags += 1
+        if self.new_lags >= LAG_REFRESH:
+            self.new_lags = 0
+            for percentile, value in self.percentiles().items():
+                loop_lag_gauge.set(value, {'percentile': f'p{percentile}'})
+
+    def percentiles(self):
+        '''Returns the percentiles of the recent loop lags'''
+        if not self.lags:
+            return {}
+        ordered = sorted(self.lags)
+        return {
+            percentile: ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+            for percentile in PERCENTILES
+        }
+
+    def report_blocked(self):
+        while self.blocked_events:
+            greenlet, info = self.blocked_events.popleft()
+            loop_blocked_counter.add(1)
+            logger.warning(
+                'Greenlet %s blocked the gevent hub for more than %.3fs\n%s',
+                greenlet,
+                self.blocking_threshold,
+                '\n'.join(info)
+            )
+
+
+loop_monitor = LoopMonitor(
+    LOOP_MONITOR_INTERVAL, LOOP_MONITOR_BLOCKING_THRESHOLD
+) if LOOP_MONITOR else None
@@ -1,11 +1,16 @@
 from os import getenv
 
+from opentelemetry import metrics
 from opentelemetry import trace
+from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import \
+    OTLPMetricExporter
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import \
     OTLPSpanExporter
 from opentelemetry.instrumentation.botocore import BotocoreInstrumentor
 from opentelemetry.instrumentation.flask import FlaskInstrumentor
 from opentelemetry.instrumentation.logging import LoggingInstrumentor
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
 from opentelemetry.sdk.resources import Resource
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
@@ -54,3 +59,19 @@ def setup_trace_provider():
         provider = TracerProvider(resource=Resource.create())
         provider.add_span_processor(span_processor)
         trace.set_tracer_provider(provider)
+
+
+def setup_meter_provider():
+    if not strtobool(getenv("OTEL_SDK_DISABLED", "false")) and \
+        strtobool(getenv("OTEL_ENABLE_METRICS", "false")):
+        # The instruments created at module level with metrics.get_meter() are proxies that are
+        # bound to this provider once it is set.
+        metric_reader = PeriodicExportingMetricReader(
+            OTLPMetricExporter(
+                endpoint=getenv('OTEL_EXPORTER_OTLP_ENDPOINT', "http://localhost:4317"),
+                headers=getenv('OTEL_EXPORTER_OTLP_HEADERS'),
+                insecure=strtobool(getenv('OTEL_EXPORTER_OTLP_INSECURE', "false"))
+            )
+        )
+        provider = MeterProvider(resource=Resource.create(), metric_readers=[metric_reader])
+        metrics.set_meter_provider(provider)
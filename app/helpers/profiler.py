@@ -0,0 +1,232 @@
+import hmac
+import logging
+import os
+import random
+import signal
+import threading
+import time
+from pathlib import Path
+
+import gevent
+from opentelemetry import metrics
+
+from app.helpers.worker_greenlet import WorkerGreenlet
+from app.settings import PROFILER
+from app.settings import PROFILER_DIR
+from app.settings import PROFILER_FLUSH_INTERVAL
+from app.settings import PROFILER_HEADER
+from app.settings import PROFILER_INTERVAL
+from app.settings import PROFILER_MAX_DISK
+from app.settings import PROFILER_MAX_OVERHEAD
+from app.settings import PROFILER_MAX_STACKS
+from app.settings import PROFILER_SAMPLE_RATE
+from app.settings import PROFILER_TOKEN
+
+logger = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+profiled_requests_counter = meter.create_counter(
+    'shortlink.profiler.requests',
+    unit='{request}',
+    description='Number of profiled requests per endpoint'
+)
+profiler_skipped_counter = meter.create_counter(
+    'shortlink.profiler.skipped',
+    unit='{event}',
+    description='Number of profiles and profile writes skipped per reason (overhead or disk)'
+)
+
+# Window in seconds over which the overhead of the profiler is capped
+OVERHEAD_WINDOW = 60
+MAX_STACK_DEPTH = 128
+# Samples of new stacks once the maximum number of stacks of an endpoint has been reached
+TRUNCATED_STACK = '[truncated]'
+
+
+class SamplingProfiler(WorkerGreenlet):  # pylint: disable=too-many-instance-attributes
+    '''Statistical profiler of the requests of a worker
+
+    While at least one request is profiled, a SIGPROF interval timer interrupts the worker every
+    `interval` seconds of CPU time and the stack of the running greenlet is sampled if it serves a
+    profiled request. The stacks are aggregated per endpoint and periodically written in the
+    collapsed stack format of flamegraph.pl/speedscope, one file per endpoint and worker in
+    `directory`, by default the `profiles` directory of LOGS_DIR when the worker starts profiling.
+
+    Requests are profiled at random with `sample_rate`, or when they carry the `header` with the
+    `token` value. The time spent sampling and writing is capped to `max_overhead` of the wall
+    time, beyond it the profiles are dropped until the next window. The files are not written
+    when the directory would exceed `max_disk` bytes.
+
+    The profiler must run in the main thread (signal handler), which is the case of the gevent
+    workers.
+    '''
+
+    def __init__(
+        self,
+        directory,
+        *,
+        sample_rate,
+        header,
+        token,
+        interval,
+        max_overhead,
+        flush_interval,
+        max_disk,
+        max_stacks,
+    ):
+        super().__init__()
+        self.configured_directory = directory
+        self.directory = None
+        self.sample_rate = sample_rate
+        self.header = header
+        self.token = token
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.flush_interval = flush_interval
+        self.max_disk = max_disk
+        self.max_stacks = max_stacks
+        # profiled greenlet -> endpoint
+        self.active = {}
+        # endpoint -> {collapsed stack: samples}
+        self.stacks = {}
+        self.labels = {}
+        self.overhead = 0.0
+        self.window_started = time.monotonic()
+        self.armed = False
+
+    def on_start(self):
+        self.directory = Path(
+            self.configured_directory or os.path.join(os.getenv('LOGS_DIR', 'logs'), 'profiles')
+        )
+        self.active.clear()
+        self.stacks.clear()
+        signal.signal(signal.SIGPROF, self.sample)
+
+    def stop(self):
+        '''Stop the profiling and write the pending stacks'''
+        self.disarm()
+        self.active.clear()
+        super().stop()
+
+    def on_stop(self):
+        self.flush()
+
+    def run(self):
+        while True:
+            gevent.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as error:
+                logger.error('Failed to write the profiles: %s', error)
+
+    def should_profile(self, headers):
+        if self.token and hmac.compare_digest(headers.get(self.header, ''), self.token):
+            return True
+        return random.random() < self.sample_rate
+
+    def over_budget(self):
+        now = time.monotonic()
+        if now - self.window_started > OVERHEAD_WINDOW:
+            self.window_started = now
+            self.overhead = 0.0
+        return self.overhead > self.max_overhead * OVERHEAD_WINDOW
+
+    def start_request(self, endpoint, headers):
+        '''Start profiling the current request if selected
+
+        Returns:
+            True if the request is profiled
+        '''
+        if not self.should_profile(headers):
+            return False
+        if threading.current_thread() is not threading.main_thread():
+            return False
+        if self.over_budget():
+            profiler_skipped_counter.add(1, {'reason': 'overhead'})
+            return False
+        self.start()
+        self.active[gevent.getcurrent()] = endpoint or 'unknown'
+        profiled_requests_counter.add(1, {'endpoint': endpoint or 'unknown'})
+        if not self.armed:
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+            self.armed = True
+        return True
+
+    def stop_request(self):
+        '''Stop profiling the current request'''
+        if self.active.pop(gevent.getcurrent(), None) is not None and not self.active:
+            self.disarm()
+
+    def disarm(self):
+        if self.armed:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            self.armed = False
+
+    def sample(self, signum, frame):  # pylint: disable=unused-argument
+        started = time.perf_counter()
+        endpoint = self.active.get(gevent.getcurrent())
+        if endpoint is not None and frame is not None:
+            self.record(endpoint, frame)
+        self.overhead += time.perf_counter() - started
+        if self.over_budget():
+            # Hard cap, the requests currently profiled are dropped
+            profiler_skipped_counter.add(len(self.active), {'reason': 'overhead'})
+            self.active.clear()
+            self.disarm()
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = \
+                f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+        return label
+
+    def record(self, endpoint, frame):
+        labels = []
+        while frame is not None and len(labels) < MAX_STACK_DEPTH:
+            labels.append(self.label(frame.f_code))
+            frame = frame.f_back
+        stack = ';'.join(reversed(labels))
+        counts = self.stacks.setdefault(endpoint, {})
+        if stack not in counts and len(counts) >= self.max_stacks:
+            stack = TRUNCATED_STACK
+        counts[stack] = counts.get(stack, 0) + 1
+
+    def flush(self):
+        '''Write the collapsed stacks of each endpoint (since the worker start)'''
+        started = time.perf_counter()
+        try:
+            for endpoint, counts in list(self.stacks.items()):
+                self.write(
+                    self.directory / f'{endpoint}-{self.pid}.folded',
+                    ''.join(f'{stack} {count}\n' for stack, count in counts.items())
+                )
+        finally:
+            self.overhead += time.perf_counter() - started
+
+    def write(self, path, content):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        used = sum(
+            entry.stat().st_size for entry in self.directory.glob('*.folded') if entry != path
+        )
+        if used + len(content) > self.max_disk:
+            logger.warning('Profiles directory %s full, %s not written', self.directory, path)
+            profiler_skipped_counter.add(1, {'reason': 'disk'})
+            return
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'wt', encoding='utf-8') as fd:
+            fd.write(content)
+        tmp_path.replace(path)
+
+
+profiler = SamplingProfiler(
+    PROFILER_DIR,
+    sample_rate=PROFILER_SAMPLE_RATE,
+    header=PROFILER_HEADER,
+    token=PROFILER_TOKEN,
+    interval=PROFILER_INTERVAL,
+    max_overhead=PROFILER_MAX_OVERHEAD,
+    flush_interval=PROFILER_FLUSH_INTERVAL,
+    max_disk=PROFILER_MAX_DISK,
+    max_stacks=PROFILER_MAX_STACKS,
+) if PROFILER else None
@@ -0,0 +1,165 @@
+import ipaddress
+import logging
+import math
+import multiprocessing
+import time
+import zlib
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from opentelemetry import metrics
+
+from flask import abort
+from flask import request
+
+from app.settings import FORWARDED_ALLOW_IPS
+from app.settings import FORWARDED_TRUSTED_HOPS
+from app.settings import RATE_LIMIT_CREATE
+from app.settings import RATE_LIMIT_CREATE_BURST
+from app.settings import RATE_LIMIT_CREATE_RATE
+from app.settings import RATE_LIMIT_KEY
+from app.settings import RATE_LIMIT_MAX_CLIENTS
+from app.settings import RATE_LIMIT_SHARED
+
+logger = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+rate_limited_counter = meter.create_counter(
+    'shortlink.rate_limited',
+    unit='{request}',
+    description='Number of requests rejected by the rate limiter'
+)
+
+
+class TokenBucketRateLimiter:
+    '''Per client token bucket rate limiter
+
+    Each client has a bucket of `burst` tokens refilled at `rate` tokens per second, a request
+    consuming one token. At most `max_clients` buckets are kept, the least recently used client
+    being forgotten (which means that its bucket will be full again).
+    '''
+
+    def __init__(self, rate, burst, max_clients):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+
+    def acquire(self, key, now=None):
+        '''Take a token from the client bucket
+
+        Returns:
+            0 if the request is allowed, otherwise the number of seconds to wait for a token.
+        '''
+        now = time.monotonic() if now is None else now
+        tokens, last = self.buckets.pop(key, (self.burst, now))
+        tokens, wait = self.take_token(tokens, last, now)
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_clients:
+            self.buckets.popitem(last=False)
+        return wait
+
+    def take_token(self, tokens, last, now):
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, 0
+        return tokens, (1 - tokens) / self.rate
+
+
+class SharedTokenBucketRateLimiter(TokenBucketRateLimiter):
+    '''Token bucket rate limiter shared by all forked processes (gunicorn workers)
+
+    The buckets are stored in a fixed size shared memory array that must be created before the
+    workers are forked. Clients are hashed into `max_clients` slots, therefore clients sharing a
+    slot also share their bucket.
+    '''
+
+    def __init__(self, rate, burst, max_clients):
+        super().__init__(rate, burst, max_clients)
+        # Per slot: number of tokens and time of last update (0 means unused slot). The
+        # monotonic clock cannot be used as it is not shared between processes.
+        self.slots = multiprocessing.RawArray('d', 2 * max_clients)
+        self.lock = multiprocessing.Lock()
+
+    def acquire(self, key, now=None):
+        now = time.time() if now is None else now
+        slot = 2 * (zlib.crc32(key.encode('utf-8')) % self.max_clients)
+        with self.lock:
+            tokens, last = self.slots[slot], self.slots[slot + 1]
+            if last == 0:
+                tokens, last = self.burst, now
+            tokens, wait = self.take_token(tokens, max(last, 0), now)
+            self.slots[slot], self.slots[slot + 1] = tokens, now
+        return wait
+
+
+def is_trusted_proxy(address):
+    '''Returns True if the address is part of the FORWARDED_ALLOW_IPS'''
+    if '*' in FORWARDED_ALLOW_IPS:
+        return True
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in ipaddress.ip_network(network, strict=False) for network in FORWARDED_ALLOW_IPS)
+
+
+def get_client_ip():
+    '''Returns the client IP address of the request
+
+    The X-Forwarded-For header is only taken into account when the request comes from a trusted
+    proxy (see gunicorn forwarded_allow_ips), in this case the client is the right most address
+    of the header that is not a trusted proxy. When all proxies are trusted (`*`), the client is
+    the address appended by the FORWARDED_TRUSTED_HOPS-th proxy counted from the right, the left
+    most addresses being set by the client itself.
+    '''
+    remote_addr = request.remote_addr
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    if not forwarded_for or not is_trusted_proxy(remote_addr):
+        return remote_addr
+    hops = [hop.strip() for hop in forwarded_for.split(',') if hop.strip()]
+    if '*' in FORWARDED_ALLOW_IPS:
+        if not hops:
+            return remote_addr
+        return hops[-min(max(FORWARDED_TRUSTED_HOPS, 1), len(hops))]
+    for hop in reversed(hops):
+        if not is_trusted_proxy(hop):
+            return hop
+    # All hops are trusted proxies
+    return remote_addr
+
+
+def get_client_key():
+    if RATE_LIMIT_KEY == 'origin':
+        origin = request.headers.get('Origin', request.headers.get('Referer', ''))
+        domain = urlparse(origin).hostname
+        if domain:
+            return domain
+    return get_client_ip() or ''
+
+
+def init_create_rate_limiter():
+    if not RATE_LIMIT_CREATE:
+        return None
+    if RATE_LIMIT_SHARED:
+        limiter_class = SharedTokenBucketRateLimiter
+    else:
+        limiter_class = TokenBucketRateLimiter
+    return limiter_class(RATE_LIMIT_CREATE_RATE, RATE_LIMIT_CREATE_BURST, RATE_LIMIT_MAX_CLIENTS)
+
+
+# NOTE: the rate limiter needs to be created at import time, in order for the shared memory to be
+# created before forking the workers.
+create_rate_limiter = init_create_rate_limiter()
+
+
+def check_create_rate_limit():
+    '''Abort with a 429 status code if the client exceeded its shortlink creation rate'''
+    if create_rate_limiter is None:
+        return
+    key = get_client_key()
+    wait = create_rate_limiter.acquire(key)
+    if wait > 0:
+        logger.warning('Client %s exceeded the shortlink creation rate limit', key)
+        rate_limited_counter.add(1, {'endpoint': request.endpoint})
+        abort(429, 'Too many shortlink creations, please retry later', retry_after=math.ceil(wait))
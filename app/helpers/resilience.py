@@ -0,0 +1,182 @@
+import logging
+import time
+from collections import deque
+
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError
+from opentelemetry import metrics
+
+from app.settings import CIRCUIT_BREAKER_ENABLED
+from app.settings import CIRCUIT_BREAKER_FAILURE_RATE
+from app.settings import CIRCUIT_BREAKER_MIN_CALLS
+from app.settings import CIRCUIT_BREAKER_OPEN_DURATION
+from app.settings import CIRCUIT_BREAKER_WINDOW
+
+logger = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+circuit_rejected_counter = meter.create_counter(
+    'shortlink.dynamodb.circuit_breaker.rejected',
+    unit='{call}',
+    description='Number of DynamoDB calls rejected by the open circuit breaker'
+)
+circuit_opened_counter = meter.create_counter(
+    'shortlink.dynamodb.circuit_breaker.opened',
+    unit='{event}',
+    description='Number of times the DynamoDB circuit breaker opened'
+)
+
+# DynamoDB error codes caused by throttling, see
+# https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Programming.Errors.html
+THROTTLING_ERROR_CODES = {
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'ThrottlingException',
+}
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    '''Raised when a call is rejected by an open circuit breaker'''
+
+    def __init__(self, name, retry_after):
+        super().__init__(f'Circuit breaker {name} is open')
+        self.retry_after = retry_after
+
+
+def is_availability_error(error):
+    '''Returns True if the error denotes an unavailable or throttled service
+
+    Other errors (e.g. conditional check or validation errors) are a normal answer of the
+    service and must not open the circuit.
+    '''
+    if isinstance(error, BotoCoreError):
+        return True
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return code in THROTTLING_ERROR_CODES or status >= 500
+    return False
+
+
+class CircuitBreaker:
+    '''Circuit breaker based on the error rate of a sliding time window
+
+    The circuit opens when at least `min_calls` calls have been done during the last `window`
+    seconds and the rate of failed calls is above `failure_rate`. While open, the calls fail
+    fast with a CircuitOpenError. After `open_duration` seconds a single trial call is let
+    through (half open state), its outcome closes or re-opens the circuit.
+    '''
+
+    def __init__(self, name, *, failure_rate, min_calls, window, open_duration, enabled=True):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_duration = open_duration
+        self.enabled = enabled
+        self.state = CLOSED
+        self.opened_at = 0
+        self.trial_running = False
+        # One [second, calls, failures] bucket per second of the window
+        self.buckets = deque()
+
+    def reset(self):
+        self.state = CLOSED
+        self.trial_running = False
+        self.buckets.clear()
+
+    def call(self, func, *args, **kwargs):
+        '''Call the function through the circuit breaker'''
+        if not self.enabled:
+            return func(*args, **kwargs)
+        trial = self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:
+            self.after_call(trial, failed=is_availability_error(error))
+            raise
+        except BaseException:
+            # Interrupted call (e.g. GreenletExit), its outcome is unknown but the next trial
+            # call must be let through
+            if trial:
+                self.trial_running = False
+            raise
+        self.after_call(trial, failed=False)
+        return result
+
+    def before_call(self):
+        '''Raise a CircuitOpenError if the call is not allowed
+
+        Returns:
+            True if the call is the trial call of the half open state
+        '''
+        if self.state == CLOSED:
+            return False
+        now = time.monotonic()
+        if self.state == OPEN and now - self.opened_at >= self.open_duration:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN and not self.trial_running:
+            self.trial_running = True
+            return True
+        circuit_rejected_counter.add(1, {'circuit': self.name})
+        raise CircuitOpenError(
+            self.name, max(1, int(self.opened_at + self.open_duration - now) + 1)
+        )
+
+    def after_call(self, trial, failed):
+        if trial:
+            self.trial_running = False
+            if failed:
+                self.open(time.monotonic())
+            else:
+                logger.info('Circuit breaker %s closed', self.name)
+                self.reset()
+            return
+        self.record(failed)
+
+    def record(self, failed):
+        now = time.monotonic()
+        second = int(now)
+        if not self.buckets or self.buckets[-1][0] != second:
+            self.buckets.append([second, 0, 0])
+        self.buckets[-1][1] += 1
+        self.buckets[-1][2] += int(failed)
+        while self.buckets and self.buckets[0][0] <= second - self.window:
+            self.buckets.popleft()
+        if not failed or self.state != CLOSED:
+            return
+        calls = sum(bucket[1] for bucket in self.buckets)
+        failures = sum(bucket[2] for bucket in self.buckets)
+        if calls >= self.min_calls and failures / calls >= self.failure_rate:
+            self.open(now)
+
+    def open(self, now):
+        logger.error('Circuit breaker %s opened for %ss', self.name, self.open_duration)
+        circuit_opened_counter.add(1, {'circuit': self.name})
+        self.state = OPEN
+        self.opened_at = now
+        self.buckets.clear()
+
+
+dynamodb_circuit_breaker = CircuitBreaker(
+    'dynamodb',
+    failure_rate=CIRCUIT_BREAKER_FAILURE_RATE,
+    min_calls=CIRCUIT_BREAKER_MIN_CALLS,
+    window=CIRCUIT_BREAKER_WINDOW,
+    open_duration=CIRCUIT_BREAKER_OPEN_DURATION,
+    enabled=CIRCUIT_BREAKER_ENABLED
+)
+# Circuit of the background DynamoDB accesses (URL filter rebuild, write-behind flush, hit
+# counters), their failures do not open the circuit of the requests and vice versa
+dynamodb_background_circuit_breaker = CircuitBreaker(
+    'dynamodb-background',
+    failure_rate=CIRCUIT_BREAKER_FAILURE_RATE,
+    min_calls=CIRCUIT_BREAKER_MIN_CALLS,
+    window=CIRCUIT_BREAKER_WINDOW,
+    open_duration=CIRCUIT_BREAKER_OPEN_DURATION,
+    enabled=CIRCUIT_BREAKER_ENABLED
+)
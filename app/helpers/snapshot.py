@@ -0,0 +1,231 @@
+import logging
+import mmap
+import os
+import re
+import struct
+import time
+import zlib
+from collections import Counter
+from itertools import islice
+from pathlib import Path
+
+from opentelemetry import metrics
+
+logger = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+snapshot_lookups_counter = meter.create_counter(
+    'shortlink.snapshot.lookups',
+    unit='{lookup}',
+    description='Number of snapshot index lookups per result (hit or miss)'
+)
+
+# File layout:
+#   header | keys (count * key_width) | offsets ((count + 1) * uint64) | dictionary | blob
+# The keys are the sorted shortlink ids, right padded with NUL bytes. Each entry of the blob is a
+# raw deflate stream of `created\nurl` compressed with the shared dictionary, the offsets are
+# relative to the blob start and the last one is the blob size.
+MAGIC = b'SHORTSNP'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQdI')
+OFFSET = struct.Struct('<Q')
+PADDING = b'\x00'
+
+# The deflate window is 32 KiB, a larger dictionary would not be used
+DICTIONARY_SIZE = 32 * 1024
+DICTIONARY_SAMPLE = 10000
+# URL tokens used to build the dictionary: path, then each query parameter
+TOKEN_REGEX = re.compile(r'(?=[?&#])')
+
+
+def build_dictionary(urls, size=DICTIONARY_SIZE):
+    '''Returns a deflate dictionary made of the most common URL tokens
+
+    The most common tokens are at the end of the dictionary, where they are encoded with the
+    shortest distances.
+    '''
+    counts = Counter(token for url in urls for token in TOKEN_REGEX.split(url) if token)
+    tokens = []
+    length = 0
+    for token, count in counts.most_common():
+        if count < 2:
+            break
+        encoded = token.encode('utf-8')
+        if length + len(encoded) > size:
+            continue
+        tokens.append(encoded)
+        length += len(encoded)
+    return b''.join(reversed(tokens))
+
+
+def write_snapshot(path, entries, dictionary_size=DICTIONARY_SIZE):
+    '''Write the snapshot index file of the entries
+
+    The file is written next to its final path and then atomically renamed, so that the workers
+    never map a partially written file.
+
+    Args:
+        path: str
+            Snapshot file path
+        entries: iterable
+            Entries as dict with shortlink_id, url and created
+
+    Returns:
+        The number of entries written
+    '''
+    entries = sorted(
+        ((entry['shortlink_id'].encode('ascii'), entry['url'], entry.get('created', ''))
+         for entry in entries),
+        key=lambda entry: entry[0]
+    )
+    key_width = max((len(key) for key, _, _ in entries), default=1)
+    dictionary = build_dictionary((url for _, url, _ in islice(entries, DICTIONARY_SAMPLE)),
+                                  dictionary_size)
+    blob = bytearray()
+    offsets = []
+    for _, url, created in entries:
+        offsets.append(len(blob))
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=dictionary)
+        blob += compressor.compress(f'{created}\n{url}'.encode('utf-8')) + compressor.flush()
+    offsets.append(len(blob))
+
+    path = Path(path)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as fd:
+        fd.write(HEADER.pack(MAGIC, VERSION, key_width, len(entries), time.time(), len(dictionary)))
+        for key, _, _ in entries:
+            fd.write(key.ljust(key_width, PADDING))
+        for offset in offsets:
+            fd.write(OFFSET.pack(offset))
+        fd.write(dictionary)
+        fd.write(blob)
+    tmp_path.replace(path)
+    return len(entries)
+
+
+class Snapshot:
+    '''Read only memory-mapped snapshot index of the shortlink entries
+
+    The keys are binary searched directly in the mapped file, only the probed keys are copied,
+    and the URL is decompressed straight from the mapped blob. The mapping is shared with the
+    page cache, therefore all workers of a host share the same memory.
+    '''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as fd:
+            self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.key_width, self.count, self.created, dictionary_size = \
+                HEADER.unpack_from(self.mm)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f'{path} is not a version {VERSION} shortlink snapshot')
+        except (ValueError, struct.error):
+            self.mm.close()
+            raise
+        self.keys_start = HEADER.size
+        self.offsets_start = self.keys_start + self.count * self.key_width
+        dictionary_start = self.offsets_start + (self.count + 1) * OFFSET.size
+        self.blob_start = dictionary_start + dictionary_size
+        self.dictionary = self.mm[dictionary_start:self.blob_start]
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.mm.close()
+
+    def key(self, index):
+        start = self.keys_start + index * self.key_width
+        return self.mm[start:start + self.key_width]
+
+    def find(self, short_id):
+        '''Returns the index of the shortlink_id or None if not in the snapshot'''
+        try:
+            key = short_id.encode('ascii')
+        except UnicodeEncodeError:
+            return None
+        if len(key) > self.key_width:
+            return None
+        key = key.ljust(self.key_width, PADDING)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.key(low) == key:
+            return low
+        return None
+
+    def get(self, short_id):
+        '''Returns the entry (shortlink_id, url and created) or None if not in the snapshot'''
+        index = self.find(short_id)
+        if index is None:
+            snapshot_lookups_counter.add(1, {'result': 'miss'})
+            return None
+        start, end = struct.unpack_from('<QQ', self.mm, self.offsets_start + index * OFFSET.size)
+        decompressor = zlib.decompressobj(-15, zdict=self.dictionary)
+        with memoryview(self.mm)[self.blob_start + start:self.blob_start + end] as data:
+            created, url = decompressor.decompress(data).decode('utf-8').split('\n', 1)
+        snapshot_lookups_counter.add(1, {'result': 'hit'})
+        return {'shortlink_id': short_id, 'url': url, 'created': created}
+
+
+class SnapshotIndex:
+    '''Per process snapshot index, reopened when the snapshot file is replaced
+
+    The snapshot is opened lazily, a missing or invalid file is not an error, the lookups then
+    simply fall through to DynamoDB. The file is checked for replacement at most every
+    `reload_interval` seconds.
+    '''
+
+    def __init__(self, path, reload_interval):
+        self.path = Path(path)
+        self.reload_interval = reload_interval
+        self.snapshot = None
+        self.inode = None
+        self.checked = None
+        self.pid = None
+
+    def reload(self):
+        now = time.monotonic()
+        if self.pid == os.getpid() and now - self.checked < self.reload_interval:
+            return
+        self.pid = os.getpid()
+        self.checked = now
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            self.close()
+            return
+        if (stat.st_ino, stat.st_mtime_ns) == self.inode:
+            return
+        try:
+            snapshot = Snapshot(self.path)
+        except (OSError, ValueError, struct.error) as error:
+            logger.error('Failed to open the snapshot %s: %s', self.path, error)
+            return
+        self.close()
+        self.snapshot = snapshot
+        self.inode = (stat.st_ino, stat.st_mtime_ns)
+        logger.info(
+            'Snapshot %s opened: %d entries, created %s',
+            self.path,
+            len(snapshot),
+            time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(snapshot.created))
+        )
+
+    def close(self):
+        if self.snapshot is not None:
+            self.snapshot.close()
+        self.snapshot = None
+        self.inode = None
+
+    def get(self, short_id):
+        '''Returns the entry of the snapshot or None if not found (or no snapshot available)'''
+        self.reload()
+        if self.snapshot is None:
+            return None
+        return self.snapshot.get(short_id)
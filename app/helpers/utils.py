@@ -1,7 +1,10 @@
+import hashlib
+import hmac
 import logging
 import logging.config
 import os
 import re
+import time
 from itertools import chain
 from pathlib import Path
 from urllib.parse import urlparse
@@ -15,13 +18,66 @@ from flask import jsonify
 from flask import make_response
 from flask import request
 
+from app.helpers.cache import LRUCache
 from app.helpers.otel import strtobool
+from app.helpers.resilience import CircuitOpenError
 from app.settings import ALLOWED_DOMAINS_PATTERN
+from app.settings import CACHE_CONTROL
+from app.settings import CACHE_CONTROL_4XX
+from app.settings import CACHE_CONTROL_INFO
+from app.settings import CACHE_CONTROL_NOT_FOUND
+from app.settings import CACHE_CONTROL_REDIRECT
+from app.settings import CACHE_STALE_IF_ERROR
+from app.settings import CACHE_STALE_WHILE_REVALIDATE
+from app.settings import ETAG_SECRET
 from app.settings import SHORT_ID_ALPHABET
+from app.settings import SHORT_ID_LEGACY_PATTERN
 from app.settings import SHORT_ID_SIZE
+from app.settings import SURROGATE_CONTROL_INFO
+from app.settings import SURROGATE_CONTROL_NOT_FOUND
+from app.settings import SURROGATE_CONTROL_REDIRECT
+from app.settings import URL_VALIDATION_CACHE_SIZE
 
 logger = logging.getLogger(__name__)
 
+# Internal endpoints, without CORS and Cache-Control headers
+INTERNAL_ENDPOINTS = frozenset(['checker', 'heavy_hitters'])
+
+# Shortlink ids that can safely be embedded in an ETag or a Surrogate-Key header
+ETAG_SHORTLINK_ID_PATTERN = re.compile(r'[0-9A-Za-z_-]+')
+
+ALLOWED_DOMAINS_REGEX = re.compile(ALLOWED_DOMAINS_PATTERN)
+
+# Verdicts of the URL validation
+URL_VALID = 'valid'
+URL_INVALID = 'invalid'
+URL_NOT_ALLOWED = 'not_allowed'
+url_verdict_cache = LRUCache(URL_VALIDATION_CACHE_SIZE)
+
+
+def with_stale_directives(cache_control):
+    directives = [cache_control]
+    if CACHE_STALE_WHILE_REVALIDATE > 0:
+        directives.append(f'stale-while-revalidate={CACHE_STALE_WHILE_REVALIDATE}')
+    if CACHE_STALE_IF_ERROR > 0:
+        directives.append(f'stale-if-error={CACHE_STALE_IF_ERROR}')
+    return ', '.join(directives)
+
+
+# Caching policies of the GET responses: policy -> (Cache-Control, Surrogate-Control)
+CACHE_POLICIES = {
+    'redirect': (with_stale_directives(CACHE_CONTROL_REDIRECT), SURROGATE_CONTROL_REDIRECT),
+    'info': (with_stale_directives(CACHE_CONTROL_INFO), SURROGATE_CONTROL_INFO),
+    'not_found': (CACHE_CONTROL_NOT_FOUND, SURROGATE_CONTROL_NOT_FOUND),
+    'client_error': (CACHE_CONTROL_4XX, ''),
+    # The server errors are not cached, to let the CDN serve its stale copies (stale-if-error)
+    'server_error': ('no-store', ''),
+    'default': (CACHE_CONTROL, ''),
+}
+
+SHORT_ID_CHARACTERS = frozenset(SHORT_ID_ALPHABET)
+SHORT_ID_LEGACY_REGEX = re.compile(SHORT_ID_LEGACY_PATTERN)
+
 
 def get_logging_cfg():
     cfg_file = os.getenv('LOGGING_CFG', 'logging-cfg-local.yaml')
@@ -76,6 +132,81 @@ def generate_short_id():
     return generate(SHORT_ID_ALPHABET, SHORT_ID_SIZE)
 
 
+def is_valid_short_id(short_id):
+    '''Returns False if the shortlink_id cannot exist
+
+    Valid ids are the ones generated by generate_short_id() and the legacy ones.
+    '''
+    if len(short_id) == SHORT_ID_SIZE and SHORT_ID_CHARACTERS.issuperset(short_id):
+        return True
+    return SHORT_ID_LEGACY_REGEX.fullmatch(short_id) is not None
+
+
+def get_url_digest(url):
+    '''Returns the fixed size digest of the URL, key of the UrlDigestIndex
+
+    The 128 bits of the digest make a collision unlikely, it is nevertheless possible and the URL
+    of the entries found by digest must be verified.
+    '''
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+
+
+def get_shortlink_etag(shortlink_id, created, hits=None):
+    '''Returns the strong ETag (unquoted) of a shortlink entry
+
+    A shortlink entry is immutable, therefore its ETag is derived from its shortlink_id and its
+    creation timestamp, and its number of hits when counted. Without hits and with an
+    ETAG_SECRET, the ETag is the shortlink_id signed with the secret, which allows to validate
+    an ETag without the DB entry (see is_shortlink_etag): only the service can generate it and it
+    only does so for existing shortlinks.
+    '''
+    if hits is None and ETAG_SECRET and ETAG_SHORTLINK_ID_PATTERN.fullmatch(shortlink_id):
+        return f'{shortlink_id}-{get_etag_signature(shortlink_id)}'
+    value = f'{shortlink_id}:{created}' if hits is None else f'{shortlink_id}:{created}:{hits}'
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()[:16]
+
+
+def get_etag_signature(shortlink_id):
+    return hmac.new(ETAG_SECRET.encode('utf-8'), shortlink_id.encode('utf-8'),
+                    hashlib.sha256).hexdigest()[:32]
+
+
+def is_shortlink_etag(shortlink_id, etag):
+    '''Returns True if the ETag (unquoted) is the signed ETag of the given shortlink_id'''
+    if not ETAG_SECRET or ETAG_SHORTLINK_ID_PATTERN.fullmatch(shortlink_id) is None:
+        return False
+    return hmac.compare_digest(etag, f'{shortlink_id}-{get_etag_signature(shortlink_id)}')
+
+
+def get_cache_policy(status_code, shortlink_id=None, redirect=False):
+    '''Returns the caching policy name of a GET response (see CACHE_POLICIES)'''
+    if status_code == 404:
+        return 'not_found'
+    if status_code >= 500:
+        return 'server_error'
+    if status_code >= 400:
+        return 'client_error'
+    if shortlink_id is None:
+        return 'default'
+    return 'redirect' if redirect else 'info'
+
+
+def set_cache_headers(response, policy, shortlink_id=None):
+    '''Set the Cache-Control, Surrogate-Control and Surrogate-Key headers of a GET response
+
+    The Surrogate-Key header carries the shortlink_id and the policy name, which allows the
+    targeted purge of the CDN copies of a shortlink (e.g. its cached 404 once created) or of all
+    the responses of a policy.
+    '''
+    cache_control, surrogate_control = CACHE_POLICIES[policy]
+    response.headers.set('Cache-Control', cache_control)
+    if surrogate_control:
+        response.headers.set('Surrogate-Control', surrogate_control)
+    if shortlink_id is not None and ETAG_SHORTLINK_ID_PATTERN.fullmatch(shortlink_id):
+        response.headers.set('Surrogate-Key', f'{shortlink_id} {policy}')
+    return response
+
+
 def make_error_msg(code, msg):
     response = make_response(
         jsonify({
@@ -88,6 +219,29 @@ def make_error_msg(code, msg):
     return response
 
 
+def make_exception_error_msg(err):
+    '''Returns the error response of an exception that is not an HTTPException'''
+    if isinstance(err, CircuitOpenError):
+        logger.error(err)
+        response = make_error_msg(503, "Service temporarily unavailable, please retry later")
+        response.headers['Retry-After'] = str(err.retry_after)
+        return response
+    logger.exception('Unexpected exception: %s', err)
+    return make_error_msg(500, "Internal server error, please consult logs")
+
+
+def get_response_log_extra(response, request_started):
+    '''Returns the log record extra attributes describing the response'''
+    return {
+        'response': {
+            "status_code": response.status_code,
+            "headers": dict(response.headers.items()),
+            "json": response.json,
+        },
+        "duration": time.time() - request_started
+    }
+
+
 def get_url():
     """
     Get and check the url parameter
@@ -96,6 +250,8 @@ def get_url():
     Abort with a 400 status code if the url is over 2046 characters long (dynamodb limitation)
     Abort with a 400 status code if the hostname of the URL parameter is not allowed.
     Abort with a 415 status code if the payload is invalid.
+
+    The checks are ordered cheapest first, see check_url().
     """
     if not request.is_json:
         abort(415, 'Input data missing or from wrong type, must be application/json')
@@ -103,18 +259,19 @@ def get_url():
     if url is None:
         logger.error('"url" parameter missing from input json')
         abort(400, 'Url parameter missing from request')
-    if not validators.url(url):
-        logger.error('URL %s not valid.', url)
-        abort(400, f"URL({url}) given as parameter is not valid.")
-        # urls have a maximum size of 2046 character due to a dynamodb limitation
-    if len(url) > 2046:
+    # urls have a maximum size of 2046 character due to a dynamodb limitation
+    if isinstance(url, str) and len(url) > 2046:
         logger.error("Url(%s) given as parameter exceeds characters limit.", url)
         abort(
             400,
             f"The url given as parameter was too long. (limit is 2046 "
             f"characters, {len(url)} given)"
         )
-    if not is_domain_allowed(url):
+    verdict = check_url(url)
+    if verdict == URL_INVALID:
+        logger.error('URL %s not valid.', url)
+        abort(400, f"URL({url}) given as parameter is not valid.")
+    if verdict == URL_NOT_ALLOWED:
         logger.error(
             'URL(%s) given as a parameter is not allowed, test pattern %s',
             url,
@@ -125,10 +282,43 @@ def get_url():
     return url
 
 
+def check_url(url):
+    """Returns the verdict of the URL validation: URL_VALID, URL_INVALID or URL_NOT_ALLOWED
+
+    The verdicts of the recently checked URLs are memoized.
+    """
+    if not isinstance(url, str):
+        return URL_INVALID
+    verdict = url_verdict_cache.get(url)
+    if verdict is None:
+        verdict = validate_url(url)
+        url_verdict_cache.set(url, verdict)
+    return verdict
+
+
+def validate_url(url):
+    """Validate the URL with the cheapest checks first
+
+    The hostname is checked against the allowed domains before the costly syntactic validation,
+    which is only done for URLs of allowed domains.
+    """
+    try:
+        domain = urlparse(url).hostname
+    except ValueError:
+        return URL_INVALID
+    if not domain:
+        return URL_INVALID
+    if ALLOWED_DOMAINS_REGEX.fullmatch(domain) is None:
+        return URL_NOT_ALLOWED
+    if not validators.url(url):
+        return URL_INVALID
+    return URL_VALID
+
+
 def is_domain_allowed(url):
     """Check if the url contain a domain that is allowed
     """
     domain = urlparse(url).hostname
     if domain:
-        return re.fullmatch(ALLOWED_DOMAINS_PATTERN, domain) is not None
+        return ALLOWED_DOMAINS_REGEX.fullmatch(domain) is not None
     return False
@@ -0,0 +1,45 @@
+import os
+from abc import ABC
+from abc import abstractmethod
+
+import gevent
+
+
+class WorkerGreenlet(ABC):
+    '''Background greenlet of a gunicorn worker
+
+    The instances are created on import, before the workers are forked, therefore the greenlet
+    is started lazily on first use in each worker. Subclasses implement run(), and can reset
+    their per worker state in on_start() and finalize it in on_stop() (e.g. a last flush), which
+    is only called if the greenlet was running.
+    '''
+
+    def __init__(self):
+        self.pid = None
+        self.greenlet = None
+
+    def start(self):
+        '''Start the greenlet of the worker, this is done lazily on first use'''
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.on_start()
+        self.greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        '''Stop the greenlet of the worker'''
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.on_stop()
+        self.greenlet = None
+        self.pid = None
+
+    def on_start(self):
+        pass
+
+    def on_stop(self):
+        pass
+
+    @abstractmethod
+    def run(self):
+        '''Body of the greenlet, usually an endless loop'''
@@ -0,0 +1,362 @@
+import fcntl
+import json
+import logging
+import os
+import uuid
+from collections import OrderedDict
+from collections import deque
+from itertools import islice
+from pathlib import Path
+
+import gevent
+import gevent.event
+import gevent.lock
+from opentelemetry import metrics
+
+logger = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+write_behind_flushed_counter = meter.create_counter(
+    'shortlink.write_behind.flushed',
+    unit='{entry}',
+    description='Number of write-behind entries flushed to DynamoDB'
+)
+write_behind_replayed_counter = meter.create_counter(
+    'shortlink.write_behind.replayed',
+    unit='{entry}',
+    description='Number of write-behind entries replayed from the journal of a dead worker'
+)
+write_behind_collisions_counter = meter.create_counter(
+    'shortlink.write_behind.id_collisions',
+    unit='{id}',
+    description='Number of generated shortlink_id rejected from the reserved ids as already used'
+)
+write_behind_conflicts_counter = meter.create_counter(
+    'shortlink.write_behind.conflicts',
+    unit='{entry}',
+    description='Number of write-behind entries not written on flush, their id being used by '
+    'another entry'
+)
+
+# Number of entries written per flush step (with a conditional PutItem each, BatchWriteItem
+# does not support conditions), respectively maximum number of items of a BatchGetItem request
+BATCH_WRITE_SIZE = 25
+BATCH_GET_SIZE = 100
+
+
+def read_journal(path):
+    '''Returns the entries of a journal file that have not yet been flushed'''
+    entries = OrderedDict()
+    with open(path, 'rt', encoding='utf-8') as fd:
+        for line in fd:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Partially written last line of a crashed worker
+                logger.warning('Ignore invalid journal record in %s: %s', path, line)
+                continue
+            if 'put' in record:
+                entries[record['put']['shortlink_id']] = record['put']
+            for short_id in record.get('flushed', []):
+                entries.pop(short_id, None)
+    return entries
+
+
+class ReservedIds:
+    '''Pool of generated shortlink_id checked as unused in DynamoDB'''
+
+    def __init__(self, generate_id, get_existing_ids, size):
+        self.generate_id = generate_id
+        self.get_existing_ids = get_existing_ids
+        self.size = size
+        self.ids = deque()
+
+    def pop(self, excluded):
+        '''Returns a reserved shortlink_id not in excluded, or None if none is available'''
+        while self.ids:
+            short_id = self.ids.popleft()
+            if short_id not in excluded:
+                return short_id
+        return None
+
+    def fill(self, excluded):
+        '''Fill up the pool with new ids, excluding the given ones'''
+        missing = self.size - len(self.ids)
+        if missing <= 0:
+            return
+        candidates = {self.generate_id() for _ in range(min(missing, BATCH_GET_SIZE))}
+        candidates -= set(excluded)
+        existing = self.get_existing_ids(list(candidates))
+        if existing:
+            write_behind_collisions_counter.add(len(existing))
+        self.ids.extend(candidates - existing)
+
+
+class PendingEntries:
+    '''Entries of a journal not yet flushed, the flush event is set once `flush_size` entries
+    are pending
+    '''
+
+    def __init__(self, flush_size):
+        self.flush_size = flush_size
+        self.flush_event = gevent.event.Event()
+        self.entries = OrderedDict()
+        self.urls = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, short_id):
+        return short_id in self.entries
+
+    def add(self, entry):
+        self.entries[entry['shortlink_id']] = entry
+        self.urls[entry['url']] = entry['shortlink_id']
+        if len(self.entries) >= self.flush_size:
+            self.flush_event.set()
+
+    def pop(self, short_id):
+        entry = self.entries.pop(short_id)
+        self.urls.pop(entry['url'], None)
+        return entry
+
+    def get(self, short_id):
+        return self.entries.get(short_id)
+
+    def get_by_url(self, url):
+        short_id = self.urls.get(url)
+        return None if short_id is None else self.entries.get(short_id)
+
+    def batch(self, size):
+        '''Returns the oldest `size` pending entries'''
+        return list(islice(self.entries.values(), size))
+
+    def clear(self):
+        self.entries.clear()
+        self.urls.clear()
+
+
+class WriteBehindJournal:
+    '''Local durable journal of the created entries not yet written to DynamoDB
+
+    Each worker appends the created entries to its own journal file in `directory` and a
+    background greenlet flushes them to DynamoDB with conditional writes, every `flush_interval`
+    seconds or as soon as `flush_size` entries are pending. The journal file is locked by its
+    worker, a journal file that is not locked belongs to a dead worker and its pending entries
+    are replayed by the next worker opening its journal.
+
+    New entries get a shortlink_id from a pool of ids that the flusher greenlet generated and
+    checked as unused in DynamoDB. The shortlink_id has already been answered to the client, an
+    entry whose shortlink_id has been used by another entry in the meantime is therefore not
+    written (it never overwrites the other entry) and is logged as error.
+
+    The journal file is written to disk with fsync in the gevent threadpool, in order to not
+    block the other greenlets of the worker.
+
+    The id generation and DynamoDB accesses are given as functions:
+        generate_id(): returns a new random shortlink_id
+        write_entries(entries): writes the entries one by one with a conditional write, unless
+            their id is already used by another entry, and returns the set of these used ids
+        get_existing_ids(ids): returns the set of ids already used in DynamoDB
+    '''
+
+    def __init__(
+        self,
+        directory,
+        generate_id,
+        write_entries,
+        get_existing_ids,
+        *,
+        flush_interval,
+        flush_size,
+        reserved_ids,
+        fsync=True,
+    ):
+        self.directory = Path(directory)
+        self.write_entries = write_entries
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.pid = None
+        self.path = None
+        self.fd = None
+        self.flusher = None
+        self.flush_lock = gevent.lock.Semaphore()
+        self.pending = PendingEntries(flush_size)
+        self.reserved = ReservedIds(generate_id, get_existing_ids, reserved_ids)
+        # Pending entries of the other workers journals: path -> (size, mtime, entries)
+        self.other_journals = {}
+
+    def open(self):
+        '''Open the journal of the current process
+
+        This is done lazily on first use, as the journal belongs to the forked worker. The journal
+        is created and locked under a temporary name and then renamed into place, so that the
+        other workers never see it unlocked and replay it as the journal of a dead worker.
+        '''
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        name = f'journal-{self.pid}-{uuid.uuid4().hex[:8]}.jsonl'
+        tmp_path = self.directory / f'.{name}.tmp'
+        self.path = self.directory / name
+        self.fd = open(tmp_path, 'at', encoding='utf-8')  # pylint: disable=consider-using-with
+        fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        tmp_path.rename(self.path)
+        self.pending.clear()
+        self.replay_dead_journals()
+        self.flusher = gevent.spawn(self.run)
+
+    def close(self, flush=True):
+        if self.fd is None:
+            return
+        if self.flusher is not None:
+            self.flusher.kill()
+            self.flusher = None
+        if flush:
+            self.flush()
+        self.fd.close()
+        self.fd = None
+        self.pid = None
+        if not self.pending and self.path.exists():
+            self.path.unlink()
+
+    def replay_dead_journals(self):
+        for path in self.directory.glob('journal-*.jsonl'):
+            if path == self.path:
+                continue
+            try:
+                fd = open(path, 'rt', encoding='utf-8')  # pylint: disable=consider-using-with
+            except FileNotFoundError:
+                # Replayed by another worker in the meantime
+                continue
+            with fd:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Journal of a living worker, or replayed by another worker
+                    continue
+                try:
+                    replaced = os.stat(path).st_ino != os.fstat(fd.fileno()).st_ino
+                except FileNotFoundError:
+                    replaced = True
+                if replaced:
+                    # Replayed and removed by another worker between the open and the lock
+                    continue
+                entries = read_journal(path)
+                logger.warning('Replay %d pending entries from the journal %s', len(entries), path)
+                for entry in entries.values():
+                    self.add(entry)
+                write_behind_replayed_counter.add(len(entries))
+                path.unlink()
+
+    def append(self, record):
+        self.fd.write(json.dumps(record) + '\n')
+        self.fd.flush()
+        if self.fsync:
+            # Only the current greenlet waits for the disk, not the whole worker
+            gevent.get_hub().threadpool.apply(os.fsync, (self.fd.fileno(),))
+
+    def add(self, entry):
+        '''Record the new entry in the journal, it will be flushed to DynamoDB later'''
+        self.open()
+        self.append({'put': entry})
+        self.pending.add(entry)
+
+    def get(self, short_id):
+        '''Returns the pending entry of this worker'''
+        return self.pending.get(short_id)
+
+    def get_by_url(self, url):
+        '''Returns the pending entry of this worker with the given url'''
+        return self.pending.get_by_url(url)
+
+    def find(self, short_id):
+        '''Returns the pending entry of another worker of this host'''
+        if not self.directory.exists():
+            return None
+        journals = {}
+        for path in self.directory.glob('journal-*.jsonl'):
+            if path == self.path:
+                continue
+            try:
+                stat = path.stat()
+                size, mtime, entries = self.other_journals.get(path, (None, None, None))
+                if (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+                    size, mtime, entries = stat.st_size, stat.st_mtime_ns, read_journal(path)
+            except FileNotFoundError:
+                # Journal removed in the meantime
+                continue
+            journals[path] = (size, mtime, entries)
+        self.other_journals = journals
+        for _, _, entries in journals.values():
+            if short_id in entries:
+                return entries[short_id]
+        return None
+
+    def reserve_short_id(self):
+        '''Returns a reserved shortlink_id, or None if none is available'''
+        self.open()
+        return self.reserved.pop(self.pending)
+
+    def reserve_ids(self):
+        '''Fill up the reserved ids pool'''
+        self.reserved.fill(self.pending.entries)
+
+    def drop_conflicts(self, short_ids):
+        '''Drop the pending entries whose id is used by another entry
+
+        The shortlink_id has already been answered to the client, therefore the entry is not
+        written with another id. It is logged for a manual recovery.
+        '''
+        for short_id in short_ids:
+            entry = self.pending.pop(short_id)
+            logger.error(
+                'shortlink_id %s already used by another entry, the entry is not written: %s',
+                short_id,
+                json.dumps(entry)
+            )
+        write_behind_conflicts_counter.add(len(short_ids))
+
+    def flush(self):
+        '''Write the pending entries to DynamoDB, by steps of BATCH_WRITE_SIZE conditional writes
+
+        Returns:
+            True if all pending entries have been written
+        '''
+        with self.flush_lock:
+            while self.pending:
+                batch = self.pending.batch(BATCH_WRITE_SIZE)
+                try:
+                    used = self.write_entries(batch)
+                except Exception as error:  # pylint: disable=broad-except
+                    # The entries written before the error are written again on the next flush,
+                    # their conditional write finding the same entry
+                    logger.error('Failed to flush %d journal entries: %s', len(self.pending), error)
+                    return False
+                flushed = [
+                    entry['shortlink_id'] for entry in batch if entry['shortlink_id'] not in used
+                ]
+                # The conflicting entries are never written, they are not replayed either
+                self.append({'flushed': [entry['shortlink_id'] for entry in batch]})
+                for short_id in flushed:
+                    self.pending.pop(short_id)
+                write_behind_flushed_counter.add(len(flushed))
+                if used:
+                    self.drop_conflicts(used)
+            if self.fd is not None and self.fd.tell() > 0:
+                # Only an empty journal can be truncated without risking to loose entries on a
+                # crash
+                self.fd.truncate(0)
+                self.fd.seek(0)
+        return True
+
+    def run(self):
+        while True:
+            self.pending.flush_event.wait(timeout=self.flush_interval)
+            self.pending.flush_event.clear()
+            try:
+                self.flush()
+                self.reserve_ids()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.exception('Write-behind flusher failed: %s', error)
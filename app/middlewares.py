@@ -0,0 +1,393 @@
+import logging
+import time
+from urllib.parse import parse_qsl
+
+from opentelemetry import metrics
+from werkzeug.datastructures import EnvironHeaders
+from werkzeug.exceptions import NotFound
+from werkzeug.utils import redirect
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import ClosingIterator
+
+from flask import g
+
+from app.helpers.admission import admission_controller
+from app.helpers.admission import admitted_counter
+from app.helpers.cache import LRUCache
+from app.helpers.dynamo_db import entry_cache
+from app.helpers.dynamo_db import get_db
+from app.helpers.dynamo_db import negative_cache
+from app.helpers.hit_counters import record_hit
+from app.helpers.otel import strtobool
+from app.helpers.utils import INTERNAL_ENDPOINTS
+from app.helpers.utils import get_cache_policy
+from app.helpers.utils import get_registered_method
+from app.helpers.utils import get_response_log_extra
+from app.helpers.utils import is_domain_allowed
+from app.helpers.utils import is_valid_short_id
+from app.helpers.utils import make_error_msg
+from app.helpers.utils import make_exception_error_msg
+from app.helpers.utils import set_cache_headers
+from app.settings import CORS_MAX_AGE
+from app.settings import CORS_PREFLIGHT_SHORT_CIRCUIT
+from app.settings import DYNAMODB_CONSISTENT_READ_REDIRECT
+from app.settings import ENTRY_CACHE_TTL
+from app.settings import HIT_COUNTERS
+from app.settings import LOAD_SHEDDING_RETRY_AFTER
+from app.settings import RESPONSE_CACHE_SIZE
+from app.settings import SHORT_ID_CHECK
+
+logger = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+requests_counter = meter.create_counter(
+    'shortlink.requests',
+    unit='{request}',
+    description='Number of requests received, the cors.preflight attribute gives the preflight '
+    'share of the traffic'
+)
+response_cache_counter = meter.create_counter(
+    'shortlink.response_cache.lookups',
+    unit='{request}',
+    description='Number of response cache lookups per result (hit or miss)'
+)
+
+# Serialized responses (status, headers, body) keyed by (shortlink_id, redirect, origin class),
+# shortlink entries being immutable they expire like the cached entries.
+response_cache = LRUCache(RESPONSE_CACHE_SIZE, ENTRY_CACHE_TTL)
+# Only the responses of existing shortlinks are cached, unknown ids are handled by the negative
+# cache of the DB layer.
+CACHEABLE_STATUS = frozenset(['200', '301'])
+
+
+def get_redirect_param(environ):
+    '''Returns the redirect query parameter value of the WSGI request
+
+    Returns None if the parameter is invalid.
+    '''
+    for key, value in parse_qsl(environ.get('QUERY_STRING', ''), keep_blank_values=True):
+        if key == 'redirect':
+            try:
+                return strtobool(value)
+            except ValueError:
+                return None
+    return True
+
+
+class ShortlinkMiddleware:
+    '''Base class of the WSGI middlewares answering some requests without Flask dispatch'''
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        # Computed lazily as the routes are registered after the middleware creation
+        self._static_endpoints = None
+        self._allowed_methods = {}
+
+    @property
+    def static_endpoints(self):
+        if self._static_endpoints is None:
+            self._static_endpoints = {
+                rule.rule: rule.endpoint
+                for rule in self.app.url_map.iter_rules()
+                if not rule.arguments
+            }
+        return self._static_endpoints
+
+    def get_endpoint(self, path):
+        '''Returns the endpoint matching the path or None if not known by the middleware'''
+        if path in self.static_endpoints:
+            return self.static_endpoints[path]
+        shortlink_id = path[1:]
+        if path.startswith('/') and shortlink_id and path.isascii() and '/' not in shortlink_id:
+            return 'get_shortlink'
+        return None
+
+    def get_allowed_methods(self, endpoint):
+        '''Returns the precomputed allowed methods (comma separated) of the endpoint'''
+        if endpoint not in self._allowed_methods:
+            rule = next(self.app.url_map.iter_rules(endpoint))
+            self._allowed_methods[endpoint] = ', '.join(get_registered_method(self.app, rule))
+        return self._allowed_methods[endpoint]
+
+    def get_allowed_origin(self, environ, endpoint):
+        '''Returns the Access-Control-Allow-Origin value or None if the origin is not allowed'''
+        if endpoint == 'get_shortlink' and get_redirect_param(environ):
+            # redirect endpoint are allowed from all origins
+            return '*'
+        origin = environ.get('HTTP_ORIGIN')
+        if origin and is_domain_allowed(origin):
+            return origin
+        return None
+
+    def log_response(self, environ, response, request_started):
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        self.log_access(environ, response.status, get_response_log_extra(response, request_started))
+
+    def log_access(self, environ, status, response_extra):
+        '''Log the request with the response attributes given as `response_extra`'''
+        # There is no flask request context here, therefore the request attributes normally added
+        # by the logging flask filter are given as extra.
+        logger.info(
+            "%s %s - %s",
+            environ.get('REQUEST_METHOD'),
+            environ.get('PATH_INFO'),
+            status,
+            extra={
+                'flask_request_path': environ.get('PATH_INFO'),
+                'flask_request_method': environ.get('REQUEST_METHOD'),
+                'flask_request_query_string': environ.get('QUERY_STRING', ''),
+                'flask_request_headers': dict(EnvironHeaders(environ).items()),
+                'flask_request_remote_addr': environ.get('REMOTE_ADDR'),
+                **response_extra
+            }
+        )
+
+
+class RedirectFastPathMiddleware(ShortlinkMiddleware):
+    '''WSGI middleware answering plain `GET /<shortlink_id>` redirects without Flask dispatch
+
+    A redirect request does not need the origin validation nor any of the Flask request hooks,
+    therefore it is resolved here directly through get_db() and answered with exactly the same
+    status, body and headers as the `get_shortlink` endpoint would do. Every other request
+    (info requests, invalid redirect parameter, other endpoints and methods, ...) falls through
+    to the wrapped Flask WSGI application.
+    '''
+
+    def __call__(self, environ, start_response):
+        shortlink_id = self.get_redirect_shortlink_id(environ)
+        if shortlink_id is None:
+            return self.wsgi_app(environ, start_response)
+        return self.redirect(environ, shortlink_id)(environ, start_response)
+
+    def get_redirect_shortlink_id(self, environ):
+        '''Returns the shortlink_id if the request is a plain redirect request, None otherwise'''
+        if environ.get('REQUEST_METHOD') != 'GET':
+            return None
+        path = environ.get('PATH_INFO', '')
+        if self.get_endpoint(path) != 'get_shortlink':
+            return None
+        # On invalid redirect parameter let flask return the 400 error
+        if not get_redirect_param(environ):
+            return None
+        return path[1:]
+
+    def redirect(self, environ, shortlink_id):
+        request_started = time.time()
+        logger.debug('GET %s', environ.get('PATH_INFO'))
+        with self.app.app_context():
+            g.endpoint = 'get_shortlink'
+            try:
+                db_entry = get_db().get_entry_by_shortlink(
+                    shortlink_id, consistent_read=DYNAMODB_CONSISTENT_READ_REDIRECT
+                )
+            except Exception as error:  # pylint: disable=broad-except
+                # Render the same error response as the flask error handler, without a second
+                # dispatch to flask which would call the DB again
+                response = make_exception_error_msg(error)
+                response.headers.set('Content-Type', 'application/json; charset=utf-8')
+            else:
+                if db_entry is None:
+                    error = NotFound(f'No short url found for {shortlink_id}')
+                    logger.error(error)
+                    response = make_error_msg(error.code, error.description)
+                    response.headers.set('Content-Type', 'application/json; charset=utf-8')
+                else:
+                    record_hit(shortlink_id)
+                    logger.debug("redirecting to the following url : %s", db_entry['url'])
+                    response = redirect(db_entry['url'], code=301)
+
+            response.headers['Access-Control-Allow-Origin'] = '*'
+            response.headers['Vary'] = 'Origin'
+            response.headers.set(
+                'Access-Control-Allow-Methods', self.get_allowed_methods('get_shortlink')
+            )
+            response.headers.set('Access-Control-Allow-Headers', '*')
+            set_cache_headers(
+                response,
+                get_cache_policy(response.status_code, shortlink_id, redirect=True),
+                shortlink_id
+            )
+            self.log_response(environ, response, request_started)
+        return response
+
+
+class ResponseCacheMiddleware(ShortlinkMiddleware):
+    '''WSGI middleware replaying the cached responses of `GET /<shortlink_id>`
+
+    The final response (status, headers and body) of the redirects and json information requests
+    is cached per shortlink_id, redirect flag and origin class, then replayed as is without Flask
+    dispatch nor DB access. The origin class is `*` for the redirects, which are allowed from all
+    origins, and the Origin header for the json information, which is echoed in the
+    Access-Control-Allow-Origin header. Information requests without allowed Origin header or
+    with an If-None-Match header, as well as all information requests when the hits are part of
+    the answer, fall through to the wrapped WSGI application without being cached.
+    '''
+
+    def __call__(self, environ, start_response):
+        key = self.get_cache_key(environ)
+        if key is None:
+            return self.wsgi_app(environ, start_response)
+        cached = response_cache.get(key)
+        if cached is None:
+            response_cache_counter.add(1, {'result': 'miss'})
+            return self.store(environ, start_response, key)
+        response_cache_counter.add(1, {'result': 'hit'})
+        return self.replay(environ, start_response, key[0], cached)
+
+    def get_cache_key(self, environ):
+        '''Returns the cache key of the request or None if the response is not cacheable'''
+        path = environ.get('PATH_INFO', '')
+        if environ.get('REQUEST_METHOD') != 'GET' or self.get_endpoint(path) != 'get_shortlink':
+            return None
+        redirect_param = get_redirect_param(environ)
+        if redirect_param:
+            return (path[1:], True, '*')
+        # On invalid redirect parameter let flask return the 400 error
+        if redirect_param is None or HIT_COUNTERS or 'HTTP_IF_NONE_MATCH' in environ:
+            return None
+        origin = environ.get('HTTP_ORIGIN')
+        if not origin or not is_domain_allowed(origin):
+            return None
+        return (path[1:], False, origin)
+
+    def store(self, environ, start_response, key):
+        '''Forward the request to the wrapped application and cache its response'''
+        captured = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured.update(status=status, headers=headers)
+            return start_response(status, headers, exc_info)
+
+        app_iter = self.wsgi_app(environ, capture_start_response)
+        try:
+            body = b''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        if captured['status'][:3] in CACHEABLE_STATUS:
+            response_cache.set(key, (captured['status'], list(captured['headers']), body))
+        return [body]
+
+    def replay(self, environ, start_response, shortlink_id, cached):
+        request_started = time.time()
+        status, headers, body = cached
+        record_hit(shortlink_id)
+        start_response(status, list(headers))
+        if logger.isEnabledFor(logging.INFO):
+            # Logged from the cached response as is, without parsing its body
+            self.log_access(
+                environ,
+                status,
+                {
+                    'response': {
+                        'status_code': int(status.split(' ', 1)[0]),
+                        'headers': dict(headers),
+                        'length': len(body),
+                    },
+                    'duration': time.time() - request_started
+                }
+            )
+        return [body]
+
+
+class AdmissionControlMiddleware(ShortlinkMiddleware):
+    '''WSGI middleware shedding the requests beyond the concurrency bound of the worker
+
+    The requests are admitted by the admission controller (see app.helpers.admission), the
+    shortlink creations with a lower priority than the reads. The internal endpoints (e.g.
+    /checker) and the `GET /<shortlink_id>` of the cached, negatively cached or invalid
+    shortlink ids, answered without DB access, bypass the controller. The shed requests are
+    answered with a 503 and a Retry-After header.
+    '''
+
+    def __call__(self, environ, start_response):
+        priority = self.get_priority(environ)
+        if priority == 'bypass':
+            admitted_counter.add(1, {'priority': priority})
+            return self.wsgi_app(environ, start_response)
+        if admission_controller.acquire(priority) is not None:
+            return self.shed(environ)(environ, start_response)
+        try:
+            app_iter = self.wsgi_app(environ, start_response)
+        except BaseException:
+            admission_controller.release()
+            raise
+        # The slot is held until the response has been sent
+        return ClosingIterator(app_iter, admission_controller.release)
+
+    def get_priority(self, environ):
+        '''Returns the admission priority of the request (bypass, read or create)'''
+        path = environ.get('PATH_INFO', '')
+        endpoint = self.get_endpoint(path)
+        if endpoint in INTERNAL_ENDPOINTS:
+            return 'bypass'
+        if environ.get('REQUEST_METHOD') == 'POST':
+            return 'create'
+        if endpoint == 'get_shortlink' and self.is_answered_without_db(path[1:]):
+            return 'bypass'
+        return 'read'
+
+    def is_answered_without_db(self, short_id):
+        '''Returns True if the shortlink is cached or known to not exist'''
+        if short_id in entry_cache or short_id in negative_cache:
+            return True
+        return SHORT_ID_CHECK and not is_valid_short_id(short_id)
+
+    def shed(self, environ):
+        request_started = time.time()
+        with self.app.app_context():
+            response = make_error_msg(503, "Service overloaded, please retry later")
+        response.headers['Retry-After'] = str(LOAD_SHEDDING_RETRY_AFTER)
+        response.headers['Cache-Control'] = 'no-store'
+        endpoint = self.get_endpoint(environ.get('PATH_INFO', ''))
+        allowed_origin = self.get_allowed_origin(environ, endpoint)
+        if allowed_origin is not None:
+            response.headers['Access-Control-Allow-Origin'] = allowed_origin
+            response.headers['Vary'] = 'Origin'
+        self.log_response(environ, response, request_started)
+        return response
+
+
+class CorsPreflightMiddleware(ShortlinkMiddleware):
+    '''WSGI middleware answering the CORS preflight requests before the Flask routing
+
+    The preflight requests are answered from the precomputed allowed methods, with the same
+    headers as the Flask hooks would do plus the Access-Control-Max-Age header. Preflight
+    requests that would be rejected by the origin validation, as well as the ones for the
+    internal endpoints (e.g. /checker), fall through to Flask.
+
+    This middleware also counts all requests in order to follow the preflight traffic share.
+    '''
+
+    def __call__(self, environ, start_response):
+        preflight = environ.get('REQUEST_METHOD') == 'OPTIONS' and \
+            'HTTP_ACCESS_CONTROL_REQUEST_METHOD' in environ
+        requests_counter.add(1, {'cors.preflight': preflight})
+        if preflight and CORS_PREFLIGHT_SHORT_CIRCUIT:
+            response = self.preflight(environ)
+            if response is not None:
+                return response(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+    def preflight(self, environ):
+        '''Returns the preflight response or None if the request should be handled by Flask'''
+        request_started = time.time()
+        endpoint = self.get_endpoint(environ.get('PATH_INFO', ''))
+        if endpoint is None or endpoint in INTERNAL_ENDPOINTS:
+            return None
+        allowed_origin = self.get_allowed_origin(environ, endpoint)
+        if allowed_origin is None:
+            return None
+
+        allowed_methods = self.get_allowed_methods(endpoint)
+        response = Response()
+        response.headers['Allow'] = allowed_methods
+        response.headers['Access-Control-Allow-Origin'] = allowed_origin
+        response.headers['Vary'] = 'Origin'
+        response.headers['Access-Control-Allow-Methods'] = allowed_methods
+        response.headers['Access-Control-Allow-Headers'] = '*'
+        response.headers['Access-Control-Max-Age'] = str(CORS_MAX_AGE)
+        self.log_response(environ, response, request_started)
+        return response
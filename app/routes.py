@@ -1,15 +1,36 @@
+import hmac
 import logging
 
 from flask import abort
+from flask import g
 from flask import jsonify
 from flask import make_response
 from flask import redirect
+from flask import request
 from flask import url_for
 
 from app.app import app
 from app.helpers.dynamo_db import get_db
+from app.helpers.heavy_hitters import get_heavy_hitters
+from app.helpers.hit_counters import get_pending_hits
+from app.helpers.hit_counters import record_hit
+from app.helpers.idempotency import begin_idempotent_request
+from app.helpers.idempotency import complete_idempotent_request
+from app.helpers.idempotency import get_idempotency_key
+from app.helpers.idempotency import release_idempotent_request
+from app.helpers.rate_limiter import check_create_rate_limit
 from app.helpers.utils import get_redirect_param
+from app.helpers.utils import get_shortlink_etag
 from app.helpers.utils import get_url
+from app.helpers.utils import is_shortlink_etag
+from app.settings import DYNAMODB_CONSISTENT_READ_CREATE
+from app.settings import DYNAMODB_CONSISTENT_READ_INFO
+from app.settings import DYNAMODB_CONSISTENT_READ_REDIRECT
+from app.settings import HEAVY_HITTERS_CAPACITY
+from app.settings import HEAVY_HITTERS_HEADER
+from app.settings import HEAVY_HITTERS_TOKEN
+from app.settings import HEAVY_HITTERS_TOP
+from app.settings import HIT_COUNTERS
 from app.version import APP_VERSION
 
 logger = logging.getLogger(__name__)
@@ -25,27 +46,79 @@ def checker():
     return response
 
 
+@app.route('/heavy-hitters', methods=['GET'])
+def heavy_hitters():
+    """Internal endpoint returning the most requested shortlinks of all workers
+
+    The count of each shortlink is an upper bound of its real number of hits, its real number
+    of hits being at least `count - error`. The request must carry the HEAVY_HITTERS_HEADER
+    with the HEAVY_HITTERS_TOKEN value, and at most HEAVY_HITTERS_CAPACITY shortlinks are returned.
+    """
+    if not HEAVY_HITTERS_TOKEN or not hmac.compare_digest(
+        request.headers.get(HEAVY_HITTERS_HEADER, ''), HEAVY_HITTERS_TOKEN
+    ):
+        abort(403, 'Missing or invalid heavy hitters token')
+    try:
+        top = int(request.args.get('top', HEAVY_HITTERS_TOP))
+    except ValueError as error:
+        abort(400, f'Invalid "top" arg: {error}')
+    if top < 1:
+        abort(400, f'Invalid "top" arg: {top} is not a positive number')
+    top = min(top, HEAVY_HITTERS_CAPACITY)
+    result = get_heavy_hitters(top)
+    if result is None:
+        abort(404, 'Heavy hitters sketch not enabled')
+    workers, total, items = result
+    return make_response(
+        jsonify({
+            'success': True, 'workers': workers, 'total': total, 'heavy_hitters': items
+        })
+    )
+
+
 @app.route('/', methods=['POST'])
 def create_shortlink():
     """Create a new shortlink if needed otherwiser return existing
     """
-    new_entry = False
+    check_create_rate_limit()
+    idempotency_key = get_idempotency_key()
+    if idempotency_key is not None:
+        original = begin_idempotent_request(idempotency_key)
+        if original is not None:
+            status, shortlink_id = original
+            response = make_create_response(status, shortlink_id)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        try:
+            status, shortlink_id = shorten_url()
+        except BaseException:
+            release_idempotent_request(idempotency_key)
+            raise
+        complete_idempotent_request(idempotency_key, status, shortlink_id)
+    else:
+        status, shortlink_id = shorten_url()
+    return make_create_response(status, shortlink_id)
+
+
+def shorten_url():
+    '''Returns the status code and the shortlink_id of the url given in the request'''
     url = get_url()
     db = get_db()
-    db_entry = db.get_entry_by_url(url)
+    db_entry = db.get_entry_by_url(url, consistent_read=DYNAMODB_CONSISTENT_READ_CREATE)
     if db_entry is None:
         db_entry = db.add_url_to_table(url)
-        new_entry = True
+        return 201, db_entry['shortlink_id']
+    return 200, db_entry['shortlink_id']
 
-    response = make_response(
+
+def make_create_response(status, shortlink_id):
+    return make_response(
         jsonify({
-            "shorturl":
-                url_for("get_shortlink", shortlink_id=db_entry['shortlink_id'], _external=True),
+            "shorturl": url_for("get_shortlink", shortlink_id=shortlink_id, _external=True),
             'success': True
         }),
-        201 if new_entry else 200
+        status
     )
-    return response
 
 
 @app.route('/<shortlink_id>', methods=['GET'])
@@ -54,21 +127,40 @@ def get_shortlink(shortlink_id):
     This route checks the shortened url id and redirect the user to the full url.
     When the redirect query parameter is set to false, it will return a json containing
     the information about the shortlink.
+    The json information support conditional requests with the If-None-Match header.
     """
+    redirect_param = get_redirect_param()
 
-    db_entry = get_db().get_entry_by_shortlink(shortlink_id)
+    if not redirect_param and not HIT_COUNTERS:
+        # Shortlink entries are immutable, an ETag signed for this shortlink_id (therefore issued
+        # for an existing entry) is still valid and we can answer without DB lookup. This is not
+        # the case when the hits are part of the answer.
+        for etag in request.if_none_match.as_set(include_weak=True):
+            if is_shortlink_etag(shortlink_id, etag):
+                record_hit(shortlink_id)
+                g.etag = etag
+                return make_response('', 304)
+
+    db_entry = get_db().get_entry_by_shortlink(
+        shortlink_id,
+        consistent_read=DYNAMODB_CONSISTENT_READ_REDIRECT
+        if redirect_param else DYNAMODB_CONSISTENT_READ_INFO,
+        # The cached entry has outdated hits
+        cached=redirect_param or not HIT_COUNTERS
+    )
     if db_entry is None:
         abort(404, f'No short url found for {shortlink_id}')
+    record_hit(shortlink_id)
 
-    if get_redirect_param():
+    if redirect_param:
         logger.debug("redirecting to the following url : %s", db_entry['url'])
         return redirect(db_entry['url'], code=301)
 
-    return make_response(
-        jsonify({
-            'shorturl': shortlink_id,
-            'url': db_entry['url'],
-            'created': db_entry['created'],
-            'success': True
-        })
-    )
+    info = {'shorturl': shortlink_id, 'url': db_entry['url'], 'created': db_entry['created']}
+    if HIT_COUNTERS:
+        info['hits'] = int(db_entry.get('hits', 0)) + get_pending_hits(shortlink_id)
+    g.etag = get_shortlink_etag(shortlink_id, db_entry['created'], info.get('hits'))
+    if request.if_none_match.contains_weak(g.etag):
+        return make_response('', 304)
+
+    return make_response(jsonify({**info, 'success': True}))
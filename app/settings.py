@@ -1,10 +1,12 @@
-import os
-
 """
 The Config contains everything needed to run the service. Most entries have a default
 value and an environment value to override it.
 
 """
+import os
+
+from app.helpers.otel import strtobool
+
 ENV_FILE = os.getenv('ENV_FILE', None)
 if ENV_FILE:
     from dotenv import load_dotenv
@@ -17,19 +19,234 @@ ALLOWED_DOMAINS_STRING = os.getenv('ALLOWED_DOMAINS', '.*')
 ALLOWED_DOMAINS = ALLOWED_DOMAINS_STRING.split(',')
 ALLOWED_DOMAINS_PATTERN = f"({'|'.join(ALLOWED_DOMAINS)})"
 AWS_DYNAMODB_TABLE_NAME = os.environ.get('AWS_DYNAMODB_TABLE_NAME')
+# Table of the archived entries (cold tier), see TIERING
+AWS_DYNAMODB_COLD_TABLE_NAME = os.environ.get(
+    'AWS_DYNAMODB_COLD_TABLE_NAME',
+    f'{AWS_DYNAMODB_TABLE_NAME}-cold' if AWS_DYNAMODB_TABLE_NAME else None
+)
 AWS_DEFAULT_REGION = os.environ.get('AWS_DEFAULT_REGION', 'eu-central-1')
 AWS_ENDPOINT_URL = os.environ.get('AWS_ENDPOINT_URL', None)
 
 CACHE_CONTROL = os.getenv('CACHE_CONTROL', 'public, max-age=31536000')
 CACHE_CONTROL_4XX = os.getenv('CACHE_CONTROL_4XX', 'public, max-age=3600')
+# Per response caching policies of the `GET /<shortlink>` endpoint. The shortlinks are immutable,
+# the redirects and json information can be cached long, while the 404 (negative) answers must
+# expire quickly as the shortlink may be created moments later.
+CACHE_CONTROL_REDIRECT = os.getenv('CACHE_CONTROL_REDIRECT', CACHE_CONTROL)
+CACHE_CONTROL_INFO = os.getenv('CACHE_CONTROL_INFO', CACHE_CONTROL)
+CACHE_CONTROL_NOT_FOUND = os.getenv('CACHE_CONTROL_NOT_FOUND', 'public, max-age=60')
+# stale-while-revalidate and stale-if-error directives (in seconds, 0 to disable) added to the
+# redirect and json information policies, to let the CDN serve stale copies while revalidating
+# and during a backend (e.g. DynamoDB) outage
+CACHE_STALE_WHILE_REVALIDATE = int(os.getenv('CACHE_STALE_WHILE_REVALIDATE', '3600'))
+CACHE_STALE_IF_ERROR = int(os.getenv('CACHE_STALE_IF_ERROR', '604800'))
+# Surrogate-Control headers (CDN only caching policies) of the redirect, json information and 404
+# responses, not sent when empty. The responses also carry a Surrogate-Key header with the
+# shortlink id for targeted CDN purges.
+SURROGATE_CONTROL_REDIRECT = os.getenv('SURROGATE_CONTROL_REDIRECT', '')
+SURROGATE_CONTROL_INFO = os.getenv('SURROGATE_CONTROL_INFO', '')
+SURROGATE_CONTROL_NOT_FOUND = os.getenv('SURROGATE_CONTROL_NOT_FOUND', '')
+# Secret key of the signed ETag of the json information (HMAC of the shortlink id), which allows
+# to answer the conditional requests without DB lookup. When empty, the ETags are always
+# validated against the DB entry. It must be the same for all instances behind the CDN.
+ETAG_SECRET = os.getenv('ETAG_SECRET', '')
+
+# Answer the CORS preflight requests before the flask routing
+CORS_PREFLIGHT_SHORT_CIRCUIT = strtobool(os.getenv('CORS_PREFLIGHT_SHORT_CIRCUIT', 'true'))
+# Access-Control-Max-Age of the preflight responses (note that chromium caps it to 2 hours)
+CORS_MAX_AGE = int(os.getenv('CORS_MAX_AGE', '7200'))
+
+# Serve the plain redirect requests directly from a WSGI middleware without flask dispatch
+REDIRECT_FAST_PATH = strtobool(os.getenv('REDIRECT_FAST_PATH', 'true'))
 
 STAGING = os.environ['STAGING']
 
 COLLISION_MAX_RETRY = 10
 
+# DynamoDB client resilience: botocore retry mode (legacy, standard or adaptive), max attempts
+# (including the first one), timeouts in seconds and maximum number of pooled connections per
+# resource, which must cover the concurrent requests of a gevent worker.
+DYNAMODB_RETRY_MODE = os.getenv('DYNAMODB_RETRY_MODE', 'adaptive')
+DYNAMODB_MAX_ATTEMPTS = int(os.getenv('DYNAMODB_MAX_ATTEMPTS', '3'))
+DYNAMODB_CONNECT_TIMEOUT = float(os.getenv('DYNAMODB_CONNECT_TIMEOUT', '1'))
+DYNAMODB_READ_TIMEOUT = float(os.getenv('DYNAMODB_READ_TIMEOUT', '1'))
+DYNAMODB_WRITE_TIMEOUT = float(os.getenv('DYNAMODB_WRITE_TIMEOUT', '3'))
+DYNAMODB_MAX_POOL_CONNECTIONS = int(os.getenv('DYNAMODB_MAX_POOL_CONNECTIONS', '50'))
+
+# Strongly consistent reads per call site: redirect and info requests (GetItem) and the existing
+# shortlink lookup on shortlink creation. The latter is only applied if the UrlIndex is a local
+# secondary index, which is not the case of the deployed tables (see docker-compose.yml) where it
+# is a global secondary index read with eventual consistency.
+DYNAMODB_CONSISTENT_READ_REDIRECT = strtobool(
+    os.getenv('DYNAMODB_CONSISTENT_READ_REDIRECT', 'false')
+)
+DYNAMODB_CONSISTENT_READ_INFO = strtobool(os.getenv('DYNAMODB_CONSISTENT_READ_INFO', 'false'))
+DYNAMODB_CONSISTENT_READ_CREATE = strtobool(os.getenv('DYNAMODB_CONSISTENT_READ_CREATE', 'false'))
+# Consumed capacity returned by DynamoDB (TOTAL, INDEXES or NONE) and aggregated per endpoint
+DYNAMODB_RETURN_CONSUMED_CAPACITY = os.getenv('DYNAMODB_RETURN_CONSUMED_CAPACITY', 'TOTAL')
+
+# Hedged GetItem reads: a second read is fired when the first one did not answer within the
+# given percentile of the recent latencies, limited to a ratio of all reads.
+HEDGED_READS = strtobool(os.getenv('HEDGED_READS', 'false'))
+HEDGED_READS_PERCENTILE = float(os.getenv('HEDGED_READS_PERCENTILE', '95'))
+HEDGED_READS_BUDGET = float(os.getenv('HEDGED_READS_BUDGET', '0.05'))
+
+# Write-behind creation mode: new entries are recorded in a local journal and written to
+# DynamoDB by a background greenlet, with a conditional PutItem per entry.
+WRITE_BEHIND = strtobool(os.getenv('WRITE_BEHIND', 'false'))
+WRITE_BEHIND_JOURNAL_DIR = os.getenv('WRITE_BEHIND_JOURNAL_DIR', '/tmp/shortlink-journal')
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', '1'))
+WRITE_BEHIND_FLUSH_SIZE = int(os.getenv('WRITE_BEHIND_FLUSH_SIZE', '25'))
+WRITE_BEHIND_RESERVED_IDS = int(os.getenv('WRITE_BEHIND_RESERVED_IDS', '100'))
+WRITE_BEHIND_FSYNC = strtobool(os.getenv('WRITE_BEHIND_FSYNC', 'true'))
+
+# Existing shortlink lookup by URL digest (`url_digest` attribute, always written): the
+# UrlDigestIndex global secondary index is queried instead of the UrlIndex, whose keys are as large
+# as the URLs. Until the digest of the older entries has been backfilled (see
+# scripts/backfill_url_digests.py), URLs not found by digest are looked up in the UrlIndex.
+URL_DIGEST_INDEX = strtobool(os.getenv('URL_DIGEST_INDEX', 'false'))
+URL_DIGEST_BACKFILLED = strtobool(os.getenv('URL_DIGEST_BACKFILLED', 'false'))
+
+# Bloom filter of the table URLs, used to skip the UrlIndex query for new URLs. The filter is
+# sized for the configured false positive rate, limited to the max memory in bytes. It is built by
+# one worker per host and shared with the other workers through BLOOM_FILTER_DIR.
+BLOOM_FILTER = strtobool(os.getenv('BLOOM_FILTER', 'false'))
+BLOOM_FILTER_FALSE_POSITIVE_RATE = float(os.getenv('BLOOM_FILTER_FALSE_POSITIVE_RATE', '0.01'))
+BLOOM_FILTER_MAX_MEMORY = int(os.getenv('BLOOM_FILTER_MAX_MEMORY', str(64 * 1024 * 1024)))
+BLOOM_FILTER_REBUILD_INTERVAL = int(os.getenv('BLOOM_FILTER_REBUILD_INTERVAL', '3600'))
+BLOOM_FILTER_DIR = os.getenv('BLOOM_FILTER_DIR', '/tmp/shortlink-url-filter')
+
+# DynamoDB circuit breaker
+CIRCUIT_BREAKER_ENABLED = strtobool(os.getenv('CIRCUIT_BREAKER_ENABLED', 'true'))
+CIRCUIT_BREAKER_FAILURE_RATE = float(os.getenv('CIRCUIT_BREAKER_FAILURE_RATE', '0.5'))
+CIRCUIT_BREAKER_MIN_CALLS = int(os.getenv('CIRCUIT_BREAKER_MIN_CALLS', '20'))
+CIRCUIT_BREAKER_WINDOW = int(os.getenv('CIRCUIT_BREAKER_WINDOW', '30'))
+CIRCUIT_BREAKER_OPEN_DURATION = float(os.getenv('CIRCUIT_BREAKER_OPEN_DURATION', '10'))
+
+# Per worker cache of the shortlink entries, a size of 0 disable the cache
+ENTRY_CACHE_SIZE = int(os.getenv('ENTRY_CACHE_SIZE', '10000'))
+ENTRY_CACHE_TTL = int(os.getenv('ENTRY_CACHE_TTL', '3600'))
+
+# Per worker cache of the serialized GET /<shortlink_id> responses (redirects and json
+# information), replayed without Flask dispatch. The cached responses expire like the entries.
+RESPONSE_CACHE = strtobool(os.getenv('RESPONSE_CACHE', 'false'))
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '10000'))
+
+# Read only snapshot index of the shortlink entries (see scripts/build_snapshot.py), an empty path
+# disables it. In `first` mode the snapshot is consulted before DynamoDB, the entries created
+# after the snapshot falling through to DynamoDB, in `fallback` mode only when DynamoDB is not
+# available.
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', '')
+SNAPSHOT_MODE = os.getenv('SNAPSHOT_MODE', 'fallback')
+SNAPSHOT_RELOAD_INTERVAL = int(os.getenv('SNAPSHOT_RELOAD_INTERVAL', '60'))
+
+# Hot/cold tiering: the entries carry a coarse last access timestamp, updated by each worker at
+# most every TIERING_ACCESS_GRANULARITY seconds per shortlink and written in batches every
+# TIERING_FLUSH_INTERVAL seconds, and an expiration time (`expires` attribute, epoch seconds)
+# TIERING_TTL seconds after it. The entries about to expire are archived in the cold table and
+# deleted from the table by scripts/archive_entries.py (no DynamoDB TTL on the table), they are
+# served from the cold table and promoted back on access. The ids missing from the table and the
+# new ids of the synchronous creations cost an extra GetItem on the cold table.
+TIERING = strtobool(os.getenv('TIERING', 'false'))
+TIERING_TTL = int(os.getenv('TIERING_TTL', str(2 * 365 * 86400)))
+TIERING_ACCESS_GRANULARITY = int(os.getenv('TIERING_ACCESS_GRANULARITY', '86400'))
+TIERING_FLUSH_INTERVAL = float(os.getenv('TIERING_FLUSH_INTERVAL', '60'))
+TIERING_MAX_KEYS = int(os.getenv('TIERING_MAX_KEYS', '10000'))
+
+# Per worker sketch of the most requested shortlinks, persisted in HEAVY_HITTERS_DIR from where
+# the sketches of all workers are merged. The /heavy-hitters endpoint requires the
+# HEAVY_HITTERS_HEADER with the HEAVY_HITTERS_TOKEN value.
+HEAVY_HITTERS = strtobool(os.getenv('HEAVY_HITTERS', 'false'))
+HEAVY_HITTERS_CAPACITY = int(os.getenv('HEAVY_HITTERS_CAPACITY', '1000'))
+HEAVY_HITTERS_DIR = os.getenv('HEAVY_HITTERS_DIR', '/tmp/shortlink-heavy-hitters')
+HEAVY_HITTERS_PERSIST_INTERVAL = int(os.getenv('HEAVY_HITTERS_PERSIST_INTERVAL', '60'))
+HEAVY_HITTERS_MAX_AGE = int(os.getenv('HEAVY_HITTERS_MAX_AGE', '86400'))
+HEAVY_HITTERS_TOP = int(os.getenv('HEAVY_HITTERS_TOP', '100'))
+HEAVY_HITTERS_HEADER = os.getenv('HEAVY_HITTERS_HEADER', 'X-Shortlink-Token')
+HEAVY_HITTERS_TOKEN = os.getenv('HEAVY_HITTERS_TOKEN', '')
+
+# Per worker shortlink hit counters, written to DynamoDB every HIT_COUNTERS_FLUSH_INTERVAL
+# seconds or as soon as HIT_COUNTERS_MAX_KEYS shortlinks have been hit.
+HIT_COUNTERS = strtobool(os.getenv('HIT_COUNTERS', 'false'))
+HIT_COUNTERS_FLUSH_INTERVAL = float(os.getenv('HIT_COUNTERS_FLUSH_INTERVAL', '10'))
+HIT_COUNTERS_MAX_KEYS = int(os.getenv('HIT_COUNTERS_MAX_KEYS', '1000'))
+
+# Sampling profiler of the requests, the collapsed stacks are written per endpoint and worker in
+# PROFILER_DIR (by default the `profiles` directory of LOGS_DIR, resolved when the profiler
+# starts). Requests are profiled at random with PROFILER_SAMPLE_RATE or when they carry the
+# PROFILER_HEADER with the PROFILER_TOKEN value.
+PROFILER = strtobool(os.getenv('PROFILER', 'false'))
+PROFILER_DIR = os.getenv('PROFILER_DIR', '')
+PROFILER_SAMPLE_RATE = float(os.getenv('PROFILER_SAMPLE_RATE', '0.001'))
+PROFILER_HEADER = os.getenv('PROFILER_HEADER', 'X-Shortlink-Profile')
+PROFILER_TOKEN = os.getenv('PROFILER_TOKEN', '')
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL', '0.005'))
+PROFILER_MAX_OVERHEAD = float(os.getenv('PROFILER_MAX_OVERHEAD', '0.01'))
+PROFILER_FLUSH_INTERVAL = int(os.getenv('PROFILER_FLUSH_INTERVAL', '60'))
+PROFILER_MAX_DISK = int(os.getenv('PROFILER_MAX_DISK', str(100 * 1024 * 1024)))
+PROFILER_MAX_STACKS = int(os.getenv('PROFILER_MAX_STACKS', '10000'))
+
+# Gevent hub monitor: loop lag probed every LOOP_MONITOR_INTERVAL seconds and greenlets blocking
+# the hub longer than LOOP_MONITOR_BLOCKING_THRESHOLD seconds logged with their stack
+LOOP_MONITOR = strtobool(os.getenv('LOOP_MONITOR', 'false'))
+LOOP_MONITOR_INTERVAL = float(os.getenv('LOOP_MONITOR_INTERVAL', '0.1'))
+LOOP_MONITOR_BLOCKING_THRESHOLD = float(os.getenv('LOOP_MONITOR_BLOCKING_THRESHOLD', '0.1'))
+
+# Per worker load shedding: at most LOAD_SHEDDING_MAX_INFLIGHT requests in flight, the shortlink
+# creations only while fewer than LOAD_SHEDDING_MAX_INFLIGHT_CREATE are in flight. The requests
+# beyond wait at most LOAD_SHEDDING_QUEUE_TIMEOUT seconds for a slot and are otherwise answered
+# by a 503 with a Retry-After of LOAD_SHEDDING_RETRY_AFTER seconds. The internal endpoints (e.g.
+# /checker) and the GET /<shortlink_id> of cached shortlinks are never shed.
+LOAD_SHEDDING = strtobool(os.getenv('LOAD_SHEDDING', 'false'))
+LOAD_SHEDDING_MAX_INFLIGHT = int(os.getenv('LOAD_SHEDDING_MAX_INFLIGHT', '200'))
+LOAD_SHEDDING_MAX_INFLIGHT_CREATE = int(os.getenv('LOAD_SHEDDING_MAX_INFLIGHT_CREATE', '150'))
+LOAD_SHEDDING_QUEUE_TIMEOUT = float(os.getenv('LOAD_SHEDDING_QUEUE_TIMEOUT', '0.5'))
+LOAD_SHEDDING_MAX_QUEUE = int(os.getenv('LOAD_SHEDDING_MAX_QUEUE', '200'))
+LOAD_SHEDDING_RETRY_AFTER = int(os.getenv('LOAD_SHEDDING_RETRY_AFTER', '1'))
+
 SHORT_ID_SIZE = int(os.getenv('SHORT_ID_SIZE', '12'))
 SHORT_ID_ALPHABET = os.getenv('SHORT_ID_ALPHABET', '0123456789abcdefghijklmnopqrstuvwxyz')
+# Syntactic check of the requested shortlink ids, ids that are neither a SHORT_ID_SIZE long id of
+# SHORT_ID_ALPHABET characters nor match the legacy pattern (timestamp based ids) are unknown.
+# Only enable it when all the ids of the table match, otherwise the other existing shortlinks
+# (e.g. created with other id settings) are answered with a 404.
+SHORT_ID_CHECK = strtobool(os.getenv('SHORT_ID_CHECK', 'false'))
+SHORT_ID_LEGACY_PATTERN = os.getenv('SHORT_ID_LEGACY_PATTERN', r'[0-9a-f]{10,11}')
+
+# Per worker cache of the unknown shortlink ids
+NEGATIVE_CACHE_SIZE = int(os.getenv('NEGATIVE_CACHE_SIZE', '10000'))
+NEGATIVE_CACHE_TTL = int(os.getenv('NEGATIVE_CACHE_TTL', '60'))
+
+# Per worker cache of the URL validation verdicts of the recently shortened URLs
+URL_VALIDATION_CACHE_SIZE = int(os.getenv('URL_VALIDATION_CACHE_SIZE', '1000'))
 
 GUNICORN_WORKER_TMP_DIR = os.getenv("GUNICORN_WORKER_TMP_DIR", None)
 
 GUNICORN_KEEPALIVE = int(os.getenv('GUNICORN_KEEPALIVE', '2'))
+
+# Trusted proxies, see gunicorn forwarded_allow_ips setting
+FORWARDED_ALLOW_IPS = [ip.strip() for ip in os.getenv('FORWARED_ALLOW_IPS', '*').split(',')]
+# Number of proxies in front of the service appending the X-Forwarded-For header, the client IP
+# being the address appended by the last of them when all proxies are trusted (`*`). The other
+# addresses of the header are set by the client and cannot be trusted.
+FORWARDED_TRUSTED_HOPS = int(os.getenv('FORWARDED_TRUSTED_HOPS', '1'))
+
+# Idempotency-Key support of the shortlink creations: the responses of the last
+# IDEMPOTENCY_MAX_KEYS keys are replayed during IDEMPOTENCY_TTL seconds, the concurrent requests
+# with the same key waiting at most IDEMPOTENCY_WAIT_TIMEOUT seconds for the first one.
+IDEMPOTENCY = strtobool(os.getenv('IDEMPOTENCY', 'false'))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv('IDEMPOTENCY_MAX_KEYS', '10000'))
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', '3600'))
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.getenv('IDEMPOTENCY_WAIT_TIMEOUT', '10'))
+# Share the Idempotency-Key store between the gunicorn workers
+IDEMPOTENCY_SHARED = strtobool(os.getenv('IDEMPOTENCY_SHARED', 'false'))
+
+# Shortlink creation rate limiter
+RATE_LIMIT_CREATE = strtobool(os.getenv('RATE_LIMIT_CREATE', 'false'))
+RATE_LIMIT_CREATE_RATE = float(os.getenv('RATE_LIMIT_CREATE_RATE', '1'))
+RATE_LIMIT_CREATE_BURST = float(os.getenv('RATE_LIMIT_CREATE_BURST', '20'))
+# Client key of the rate limiter, either `ip` or `origin`
+RATE_LIMIT_KEY = os.getenv('RATE_LIMIT_KEY', 'ip')
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv('RATE_LIMIT_MAX_CLIENTS', '10000'))
+# Share the rate limiter state between the gunicorn workers
+RATE_LIMIT_SHARED = strtobool(os.getenv('RATE_LIMIT_SHARED', 'false'))
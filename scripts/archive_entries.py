@@ -0,0 +1,149 @@
+"""
+Archive the shortlink entries about to expire in the cold table (hot/cold tiering)
+
+The entries whose `expires` attribute (see TIERING_TTL) ends within the horizon are copied,
+compressed, into the cold table (AWS_DYNAMODB_COLD_TABLE_NAME) and, with --delete, deleted from
+the table once archived unless they have been accessed meanwhile. The entries written before the
+tiering mode have no `expires` attribute, it is set from their creation time once they are
+archived.
+
+The DynamoDB TTL must not be enabled on the `expires` attribute of the table: it would delete the
+entries that the job did not archive (e.g. job not run, failed or late), --delete is the only
+deletion mechanism. Large tables can be archived in parallel with one process per segment.
+
+    python -m scripts.archive_entries --horizon 604800 --delete --segment 0 --total-segments 4
+"""
+import argparse
+import logging
+import sys
+import time
+from datetime import datetime
+
+from boto3.dynamodb.conditions import Attr
+
+from app.helpers.dynamo_db import archive_entries
+from app.helpers.dynamo_db import get_table
+from app.settings import TIERING_TTL
+
+logger = logging.getLogger(__name__)
+
+
+def get_expires(entry):
+    '''Returns the expiration time of the entry, or None if it cannot be determined'''
+    if 'expires' in entry:
+        return int(entry['expires'])
+    try:
+        return int(datetime.fromisoformat(entry['created']).timestamp()) + TIERING_TTL
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def scan_entries(segment, total_segments):
+    '''Yields the pages of entries of the table segment'''
+    kwargs = {}
+    while True:
+        response = get_table('read').scan(Segment=segment, TotalSegments=total_segments, **kwargs)
+        yield response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def set_expires(entry, expires):
+    get_table('write').update_item(
+        Key={'shortlink_id': entry['shortlink_id']},
+        UpdateExpression='SET #expires = if_not_exists(#expires, :expires)',
+        ExpressionAttributeNames={'#expires': 'expires'},
+        ExpressionAttributeValues={':expires': expires}
+    )
+
+
+def delete_entry(entry, expires):
+    '''Delete the archived entry unless it has been accessed meanwhile'''
+    table = get_table('write')
+    try:
+        table.delete_item(
+            Key={'shortlink_id': entry['shortlink_id']},
+            ConditionExpression=Attr('expires').eq(expires)
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    return True
+
+
+def archive(horizon, delete=False, dry_run=False, segment=0, total_segments=1):
+    '''Archive the entries of the table segment expiring within the horizon
+
+    Returns:
+        The number of scanned, archived and deleted entries
+    '''
+    limit = int(time.time()) + horizon
+    stats = {'scanned': 0, 'archived': 0, 'deleted': 0}
+    for entries in scan_entries(segment, total_segments):
+        stats['scanned'] += len(entries)
+        expiring = []
+        for entry in entries:
+            expires = get_expires(entry)
+            if expires is None:
+                logger.warning('Entry %s without creation time, skipped', entry['shortlink_id'])
+                continue
+            if expires <= limit:
+                expiring.append((entry, expires))
+        if dry_run or not expiring:
+            stats['archived'] += len(expiring)
+            continue
+        archive_entries([{**entry, 'expires': expires} for entry, expires in expiring])
+        stats['archived'] += len(expiring)
+        # The legacy entries get their expiration time only once archived, the conditional
+        # delete relying on it
+        for entry, expires in expiring:
+            if 'expires' not in entry:
+                set_expires(entry, expires)
+        if delete:
+            stats['deleted'] += sum(delete_entry(entry, expires) for entry, expires in expiring)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        '--horizon',
+        type=int,
+        default=7 * 86400,
+        help='Archive the entries expiring within this number of seconds (default one week)'
+    )
+    parser.add_argument(
+        '--delete',
+        action='store_true',
+        help='Delete the archived entries from the table, unless accessed meanwhile'
+    )
+    parser.add_argument(
+        '--dry-run', action='store_true', help='Only count the entries that would be archived'
+    )
+    parser.add_argument('--segment', type=int, default=0, help='Table scan segment')
+    parser.add_argument(
+        '--total-segments', type=int, default=1, help='Number of table scan segments'
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    stats = archive(
+        args.horizon,
+        delete=args.delete,
+        dry_run=args.dry_run,
+        segment=args.segment,
+        total_segments=args.total_segments
+    )
+    logger.info(
+        'Segment %d/%d: %d entries scanned, %d archived, %d deleted',
+        args.segment,
+        args.total_segments,
+        stats['scanned'],
+        stats['archived'],
+        stats['deleted']
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+Backfill the URL digest of the shortlink entries created before the UrlDigestIndex
+
+The table is scanned in parallel segments, the entries without `url_digest` attribute get the
+digest of their URL. The progress of each segment is saved in the checkpoint file after each
+page, an interrupted backfill is resumed by running it again with the same checkpoint file. Once
+the backfill is complete, URL_DIGEST_BACKFILLED can be enabled.
+
+    python -m scripts.backfill_url_digests --checkpoint backfill.json --total-segments 8
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.helpers.dynamo_db import get_table
+from app.helpers.utils import get_url_digest
+from app.settings import AWS_DYNAMODB_TABLE_NAME
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpoint:
+    '''Progress of the backfill segments, saved in a JSON file
+
+    The state of a segment is the last evaluated key of its scan, whether it is done and the
+    number of entries updated.
+    '''
+
+    def __init__(self, path, total_segments):
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as fd:
+                state = json.load(fd)
+            if state['total_segments'] != total_segments:
+                raise ValueError(
+                    f'Checkpoint {path} has {state["total_segments"]} segments, resume it with '
+                    'the same number of segments'
+                )
+            self.segments = state['segments']
+        else:
+            self.segments = {
+                str(segment): {
+                    'last_key': None, 'done': False, 'updated': 0
+                } for segment in range(total_segments)
+            }
+        self.total_segments = total_segments
+
+    def get(self, segment):
+        return self.segments[str(segment)]
+
+    def update(self, segment, last_key, updated):
+        with self.lock:
+            state = self.segments[str(segment)]
+            state['last_key'] = last_key
+            state['done'] = last_key is None
+            state['updated'] += updated
+            self.save()
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fd:
+            json.dump({'total_segments': self.total_segments, 'segments': self.segments}, fd)
+        os.replace(tmp_path, self.path)
+
+    def is_done(self):
+        return all(state['done'] for state in self.segments.values())
+
+    def updated(self):
+        return sum(state['updated'] for state in self.segments.values())
+
+
+def set_url_digest(client, item):
+    '''Set the digest of the entry URL, unless the entry has been deleted meanwhile'''
+    try:
+        client.update_item(
+            TableName=AWS_DYNAMODB_TABLE_NAME,
+            Key={'shortlink_id': item['shortlink_id']},
+            UpdateExpression='SET #url_digest = :url_digest',
+            ConditionExpression='#url = :url',
+            ExpressionAttributeNames={
+                '#url_digest': 'url_digest', '#url': 'url'
+            },
+            ExpressionAttributeValues={
+                ':url_digest': get_url_digest(item['url']), ':url': item['url']
+            }
+        )
+    except client.exceptions.ConditionalCheckFailedException:
+        return False
+    return True
+
+
+def backfill_segment(client, checkpoint, segment, page_size):
+    state = checkpoint.get(segment)
+    while not state['done']:
+        kwargs = {'ExclusiveStartKey': state['last_key']} if state['last_key'] else {}
+        response = client.scan(
+            TableName=AWS_DYNAMODB_TABLE_NAME,
+            Segment=segment,
+            TotalSegments=checkpoint.total_segments,
+            Limit=page_size,
+            ProjectionExpression='#shortlink_id, #url',
+            FilterExpression='attribute_not_exists(#url_digest) AND attribute_exists(#url)',
+            ExpressionAttributeNames={
+                '#shortlink_id': 'shortlink_id', '#url': 'url', '#url_digest': 'url_digest'
+            },
+            **kwargs
+        )
+        updated = sum(set_url_digest(client, item) for item in response.get('Items', []))
+        checkpoint.update(segment, response.get('LastEvaluatedKey'), updated)
+    logger.info('Segment %d done, %d entries updated', segment, state['updated'])
+
+
+def backfill(checkpoint_path, total_segments=4, workers=None, page_size=1000):
+    '''Backfill the URL digests, resuming from the checkpoint file if it exists
+
+    Returns:
+        The checkpoint of the backfill
+    '''
+    checkpoint = Checkpoint(checkpoint_path, total_segments)
+    # The client of the resource (with its attribute value conversion) is thread safe, unlike the
+    # table resource
+    client = get_table('write').meta.client
+    with ThreadPoolExecutor(max_workers=workers or total_segments) as executor:
+        futures = [
+            executor.submit(backfill_segment, client, checkpoint, segment, page_size)
+            for segment in range(total_segments)
+        ]
+        for future in futures:
+            future.result()
+    return checkpoint
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        '--checkpoint', required=True, help='Checkpoint file of the backfill progress'
+    )
+    parser.add_argument(
+        '--total-segments', type=int, default=4, help='Number of table scan segments'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='Number of segments scanned in parallel (default all)'
+    )
+    parser.add_argument(
+        '--page-size', type=int, default=1000, help='Number of items scanned per request'
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    checkpoint = backfill(
+        args.checkpoint,
+        total_segments=args.total_segments,
+        workers=args.workers,
+        page_size=args.page_size
+    )
+    logger.info(
+        'Backfill complete, %d entries updated, URL_DIGEST_BACKFILLED can be enabled',
+        checkpoint.updated()
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+Benchmark of the URL validation of the shortlink creation
+
+Compares the former validation (syntactic check first) with the cheapest first pipeline of
+get_url(), without and with the verdict cache, over realistic map.geo.admin.ch URLs.
+
+    ENV_FILE=.env.testing python -m scripts.benchmark_url_validation
+"""
+import argparse
+import random
+import re
+import sys
+import timeit
+from urllib.parse import urlparse
+
+import validators
+
+from app.helpers.utils import check_url
+from app.helpers.utils import url_verdict_cache
+from app.helpers.utils import validate_url
+from app.settings import ALLOWED_DOMAINS_PATTERN
+
+TOPICS = ['ech', 'inspire', 'geol', 'vu', 'wildruhezonen', 'energie']
+LAYERS = [
+    'ch.swisstopo.zeitreihen',
+    'ch.bfs.gebaeude_wohnungs_register',
+    'ch.bav.haltestellen-oev',
+    'ch.swisstopo.swisstlm3d-wanderwege',
+    'ch.swisstopo.vec200-landcover',
+    'ch.bafu.biogeographische_regionen',
+    'ch.bfs.arealstatistik-bodenbedeckung-1985',
+    'ch.astra.wanderland',
+]
+
+
+def geo_admin_url(rng):
+    layers = rng.sample(LAYERS, rng.randint(1, 5))
+    return (
+        f'https://map.geo.admin.ch/#/map?lang={rng.choice(["de", "fr", "it", "en"])}'
+        f'&center={rng.uniform(2480000, 2840000):.2f},{rng.uniform(1070000, 1300000):.2f}'
+        f'&z={rng.randint(1, 12)}&topic={rng.choice(TOPICS)}'
+        f'&bgLayer=ch.swisstopo.pixelkarte-farbe&layers={";".join(layers)}'
+    )
+
+
+def build_urls(count, distinct, seed=0):
+    '''Returns `count` URLs drawn from `distinct` URLs (95% geo.admin and 5% rejected ones)'''
+    rng = random.Random(seed)
+    population = []
+    for index in range(distinct):
+        if index % 20 == 0:
+            population.append(f'https://www.example{index}.com/?q={index}')
+        else:
+            population.append(geo_admin_url(rng))
+    return [rng.choice(population) for _ in range(count)]
+
+
+def legacy_validation(url):
+    if not validators.url(url):
+        return False
+    domain = urlparse(url).hostname
+    return bool(domain) and re.fullmatch(ALLOWED_DOMAINS_PATTERN, domain) is not None
+
+
+def cached_validation(url):
+    return check_url(url)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=10000, help='Number of validated URLs')
+    parser.add_argument('--distinct', type=int, default=500, help='Number of distinct URLs')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    urls = build_urls(args.count, args.distinct)
+    candidates = [
+        ('syntactic check first', legacy_validation, None),
+        ('cheapest first', validate_url, None),
+        ('cheapest first + cache', cached_validation, url_verdict_cache.clear),
+    ]
+    print(f'{args.count} URLs ({args.distinct} distinct), best of {args.repeat}')
+    for name, function, setup in candidates:
+        timings = timeit.repeat(
+            lambda function=function: [function(url) for url in urls],
+            setup=setup or (lambda: None),
+            repeat=args.repeat,
+            number=1
+        )
+        best = min(timings)
+        print(f'{name:<25} {best * 1000:8.1f} ms {best / args.count * 1e6:8.2f} us/url')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+Build the read only snapshot index of the shortlink entries from a DynamoDB table export
+
+The export files are JSON lines, either in the DynamoDB JSON format of the DynamoDB export to S3
+(`{"Item": {"shortlink_id": {"S": "..."}, ...}}`) or plain entries (`{"shortlink_id": "...", ...}`),
+optionally gzip compressed.
+
+    python -m scripts.build_snapshot --output /var/lib/shortlink/snapshot.idx export/*.json.gz
+"""
+import argparse
+import gzip
+import json
+import logging
+import sys
+
+from app.helpers.snapshot import write_snapshot
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_ATTRIBUTES = ['shortlink_id', 'url', 'created']
+
+
+def parse_item(record):
+    '''Returns the entry of an export record, or None if it is not a shortlink entry'''
+    item = record.get('Item', record)
+    entry = {}
+    for attribute in SNAPSHOT_ATTRIBUTES:
+        value = item.get(attribute)
+        if isinstance(value, dict):
+            # DynamoDB JSON
+            value = value.get('S')
+        if value is not None:
+            entry[attribute] = value
+    if 'shortlink_id' not in entry or 'url' not in entry:
+        return None
+    return entry
+
+
+def read_export(paths):
+    '''Yields the entries of the export files'''
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as fd:
+            for number, line in enumerate(fd, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = parse_item(json.loads(line))
+                except (json.JSONDecodeError, AttributeError):
+                    entry = None
+                if entry is None:
+                    logger.warning('Skip invalid record %s:%d', path, number)
+                    continue
+                yield entry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', required=True, help='Snapshot index file to write')
+    parser.add_argument('exports', nargs='+', help='Table export files (JSON lines, .gz or not)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    count = write_snapshot(args.output, read_export(args.exports))
+    logger.info('Snapshot %s written with %d entries', args.output, count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
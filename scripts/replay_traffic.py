@@ -0,0 +1,346 @@
+"""
+Replay the production traffic recorded in the JSON access logs against a local instance
+
+The requests are read as a stream from the JSON logs of the service (the records of the
+log_response logger, file-json handler) or from JSON lines request files with flat records
+(`{"time": 1718000000.1, "method": "GET", "path": "/abc", "query_string": "", "headers": {},
+"json": null, "status_code": 301, "location": "https://..."}`, only method and path being
+required). Requests are sent at their original arrival time, divided by --speed, from a pool of
+--concurrency connections, which keeps the inter-arrival distribution, the concurrency and the
+popularity skew of the recorded traffic. With `--speed max` they are sent as fast as the pool
+allows.
+
+The latency percentiles are reported with the responses differing from the recorded ones (status
+and redirect location), or from the responses of a --baseline instance (e.g. the service without
+the cache or engine change being validated). The POST requests create shortlinks, never replay
+against a production instance.
+
+    python -m scripts.replay_traffic --target http://localhost:5000 logs/server-json-logs.json
+"""
+import argparse
+import ast
+import http.client
+import json
+import logging
+import math
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Request headers not replayed, they are set by the HTTP client
+SKIPPED_HEADERS = frozenset([
+    'host', 'content-length', 'connection', 'keep-alive', 'transfer-encoding', 'upgrade'
+])
+PERCENTILES = [50, 90, 99, 99.9]
+MAX_DIFF_EXAMPLES = 10
+
+
+def parse_time(value):
+    '''Returns the timestamp of an epoch or ISO 8601 time'''
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(value).timestamp()
+
+
+def parse_payload(value):
+    '''Returns the JSON payload of a record, the logs containing its python representation
+
+    Raises:
+        ValueError: the payload cannot be parsed, e.g. truncated in the logs
+    '''
+    if value is None or isinstance(value, (dict, list)):
+        return value
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        pass
+    try:
+        return ast.literal_eval(value)
+    except (SyntaxError, ValueError) as error:
+        raise ValueError(f'Invalid payload {value}') from error
+
+
+def parse_record(record):
+    '''Returns the request of a log or request file record, or None if it is not a request
+
+    Raises:
+        ValueError: the request cannot be reproduced
+    '''
+    if 'request' in record:
+        # Access log record of the service
+        log_request = record['request']
+        response = record.get('response', {})
+        if 'method' not in log_request or 'statusCode' not in response:
+            return None
+        duration = float(response.get('duration', 0))
+        return {
+            # The record is logged once the response is ready
+            'time': parse_time(record['time']) - duration if 'time' in record else None,
+            'method': log_request['method'],
+            'path': log_request['path'],
+            'query_string': log_request.get('queryString', ''),
+            'headers': log_request.get('headers', {}),
+            'json': parse_payload(log_request.get('payload')),
+            'status_code': int(response['statusCode']),
+            'location': response.get('headers', {}).get('Location'),
+        }
+    if 'method' not in record or 'path' not in record:
+        return None
+    return {
+        'time': parse_time(record['time']) if 'time' in record else None,
+        'method': record['method'],
+        'path': record['path'],
+        'query_string': record.get('query_string', ''),
+        'headers': record.get('headers', {}),
+        'json': record.get('json'),
+        'status_code': record.get('status_code'),
+        'location': record.get('location'),
+    }
+
+
+def read_requests(paths, stats):
+    '''Yields the requests of the files (`-` for stdin), skipped records are counted in stats'''
+    for path in paths:
+        # pylint: disable=consider-using-with
+        fd = sys.stdin if path == '-' else open(path, encoding='utf-8')
+        try:
+            for number, line in enumerate(fd, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    request = parse_record(json.loads(line))
+                except (json.JSONDecodeError, AttributeError, KeyError, ValueError) as error:
+                    logger.debug('Skip record %s:%d: %s', path, number, error)
+                    stats['skipped'] += 1
+                    continue
+                if request is not None:
+                    yield request
+        finally:
+            if fd is not sys.stdin:
+                fd.close()
+
+
+def percentile(values, rank):
+    '''Returns the nearest rank percentile of the sorted values'''
+    if not values:
+        return None
+    return values[max(0, math.ceil(rank / 100 * len(values)) - 1)]
+
+
+class Instance:
+    '''HTTP client of a service instance, with one keep-alive connection per thread'''
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection \
+            if parts.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = parts.netloc
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def get_connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = self.connection_class(self.netloc, timeout=self.timeout)
+        return self.local.connection
+
+    def send(self, request):
+        '''Send the request
+
+        Returns:
+            The status code, headers and body of the response and the latency in seconds
+        '''
+        url = request['path']
+        if request['query_string']:
+            url = f'{url}?{request["query_string"]}'
+        headers = {
+            key: value
+            for key, value in request['headers'].items()
+            if key.lower() not in SKIPPED_HEADERS
+        }
+        body = None
+        if request['json'] is not None:
+            body = json.dumps(request['json']).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        connection = self.get_connection()
+        started = time.perf_counter()
+        try:
+            connection.request(request['method'], url, body=body, headers=headers)
+            response = connection.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self.local.connection = None
+            raise
+        return response.status, response.headers, content, time.perf_counter() - started
+
+
+class Replay:
+    '''Replay of a request stream against the target instance'''
+
+    def __init__(self, target, baseline=None, concurrency=100, timeout=10):
+        self.target = Instance(target, timeout)
+        self.baseline = Instance(baseline, timeout) if baseline else None
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = Counter()
+        self.diffs = Counter()
+        self.diff_examples = []
+        self.stats = Counter()
+        self.max_lag = 0.0
+
+    def compare(self, request, status, headers, content):
+        '''Returns the differences of the response with the expected one'''
+        if self.baseline is not None:
+            expected_status, expected_headers, expected_content, _ = self.baseline.send(request)
+            expected_location = expected_headers.get('Location')
+        else:
+            expected_status = request['status_code']
+            expected_location = request['location']
+            expected_content = None
+        diffs = []
+        if expected_status is not None and status != expected_status:
+            diffs.append(('status', expected_status, status))
+        if expected_location is not None and headers.get('Location') != expected_location:
+            diffs.append(('location', expected_location, headers.get('Location')))
+        # The created shortlinks differ, only the body of the other requests are compared
+        if expected_content is not None and request['method'] == 'GET' and \
+            content != expected_content:
+            diffs.append(('body', len(expected_content), len(content)))
+        return diffs
+
+    def replay_request(self, request, scheduled):
+        lag = time.monotonic() - scheduled
+        try:
+            status, headers, content, latency = self.target.send(request)
+            diffs = self.compare(request, status, headers, content)
+        except (OSError, http.client.HTTPException) as error:
+            logger.debug('%s %s failed: %s', request['method'], request['path'], error)
+            with self.lock:
+                self.stats['errors'] += 1
+            return
+        with self.lock:
+            self.max_lag = max(self.max_lag, lag)
+            self.latencies.append(latency)
+            self.statuses[status] += 1
+            for kind, expected, actual in diffs:
+                self.diffs[kind] += 1
+                if len(self.diff_examples) < MAX_DIFF_EXAMPLES:
+                    self.diff_examples.append(
+                        f'{request["method"]} {request["path"]}: {kind} {expected} != {actual}'
+                    )
+
+    def run(self, requests, speed=1.0):
+        '''Replay the requests, at their original pace divided by speed or as fast as possible
+        with a speed of None
+        '''
+        started = time.monotonic()
+        first_time = None
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            # Bound the number of pending requests, the stream being read as it is replayed
+            slots = threading.BoundedSemaphore(self.concurrency * 2)
+            for request in requests:
+                self.stats['requests'] += 1
+                scheduled = time.monotonic()
+                if speed is not None and request['time'] is not None:
+                    if first_time is None:
+                        first_time = request['time']
+                    scheduled = started + max(0.0, request['time'] - first_time) / speed
+                    delay = scheduled - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                slots.acquire()  # pylint: disable=consider-using-with
+                future = executor.submit(self.replay_request, request, scheduled)
+                future.add_done_callback(lambda _: slots.release())
+        self.stats['duration'] = time.monotonic() - started
+        return self.get_report()
+
+    def get_report(self):
+        latencies = sorted(self.latencies)
+        return {
+            'requests': self.stats['requests'],
+            'errors': self.stats['errors'],
+            'duration': self.stats['duration'],
+            'statuses': dict(self.statuses),
+            'latency': {
+                f'p{rank:g}': percentile(latencies, rank) for rank in PERCENTILES
+            } | {
+                'max': latencies[-1] if latencies else None
+            },
+            'max_lag': self.max_lag,
+            'diffs': dict(self.diffs),
+            'diff_examples': self.diff_examples,
+        }
+
+
+def parse_speed(value):
+    if value == 'max':
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError('speed must be positive or max')
+    return speed
+
+
+def print_report(report, skipped):
+    print(
+        f'{report["requests"]} requests replayed in {report["duration"]:.1f}s, '
+        f'{report["errors"]} errors, {skipped} records skipped'
+    )
+    print('Statuses: ' + ', '.join(f'{k}: {v}' for k, v in sorted(report['statuses'].items())))
+    print(
+        'Latency: ' + ', '.join(
+            f'{name} {value * 1000:.1f}ms' for name, value in report['latency'].items()
+            if value is not None
+        )
+    )
+    print(f'Max schedule lag: {report["max_lag"] * 1000:.1f}ms')
+    if report['diffs']:
+        print('Differences: ' + ', '.join(f'{k}: {v}' for k, v in report['diffs'].items()))
+        for example in report['diff_examples']:
+            print(f'  {example}')
+    else:
+        print('No differences')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--target', required=True, help='Base URL of the instance to replay to')
+    parser.add_argument(
+        '--baseline', help='Base URL of the instance whose responses are the expected ones'
+    )
+    parser.add_argument(
+        '--speed',
+        type=parse_speed,
+        default=1.0,
+        help='Replay speed factor, 1 for the original pace, or max (default 1)'
+    )
+    parser.add_argument(
+        '--concurrency', type=int, default=100, help='Maximum number of concurrent requests'
+    )
+    parser.add_argument('--timeout', type=float, default=10, help='Request timeout in seconds')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    parser.add_argument('files', nargs='+', help='JSON log or request files, - for stdin')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    skipped = Counter()
+    replay = Replay(
+        args.target, baseline=args.baseline, concurrency=args.concurrency, timeout=args.timeout
+    )
+    report = replay.run(read_requests(args.files, skipped), speed=args.speed)
+    if args.json:
+        print(json.dumps({**report, 'skipped': skipped['skipped']}, indent=2))
+    else:
+        print_report(report, skipped['skipped'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+Project the shortlink_id collision and retry rates of the random ids over time
+
+A new id is generated uniformly among the len(SHORT_ID_ALPHABET) ** SHORT_ID_SIZE possible ids,
+it collides with probability p = n / d, n being the number of ids already used (the entries of
+the table, including the archived ones in tiering mode, but not the legacy timestamp based ids
+which are shorter). The number of PutItem retries of a creation is geometric, with p / (1 - p)
+retries on average, each retry being a failed conditional write that consumes write capacity.
+
+The analytic projection is computed for each step while the table grows by the creation rate.
+With --trials, it is compared with a Monte-Carlo simulation of the retries (requires NumPy, which
+is not a dependency of the service). The live counterpart are the `shortlink.create.collisions`
+counter and the `shortlink.create.collision_retries` histogram.
+
+    python -m scripts.simulate_collisions --table-size 2000000 --rate 25200 --days 3650
+"""
+import argparse
+import math
+import sys
+
+from app.settings import COLLISION_MAX_RETRY
+from app.settings import SHORT_ID_ALPHABET
+from app.settings import SHORT_ID_SIZE
+
+PERCENTILE = 0.99
+
+
+def get_retries_percentile(probability, percentile=PERCENTILE):
+    '''Returns the number of retries not exceeded by the given percentile of the creations'''
+    if probability <= 0:
+        return 0
+    if probability >= 1:
+        return math.inf
+    # P(retries >= k) = p ** k
+    return max(0, math.ceil(math.log(1 - percentile) / math.log(probability)) - 1)
+
+
+def project(id_space, table_size, rate, *, days, step, max_retry=COLLISION_MAX_RETRY):
+    '''Analytic projection of the collisions
+
+    Args:
+        id_space: number of possible ids
+        table_size: number of ids used at the start
+        rate: number of creations per day
+        days: projection horizon in days
+        step: days between two projected rows
+
+    Returns:
+        The projected rows, one per step
+    '''
+    rows = []
+    size = table_size
+    retries = 0.0
+    collisions_expectation = 0.0
+    for day in range(step, days + step, step):
+        step_days = min(step, days - (day - step))
+        creates = rate * step_days
+        # Mean probability over the step, the table growing linearly
+        probability = min((size + creates / 2) / id_space, 1.0)
+        retries_per_create = probability / (1 - probability) if probability < 1 else math.inf
+        retries += creates * retries_per_create
+        collisions_expectation += creates * probability
+        size += creates
+        rows.append({
+            'day': min(day, days),
+            'table_size': size,
+            'retry_probability': probability,
+            'retries_per_create': retries_per_create,
+            'retries_p99': get_retries_percentile(probability),
+            'failure_probability': probability**(max_retry + 1),
+            'retries': retries,
+            # Probability of at least one collision since the start (birthday problem)
+            'collision_probability': -math.expm1(-collisions_expectation),
+        })
+    return rows
+
+
+def simulate(id_space, table_size, rate, *, days, step, trials, seed=None):
+    '''Monte-Carlo simulation of the cumulated retries
+
+    The retries of the creations of a step are the failures before as many successes of
+    probability 1 - p, drawn from a negative binomial distribution for all trials and steps at
+    once.
+
+    Returns:
+        The mean and the 95th percentile of the cumulated retries at each step
+    '''
+    try:
+        import numpy as np  # pylint: disable=import-outside-toplevel
+    except ImportError as error:
+        raise RuntimeError('The Monte-Carlo simulation requires NumPy') from error
+    ends = np.minimum(np.arange(step, days + step, step), days)
+    creates = np.rint(rate * np.diff(ends, prepend=0)).astype(np.int64)
+    # Mean probability over the step, the table growing linearly
+    probability = np.minimum((table_size + rate * ends - creates / 2) / id_space, 1 - 1e-12)
+    retries = np.random.default_rng(seed).negative_binomial(
+        np.maximum(creates, 1), 1 - probability, size=(trials, len(ends))
+    )
+    retries = np.where(creates > 0, retries, 0).cumsum(axis=1)
+    return [{
+        'day': int(day), 'retries_mean': float(mean), 'retries_p95': float(p95)
+    } for day, mean, p95 in zip(ends, retries.mean(axis=0), np.percentile(retries, 95, axis=0))]
+
+
+def print_rows(rows, simulated=None):
+    header = (
+        f'{"day":>6} {"table size":>14} {"P(retry)":>10} {"retries/create":>14} '
+        f'{"p99 retries":>11} {"P(failure)":>10} {"retries":>12} {"P(collision)":>12}'
+    )
+    if simulated:
+        header += f' {"MC mean":>12} {"MC p95":>12}'
+    print(header)
+    for i, row in enumerate(rows):
+        line = (
+            f'{row["day"]:>6} {row["table_size"]:>14,.0f} {row["retry_probability"]:>10.3g} '
+            f'{row["retries_per_create"]:>14.3g} {row["retries_p99"]:>11} '
+            f'{row["failure_probability"]:>10.3g} {row["retries"]:>12.4g} '
+            f'{row["collision_probability"]:>12.3g}'
+        )
+        if simulated:
+            line += f' {simulated[i]["retries_mean"]:>12.4g} {simulated[i]["retries_p95"]:>12,.0f}'
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        '--size', type=int, default=SHORT_ID_SIZE, help='Short id size (default SHORT_ID_SIZE)'
+    )
+    parser.add_argument(
+        '--alphabet',
+        default=SHORT_ID_ALPHABET,
+        help='Short id alphabet (default SHORT_ID_ALPHABET)'
+    )
+    parser.add_argument(
+        '--table-size',
+        type=int,
+        required=True,
+        help='Current number of random ids in the table (and in the cold table)'
+    )
+    parser.add_argument('--rate', type=float, required=True, help='Creations per day')
+    parser.add_argument(
+        '--days', type=int, default=5 * 365, help='Projection horizon in days (default 5 years)'
+    )
+    parser.add_argument('--step', type=int, default=90, help='Days between two rows')
+    parser.add_argument(
+        '--max-retry',
+        type=int,
+        default=COLLISION_MAX_RETRY,
+        help='Collision retries before a creation fails'
+    )
+    parser.add_argument(
+        '--trials',
+        type=int,
+        default=0,
+        help='Number of Monte-Carlo trials (requires NumPy, default none)'
+    )
+    parser.add_argument('--seed', type=int, default=None, help='Monte-Carlo random seed')
+    args = parser.parse_args(argv)
+
+    id_space = len(args.alphabet)**args.size
+    print(f'{id_space:,} possible ids of {args.size} characters among {len(args.alphabet)}')
+    rows = project(
+        id_space,
+        args.table_size,
+        args.rate,
+        days=args.days,
+        step=args.step,
+        max_retry=args.max_retry
+    )
+    simulated = simulate(
+        id_space,
+        args.table_size,
+        args.rate,
+        days=args.days,
+        step=args.step,
+        trials=args.trials,
+        seed=args.seed
+    ) if args.trials else None
+    print_rows(rows, simulated)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
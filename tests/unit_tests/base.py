@@ -5,8 +5,16 @@ from urllib.parse import urlparse
 
 import boto3
 
+from flask import url_for
+
 from app.app import app
+from app.helpers.dynamo_db import entry_cache
 from app.helpers.dynamo_db import get_db
+from app.helpers.dynamo_db import negative_cache
+from app.helpers.resilience import dynamodb_background_circuit_breaker
+from app.helpers.resilience import dynamodb_circuit_breaker
+from app.helpers.utils import url_verdict_cache
+from app.middlewares import response_cache
 from app.settings import ALLOWED_DOMAINS_PATTERN
 from app.settings import AWS_DEFAULT_REGION
 from app.settings import AWS_DYNAMODB_TABLE_NAME
@@ -35,6 +43,8 @@ def create_dynamodb():
                 'AttributeName': 'shortlink_id', 'AttributeType': 'S'
             }, {
                 'AttributeName': 'url', 'AttributeType': 'S'
+            }, {
+                'AttributeName': 'url_digest', 'AttributeType': 'S'
             }],
             LocalSecondaryIndexes=[
                 {
@@ -47,6 +57,20 @@ def create_dynamodb():
                     }
                 },
             ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'UrlDigestIndex',
+                    'KeySchema': [{
+                        'AttributeName': 'url_digest', 'KeyType': 'HASH'
+                    }],
+                    'Projection': {
+                        'ProjectionType': 'INCLUDE', 'NonKeyAttributes': ['shortlink_id', 'url']
+                    },
+                    'ProvisionedThroughput': {
+                        'ReadCapacityUnits': 10, 'WriteCapacityUnits': 10
+                    }
+                },
+            ],
             ProvisionedThroughput={
                 'ReadCapacityUnits': 10, 'WriteCapacityUnits': 10
             }
@@ -83,6 +107,22 @@ class BaseShortlinkTestCase(unittest.TestCase):
 
     def tearDown(self):
         self.table.delete()
+        entry_cache.clear()
+        negative_cache.clear()
+        response_cache.clear()
+        url_verdict_cache.clear()
+        dynamodb_circuit_breaker.reset()
+        dynamodb_background_circuit_breaker.reset()
+
+    def get_info(self, short_id, headers=None):
+        '''Returns the shortlink info response (no redirect)'''
+        return self.app.get(
+            url_for('get_shortlink', shortlink_id=short_id),
+            query_string={'redirect': 'false'},
+            headers={
+                "Origin": "https://map.geo.admin.ch", **(headers or {})
+            }
+        )
 
     def assertCors(self, response, expected_allowed_methods, all_origin=False):  # pylint: disable=invalid-name
         self.assertIn('Access-Control-Allow-Origin', response.headers)
@@ -0,0 +1,135 @@
+import unittest
+from unittest.mock import patch
+
+import gevent
+
+from flask import url_for
+
+from app.app import app
+from app.helpers.admission import AdmissionController
+from app.helpers.dynamo_db import entry_cache
+from app.middlewares import AdmissionControlMiddleware
+from tests.unit_tests.base import BaseShortlinkTestCase
+
+
+class TestAdmissionController(unittest.TestCase):
+
+    def test_admit_within_limit(self):
+        controller = AdmissionController(2, 2, queue_timeout=0, max_queue=10)
+        self.assertIsNone(controller.acquire('read'))
+        self.assertIsNone(controller.acquire('create'))
+        self.assertEqual(controller.acquire('read'), 'queue_full')
+        controller.release()
+        self.assertIsNone(controller.acquire('read'))
+        self.assertEqual(controller.inflight, 2)
+
+    def test_create_limit(self):
+        controller = AdmissionController(2, 1, queue_timeout=0, max_queue=10)
+        self.assertIsNone(controller.acquire('read'))
+        self.assertEqual(controller.acquire('create'), 'queue_full')
+        self.assertIsNone(controller.acquire('read'))
+
+    def test_queue_timeout(self):
+        controller = AdmissionController(1, 1, queue_timeout=0.01, max_queue=10)
+        self.assertIsNone(controller.acquire('read'))
+        self.assertEqual(controller.acquire('read'), 'timeout')
+        self.assertEqual(controller.queued(), 0)
+        self.assertEqual(controller.inflight, 1)
+
+    def test_queue_full(self):
+        controller = AdmissionController(1, 1, queue_timeout=1, max_queue=1)
+        self.assertIsNone(controller.acquire('read'))
+        waiter = gevent.spawn(controller.acquire, 'read')
+        gevent.sleep(0)
+        self.assertEqual(controller.acquire('read'), 'queue_full')
+        controller.release()
+        self.assertIsNone(waiter.get(timeout=1))
+        self.assertEqual(controller.inflight, 1)
+
+    def test_reads_served_first(self):
+        controller = AdmissionController(1, 1, queue_timeout=1, max_queue=10)
+        self.assertIsNone(controller.acquire('read'))
+        create = gevent.spawn(controller.acquire, 'create')
+        read = gevent.spawn(controller.acquire, 'read')
+        gevent.sleep(0)
+        self.assertEqual(controller.queued(), 2)
+
+        controller.release()
+        self.assertIsNone(read.get(timeout=1))
+        self.assertFalse(create.ready())
+
+        controller.release()
+        self.assertIsNone(create.get(timeout=1))
+        self.assertEqual(controller.inflight, 1)
+
+    def test_killed_waiter(self):
+        controller = AdmissionController(1, 1, queue_timeout=1, max_queue=10)
+        self.assertIsNone(controller.acquire('read'))
+        waiter = gevent.spawn(controller.acquire, 'read')
+        gevent.sleep(0)
+        waiter.kill()
+        self.assertEqual(controller.queued(), 0)
+        controller.release()
+        self.assertEqual(controller.inflight, 0)
+
+
+class TestAdmissionControlMiddleware(BaseShortlinkTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.controller = AdmissionController(1, 1, queue_timeout=0, max_queue=10)
+        for patcher in [
+            patch.object(app, 'wsgi_app', AdmissionControlMiddleware(app, app.wsgi_app)),
+            patch('app.middlewares.admission_controller', self.controller),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_slot_released(self):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        response = self.app.get(url_for('get_shortlink', shortlink_id=short_id))
+        self.assertEqual(response.status_code, 301)
+        # The slot is released once the response has been sent (closed)
+        response.close()
+        self.assertEqual(self.controller.inflight, 0)
+
+    def test_shed_requests(self):
+        entry_cache.clear()
+        self.assertIsNone(self.controller.acquire('read'))
+        response = self.app.post(
+            url_for('create_shortlink'),
+            json={"url": "https://map.geo.admin.ch/?topic=ech"},
+            headers={"Origin": "https://map.geo.admin.ch"}
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(response.headers['Cache-Control'], 'no-store')
+        self.assertEqual(
+            response.headers['Access-Control-Allow-Origin'], 'https://map.geo.admin.ch'
+        )
+        self.assertEqual(response.json['error']['code'], 503)
+
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        response = self.app.get(url_for('get_shortlink', shortlink_id=short_id))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(self.controller.inflight, 1)
+
+    def test_prioritized_requests(self):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        entry_cache.clear()
+        self.app.get(url_for('get_shortlink', shortlink_id=short_id)).close()
+        self.app.get(url_for('get_shortlink', shortlink_id='nonexistent')).close()
+        self.assertIsNone(self.controller.acquire('read'))
+
+        response = self.app.get(url_for('checker'), headers={"Origin": "https://map.geo.admin.ch"})
+        self.assertEqual(response.status_code, 200)
+        # Cached shortlink and invalid id
+        response = self.app.get(url_for('get_shortlink', shortlink_id=short_id))
+        self.assertEqual(response.status_code, 301)
+        response = self.app.get(url_for('get_shortlink', shortlink_id='nonexistent'))
+        self.assertEqual(response.status_code, 404)
+        # Valid id requiring a DB lookup
+        response = self.app.get(url_for('get_shortlink', shortlink_id='abcdefghijkl'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.controller.inflight, 1)
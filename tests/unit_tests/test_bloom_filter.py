@@ -0,0 +1,99 @@
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from app.helpers.bloom_filter import BloomFilter
+from app.helpers.bloom_filter import UrlFilter
+from app.helpers.dynamo_db import count_urls
+from app.helpers.dynamo_db import scan_urls
+from tests.unit_tests.base import BaseShortlinkTestCase
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter.for_capacity(1000, 0.01, max_memory=1024 * 1024)
+        self.assertEqual(bloom.hash_count, 7)
+        self.assertEqual(bloom.memory, 1199)
+        urls = [f'https://map.geo.admin.ch/?layers={i}' for i in range(1000)]
+        for url in urls:
+            bloom.add(url)
+        for url in urls:
+            self.assertIn(url, bloom)
+        false_positives = sum(f'https://example.com/?{i}' in bloom for i in range(10000))
+        self.assertLess(false_positives, 200)
+        self.assertAlmostEqual(bloom.false_positive_rate(), 0.01, delta=0.002)
+
+    def test_bloom_filter_max_memory(self):
+        bloom = BloomFilter.for_capacity(1000, 0.01, max_memory=100)
+        self.assertEqual(bloom.memory, 100)
+        self.assertEqual(bloom.hash_count, 1)
+
+
+class TestUrlFilter(BaseShortlinkTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.directory.cleanup)
+        self.url_filter = self.create_url_filter()
+        patcher = patch('app.helpers.dynamo_db.url_filter', self.url_filter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_url_filter(self):
+        url_filter = UrlFilter(
+            count_urls,
+            scan_urls,
+            directory=self.directory.name,
+            false_positive_rate=0.01,
+            max_memory=1024 * 1024,
+            rebuild_interval=3600
+        )
+        # The filter is refreshed explicitly by the tests
+        patcher = patch.object(url_filter, 'start')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return url_filter
+
+    def test_url_filter_not_built(self):
+        url = next(iter(self.uuid_to_url_dict.values()))
+        self.assertTrue(self.url_filter.might_contain(url))
+        self.assertTrue(self.url_filter.might_contain('https://map.geo.admin.ch/?layers=new'))
+
+    def test_url_filter(self):
+        self.url_filter.refresh()
+        self.assertEqual(self.url_filter.filter.count, len(self.uuid_to_url_dict))
+        for short_id, url in self.uuid_to_url_dict.items():
+            self.assertEqual(self.db_client.get_entry_by_url(url)['shortlink_id'], short_id)
+
+        url = 'https://map.geo.admin.ch/?layers=test-url-filter'
+        with patch.object(self.db_client.read_table, 'query') as mock_query:
+            self.assertIsNone(self.db_client.get_entry_by_url(url))
+            mock_query.assert_not_called()
+
+        # Local creations are added to the filter
+        entry = self.db_client.add_url_to_table(url)
+        self.assertEqual(
+            self.db_client.get_entry_by_url(url)['shortlink_id'], entry['shortlink_id']
+        )
+
+    def test_url_filter_shared(self):
+        self.url_filter.refresh()
+        url = 'https://map.geo.admin.ch/?layers=test-url-filter-shared'
+        self.url_filter.add(url)
+
+        # The other workers of the host load the saved filter instead of scanning the table
+        other_url_filter = self.create_url_filter()
+        with patch.object(other_url_filter, 'scan_urls') as mock_scan:
+            other_url_filter.refresh()
+            mock_scan.assert_not_called()
+        self.assertEqual(other_url_filter.filter.count, len(self.uuid_to_url_dict))
+        self.assertFalse(other_url_filter.might_contain(url))
+
+        # The local creations made after the scan start are added to a newly loaded filter
+        with patch('app.helpers.bloom_filter.time.time', return_value=time.time() - 60):
+            other_url_filter.rebuild()
+        self.url_filter.refresh()
+        self.assertTrue(self.url_filter.might_contain(url))
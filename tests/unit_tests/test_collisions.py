@@ -0,0 +1,51 @@
+import unittest
+from importlib.util import find_spec
+
+from scripts.simulate_collisions import get_retries_percentile
+from scripts.simulate_collisions import project
+from scripts.simulate_collisions import simulate
+
+
+class TestCollisionProjection(unittest.TestCase):
+
+    def test_retries_percentile(self):
+        self.assertEqual(get_retries_percentile(0), 0)
+        self.assertEqual(get_retries_percentile(1e-6), 0)
+        # P(retries >= 6) = 0.5 ** 6 < 1%
+        self.assertEqual(get_retries_percentile(0.5), 6)
+
+    def test_project(self):
+        # Half of the 16 possible ids are used, without creation
+        rows = project(2**4, 8, 0, days=10, step=5, max_retry=2)
+        self.assertEqual([row['day'] for row in rows], [5, 10])
+        row = rows[0]
+        self.assertEqual(row['retry_probability'], 0.5)
+        self.assertEqual(row['retries_per_create'], 1)
+        self.assertEqual(row['failure_probability'], 0.125)
+        self.assertEqual(row['retries'], 0)
+        self.assertEqual(row['collision_probability'], 0)
+
+    def test_project_growth(self):
+        rows = project(36**12, 0, 25200, days=3650, step=365)
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(rows[-1]['table_size'], 25200 * 3650)
+        probabilities = [row['retry_probability'] for row in rows]
+        self.assertEqual(probabilities, sorted(probabilities))
+        self.assertLess(rows[-1]['retry_probability'], 1e-9)
+        self.assertGreater(rows[-1]['collision_probability'], 0)
+        self.assertLess(rows[-1]['collision_probability'], 0.01)
+
+    def test_project_partial_step(self):
+        rows = project(36**12, 0, 10, days=25, step=10)
+        self.assertEqual([row['day'] for row in rows], [10, 20, 25])
+        self.assertEqual(rows[-1]['table_size'], 250)
+
+    @unittest.skipIf(find_spec('numpy') is None, 'NumPy not installed')
+    def test_simulate(self):
+        rows = project(1000, 200, 10, days=100, step=10)
+        simulated = simulate(1000, 200, 10, days=100, step=10, trials=2000, seed=1)
+        self.assertEqual(len(simulated), len(rows))
+        for row, simulated_row in zip(rows, simulated):
+            self.assertAlmostEqual(
+                simulated_row['retries_mean'], row['retries'], delta=row['retries'] * 0.05
+            )
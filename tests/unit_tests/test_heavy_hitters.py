@@ -0,0 +1,158 @@
+import json
+import tempfile
+import unittest
+from collections import Counter
+from random import Random
+from unittest.mock import patch
+
+from nose2.tools import params
+
+from flask import url_for
+
+from app.helpers.heavy_hitters import HeavyHitters
+from app.helpers.heavy_hitters import SpaceSaving
+from app.helpers.heavy_hitters import merge_sketches
+from app.settings import HEAVY_HITTERS_CAPACITY
+from tests.unit_tests.base import BaseShortlinkTestCase
+
+
+def zipf_stream(size, keys, seed=0):
+    random = Random(seed)
+    return random.choices([f'id-{i}' for i in range(keys)],
+                          weights=[1 / (i + 1) for i in range(keys)],
+                          k=size)
+
+
+class TestSpaceSaving(unittest.TestCase):
+
+    def assertBounds(self, counters, real_counts):  # pylint: disable=invalid-name
+        for key, count, error in counters:
+            self.assertGreaterEqual(count, real_counts[key], msg=key)
+            self.assertLessEqual(count - error, real_counts[key], msg=key)
+
+    def test_space_saving_exact(self):
+        sketch = SpaceSaving(10)
+        for key in ['a', 'b', 'a', 'c', 'a', 'b']:
+            sketch.add(key)
+        self.assertEqual(
+            sketch.to_dict(), {
+                'total': 6, 'min_count': 0, 'counters': [['a', 3, 0], ['b', 2, 0], ['c', 1, 0]]
+            }
+        )
+
+    def test_space_saving_bounds(self):
+        stream = zipf_stream(10000, 1000)
+        sketch = SpaceSaving(50)
+        for key in stream:
+            sketch.add(key)
+        self.assertEqual(len(sketch), 50)
+        self.assertEqual(sketch.total, len(stream))
+        self.assertEqual(min(count for count, _ in sketch.counters.values()), sketch.min_count)
+        real_counts = Counter(stream)
+        self.assertBounds(sketch.to_dict()['counters'], real_counts)
+        # The top keys are found
+        top = sorted(sketch.counters, key=lambda key: -sketch.counters[key][0])[:3]
+        self.assertEqual(top, [key for key, _ in real_counts.most_common(3)])
+
+    def test_merge_sketches(self):
+        streams = [zipf_stream(5000, 500, seed) for seed in range(3)]
+        sketches = []
+        for stream in streams:
+            sketch = SpaceSaving(50)
+            for key in stream:
+                sketch.add(key)
+            sketches.append(sketch.to_dict())
+        total, items = merge_sketches(sketches, 10)
+        self.assertEqual(total, 15000)
+        self.assertEqual(len(items), 10)
+        real_counts = Counter(key for stream in streams for key in stream)
+        self.assertBounds([(item['shortlink_id'], item['count'], item['error']) for item in items],
+                          real_counts)
+        self.assertEqual(items[0]['shortlink_id'], 'id-0')
+
+
+class TestHeavyHittersEndpoint(BaseShortlinkTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.directory.cleanup)
+        self.heavy_hitters = HeavyHitters(100, self.directory.name, 60, 3600)
+        for target in ('app.helpers.heavy_hitters', 'app.helpers.hit_counters'):
+            patcher = patch(f'{target}.heavy_hitters', self.heavy_hitters)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.heavy_hitters.stop)
+        patcher = patch('app.routes.HEAVY_HITTERS_TOKEN', 'secret')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.headers = {"Origin": "https://map.geo.admin.ch", "X-Shortlink-Token": "secret"}
+
+    def test_heavy_hitters(self):
+        short_id, other_short_id, *_ = self.uuid_to_url_dict.keys()
+        for _ in range(3):
+            self.app.get(url_for('get_shortlink', shortlink_id=short_id))
+        self.app.get(
+            url_for('get_shortlink', shortlink_id=other_short_id),
+            query_string={'redirect': 'false'},
+            headers={"Origin": "https://map.geo.admin.ch"}
+        )
+        self.app.get(url_for('get_shortlink', shortlink_id='nonexistent'))
+        # Sketch of another worker
+        with open(f'{self.directory.name}/heavy-hitters-1.json', 'wt', encoding='utf-8') as fd:
+            json.dump({'total': 5, 'min_count': 0, 'counters': [[other_short_id, 5, 0]]}, fd)
+
+        response = self.app.get(url_for('heavy_hitters'), headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Cache-Control', response.headers)
+        self.assertNotIn('Access-Control-Allow-Origin', response.headers)
+        self.assertEqual(
+            response.json,
+            {
+                'success': True,
+                'workers': 2,
+                'total': 9,
+                'heavy_hitters': [
+                    {
+                        'shortlink_id': other_short_id, 'count': 6, 'error': 0
+                    },
+                    {
+                        'shortlink_id': short_id, 'count': 3, 'error': 0
+                    },
+                ]
+            }
+        )
+
+        # Persisted on worker stop
+        self.heavy_hitters.stop()
+        with open(self.heavy_hitters.path, 'rt', encoding='utf-8') as fd:
+            self.assertEqual(json.load(fd)['total'], 4)
+
+    def test_heavy_hitters_disabled(self):
+        with patch('app.helpers.heavy_hitters.heavy_hitters', None):
+            response = self.app.get(url_for('heavy_hitters'), headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+
+    @params(
+        {"Origin": "https://map.geo.admin.ch"},
+        {
+            "Origin": "https://map.geo.admin.ch", "X-Shortlink-Token": "wrong"
+        },
+    )
+    def test_heavy_hitters_token(self, headers):
+        response = self.app.get(url_for('heavy_hitters'), headers=headers)
+        self.assertEqual(response.status_code, 403)
+        with patch('app.routes.HEAVY_HITTERS_TOKEN', ''):
+            response = self.app.get(url_for('heavy_hitters'), headers=self.headers)
+        self.assertEqual(response.status_code, 403)
+
+    @params(('0', 400), ('banana', 400), ('1000000', 200))
+    def test_heavy_hitters_top(self, top, status):
+        with patch('app.routes.get_heavy_hitters', return_value=(1, 0, [])) as mock:
+            response = self.app.get(
+                url_for('heavy_hitters'), query_string={'top': top}, headers=self.headers
+            )
+        self.assertEqual(response.status_code, status)
+        if status == 200:
+            # Limited to the capacity of the sketches
+            mock.assert_called_once_with(HEAVY_HITTERS_CAPACITY)
@@ -0,0 +1,107 @@
+import unittest
+from unittest.mock import patch
+
+import gevent
+
+from app.helpers.dynamo_db import get_db
+from app.helpers.hedging import HedgeBudget
+from app.helpers.hedging import HedgedCall
+from app.helpers.hedging import LatencyTracker
+from tests.unit_tests.base import BaseShortlinkTestCase
+
+
+class TestLatencyTracker(unittest.TestCase):
+
+    def test_percentile(self):
+        tracker = LatencyTracker(90, size=100, min_samples=10, refresh=1)
+        for i in range(9):
+            tracker.add(i)
+        self.assertIsNone(tracker.value())
+        tracker.add(9)
+        self.assertEqual(tracker.value(), 9)
+        for i in range(100):
+            tracker.add(i / 100)
+        self.assertAlmostEqual(tracker.value(), 0.9)
+
+
+class TestHedgeBudget(unittest.TestCase):
+
+    def test_budget(self):
+        budget = HedgeBudget(0.5, max_tokens=2)
+        self.assertFalse(budget.spend())
+        for _ in range(10):
+            budget.earn()
+        self.assertTrue(budget.spend())
+        self.assertTrue(budget.spend())
+        self.assertFalse(budget.spend())
+
+
+class TestHedgedCall(unittest.TestCase):
+
+    def setUp(self):
+        self.hedged_call = HedgedCall('test', 50, budget_ratio=1)
+        # Recent latency of 10ms
+        for _ in range(100):
+            self.hedged_call.latency.add(0.01)
+        self.calls = []
+        self.answered = []
+
+    def call(self, delays):
+
+        def func(value):
+            delay = delays[len(self.calls)]
+            self.calls.append(gevent.getcurrent())
+            gevent.sleep(abs(delay))
+            if delay < 0:
+                raise ValueError(f'{value}-{delay}')
+            self.answered.append(f'{value}-{delay}')
+            return f'{value}-{delay}'
+
+        return self.hedged_call.call(func, 'answer')
+
+    def test_fast_call_not_hedged(self):
+        self.assertEqual(self.call([0]), 'answer-0')
+        # The primary call runs in the calling greenlet
+        self.assertEqual(self.calls, [gevent.getcurrent()])
+
+    def test_slow_call_hedged(self):
+        self.assertEqual(self.call([1, 0]), 'answer-0')
+        self.assertEqual(len(self.calls), 2)
+        # The slow primary call has been interrupted, its latency is recorded up to then
+        gevent.sleep(0)
+        self.assertEqual(self.answered, ['answer-0'])
+        self.assertEqual(len(self.hedged_call.latency.samples), 101)
+        self.assertLess(self.hedged_call.latency.samples[-1], 1)
+
+    def test_hedge_budget_exhausted(self):
+        self.hedged_call.budget.ratio = 0
+        self.assertEqual(self.call([0.05]), 'answer-0.05')
+        self.assertEqual(len(self.calls), 1)
+
+    def test_first_call_answers_before_hedge(self):
+        self.assertEqual(self.call([0.02, 1]), 'answer-0.02')
+        self.assertEqual(len(self.calls), 2)
+        # The hedged call has been cancelled
+        gevent.sleep(0)
+        self.assertTrue(self.calls[1].dead)
+        self.assertEqual(
+            self.hedged_call.latency.samples[-1], max(self.hedged_call.latency.samples)
+        )
+
+    def test_first_call_fails(self):
+        self.assertEqual(self.call([-0.02, 0.05]), 'answer-0.05')
+        with self.assertRaisesRegex(ValueError, 'answer--0.05'):
+            self.calls.clear()
+            self.call([-0.05, -0.01])
+
+
+class TestHedgedGetItem(BaseShortlinkTestCase):
+
+    def test_hedged_get_entry_by_shortlink(self):
+        hedged_call = HedgedCall('GetItem', 95, 0.05)
+        with patch('app.helpers.dynamo_db.hedged_get_item', hedged_call):
+            for short_id, url in self.uuid_to_url_dict.items():
+                self.assertEqual(
+                    get_db().get_item(Key={'shortlink_id': short_id})['Item']['url'], url
+                )
+        self.assertEqual(len(hedged_call.latency.samples), len(self.uuid_to_url_dict))
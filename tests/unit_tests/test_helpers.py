@@ -6,8 +6,18 @@ from unittest.mock import patch
 from werkzeug.exceptions import HTTPException
 
 from app.app import app
+from app.helpers.dynamo_db import entry_cache
 from app.helpers.dynamo_db import get_db
+from app.helpers.dynamo_db import is_local_index
+from app.helpers.utils import URL_INVALID
+from app.helpers.utils import URL_NOT_ALLOWED
+from app.helpers.utils import URL_VALID
+from app.helpers.utils import check_url
+from app.helpers.utils import get_shortlink_etag
 from app.helpers.utils import get_url
+from app.helpers.utils import is_shortlink_etag
+from app.helpers.utils import url_verdict_cache
+from app.settings import COLLISION_MAX_RETRY
 from tests.unit_tests.base import BaseShortlinkTestCase
 
 logger = logging.getLogger(__name__)
@@ -15,6 +25,10 @@ logger = logging.getLogger(__name__)
 
 class TestUrlCheck(unittest.TestCase):
 
+    def setUp(self):
+        super().setUp()
+        url_verdict_cache.clear()
+
     def test_check_params_ok_http(self):
         url_input = 'http://map.geo.admin.ch/enclume'
         with app.test_request_context(json={"url": url_input}):
@@ -63,6 +77,32 @@ class TestUrlCheck(unittest.TestCase):
                 get_url()
                 self.assertEqual(http_error.exception.code, 400)
 
+    def test_check_url_verdicts(self):
+        self.assertEqual(check_url('https://map.geo.admin.ch/?topic=ech'), URL_VALID)
+        self.assertEqual(check_url('https://www.example.com/?topic=ech'), URL_NOT_ALLOWED)
+        self.assertEqual(check_url('test123'), URL_INVALID)
+        self.assertEqual(check_url('https://map.geo.admin.ch:port/'), URL_INVALID)
+        self.assertEqual(check_url('https://map.geo.admin.ch/a b'), URL_INVALID)
+        self.assertEqual(check_url(['https://map.geo.admin.ch']), URL_INVALID)
+
+    @patch('app.helpers.utils.validators.url', return_value=True)
+    def test_check_url_cheapest_first(self, mock_validator):
+        # The syntactic check is only done for allowed domains
+        check_url('https://www.example.com/?topic=ech')
+        mock_validator.assert_not_called()
+        # and only once per URL
+        check_url('https://map.geo.admin.ch/?topic=ech')
+        check_url('https://map.geo.admin.ch/?topic=ech')
+        mock_validator.assert_called_once_with('https://map.geo.admin.ch/?topic=ech')
+
+    @patch('app.helpers.utils.validators.url')
+    def test_check_params_too_long_url_not_validated(self, mock_validator):
+        with app.test_request_context(json={'url': 'https://map.geo.admin.ch/' + 'a' * 2046}):
+            with self.assertRaises(HTTPException) as http_error:
+                get_url()
+            self.assertEqual(http_error.exception.code, 400)
+        mock_validator.assert_not_called()
+
 
 class TestDynamoDb(BaseShortlinkTestCase):
     """
@@ -93,6 +133,79 @@ class TestDynamoDb(BaseShortlinkTestCase):
     def test_check_and_get_shortlinks_id_non_existent(self):
         self.assertEqual(self.db.get_entry_by_url("http://non.existent.url.ch"), None)
 
+    def test_fetch_url_projection(self):
+        for uuid, url in self.uuid_to_url_dict.items():
+            entry = self.db.get_entry_by_shortlink(uuid, consistent_read=True)
+            self.assertEqual(set(entry.keys()), {'shortlink_id', 'url', 'created'})
+            entry = self.db.get_entry_by_url(url, consistent_read=True)
+            self.assertEqual(entry, {'shortlink_id': uuid, 'url': url})
+
+    def test_fetch_url_consistent_read_global_index(self):
+        url = next(iter(self.uuid_to_url_dict.values()))
+        with patch.dict('app.helpers.dynamo_db._local_indexes', {'UrlIndex': False}), \
+            patch.object(self.db.read_table, 'query', wraps=self.db.read_table.query) as mock:
+            self.assertEqual(self.db.get_entry_by_url(url, consistent_read=True)['url'], url)
+        self.assertFalse(mock.call_args.kwargs['ConsistentRead'])
+
+    def test_is_local_index(self):
+        with patch.dict('app.helpers.dynamo_db._local_indexes', clear=True):
+            self.assertTrue(is_local_index('UrlIndex'))
+            with self.assertLogs('app.helpers.dynamo_db', level='WARNING'):
+                self.assertFalse(is_local_index('UrlDigestIndex'))
+
+    @patch('app.helpers.dynamo_db.SHORT_ID_CHECK', True)
+    def test_fetch_url_unknown_id(self):
+        with patch.object(self.db.read_table, 'get_item') as mock_get_item:
+            for short_id in ['nonexistent', 'abc', 'ABCDEFGHIJKL', 'abcdefghijk!', '']:
+                self.assertIsNone(self.db.get_entry_by_shortlink(short_id))
+            mock_get_item.assert_not_called()
+
+    def test_fetch_url_unknown_id_not_checked(self):
+        with patch.object(
+            self.db.read_table, 'get_item', wraps=self.db.read_table.get_item
+        ) as mock_get_item:
+            self.assertIsNone(self.db.get_entry_by_shortlink('abc'))
+            mock_get_item.assert_called_once()
+
+    @patch('app.helpers.dynamo_db.generate_short_id')
+    def test_fetch_url_negative_cache(self, mock_generate_short_id):
+        short_id = 'abcdefghijkl'
+        url = 'https://www.example/test-negative-cache'
+        with patch.object(
+            self.db.read_table, 'get_item', wraps=self.db.read_table.get_item
+        ) as mock_get_item:
+            self.assertIsNone(self.db.get_entry_by_shortlink(short_id))
+            self.assertIsNone(self.db.get_entry_by_shortlink(short_id))
+            self.assertEqual(mock_get_item.call_count, 1)
+            # Legacy ids are looked up
+            self.assertIsNone(self.db.get_entry_by_shortlink('18a0c3f5e2b'))
+            self.assertEqual(mock_get_item.call_count, 2)
+        # Creating the entry invalidates the negative cache
+        mock_generate_short_id.return_value = short_id
+        self.db.add_url_to_table(url)
+        entry_cache.clear()
+        self.assertEqual(self.db.get_entry_by_shortlink(short_id)['url'], url)
+
+    @patch('app.helpers.dynamo_db.consumed_capacity_counter')
+    def test_consumed_capacity(self, mock_counter):
+        with app.test_request_context('/', method='POST'):
+            self.db.get_entry_by_url('https://www.example/test-consumed-capacity')
+            self.db.add_url_to_table('https://www.example/test-consumed-capacity')
+        operations = [call.args[1] for call in mock_counter.add.call_args_list]
+        self.assertEqual(
+            operations,
+            [
+                {
+                    'endpoint': 'create_shortlink', 'operation': 'Query'
+                },
+                {
+                    'endpoint': 'create_shortlink', 'operation': 'PutItem'
+                },
+            ]
+        )
+        for call in mock_counter.add.call_args_list:
+            self.assertGreater(call.args[0], 0)
+
     @patch('app.helpers.dynamo_db.generate_short_id')
     def test_duplicate_short_id_max_retry(self, mock_generate_short_id):
         mock_generate_short_id.return_value = '1'
@@ -102,8 +215,9 @@ class TestDynamoDb(BaseShortlinkTestCase):
         self.assertEqual(entry1['shortlink_id'], '1')
         with self.assertRaises(
             self.db.table.meta.client.exceptions.ConditionalCheckFailedException
-        ):
+        ), patch('app.helpers.dynamo_db.collision_retries_histogram') as mock_histogram:
             self.db.add_url_to_table(url2)
+        mock_histogram.record.assert_called_once_with(COLLISION_MAX_RETRY, {'result': 'failed'})
 
     @patch('app.helpers.dynamo_db.generate_short_id')
     def test_one_duplicate_short_id(self, mock_generate_short_id):
@@ -114,5 +228,37 @@ class TestDynamoDb(BaseShortlinkTestCase):
         url2 = 'https://www.example/test-one-duplicate-id-second-url'
         entry1 = self.db.add_url_to_table(url1)
         self.assertEqual(entry1['shortlink_id'], '2')
-        entry2 = self.db.add_url_to_table(url2)
+        with patch('app.helpers.dynamo_db.collision_retries_histogram') as mock_histogram, \
+            patch('app.helpers.dynamo_db.collisions_counter') as mock_counter:
+            entry2 = self.db.add_url_to_table(url2)
         self.assertEqual(entry2['shortlink_id'], '3')
+        mock_histogram.record.assert_called_once_with(1, {'result': 'created'})
+        mock_counter.add.assert_called_once_with(1, {'table': 'table'})
+
+
+class TestShortlinkEtag(unittest.TestCase):
+
+    @patch('app.helpers.utils.ETAG_SECRET', 'secret')
+    def test_signed_shortlink_etag(self):
+        etag = get_shortlink_etag('abcdef123456', '2024-01-01T00:00:00.000+00:00')
+        self.assertTrue(etag.startswith('abcdef123456-'))
+        self.assertTrue(is_shortlink_etag('abcdef123456', etag))
+        self.assertFalse(is_shortlink_etag('abcdef123457', etag))
+        self.assertFalse(is_shortlink_etag('abcdef123456', 'abcdef123456-0000000000000000'))
+        with patch('app.helpers.utils.ETAG_SECRET', 'other-secret'):
+            self.assertFalse(is_shortlink_etag('abcdef123456', etag))
+
+    def test_shortlink_etag(self):
+        etag = get_shortlink_etag('abcdef123456', '2024-01-01T00:00:00.000+00:00')
+        self.assertNotIn('abcdef123456', etag)
+        # Without secret the ETags are never validated without the DB entry
+        self.assertFalse(is_shortlink_etag('abcdef123456', etag))
+        self.assertNotEqual(
+            etag, get_shortlink_etag('abcdef123456', '2024-01-01T00:00:00.001+00:00')
+        )
+
+    @patch('app.helpers.utils.ETAG_SECRET', 'secret')
+    def test_shortlink_etag_unsafe_id(self):
+        etag = get_shortlink_etag('abc"def', '2024-01-01T00:00:00.000+00:00')
+        self.assertNotIn('abc', etag)
+        self.assertFalse(is_shortlink_etag('abc"def', etag))
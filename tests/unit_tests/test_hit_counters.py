@@ -0,0 +1,102 @@
+import unittest
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import gevent
+
+from flask import url_for
+
+from app.helpers.dynamo_db import add_hits
+from app.helpers.hit_counters import HitCounters
+from app.helpers.resilience import CircuitOpenError
+from tests.unit_tests.base import BaseShortlinkTestCase
+
+
+class TestHitCounters(unittest.TestCase):
+
+    def setUp(self):
+        self.update = MagicMock(return_value=True)
+        self.hit_counters = HitCounters(self.update, flush_interval=60, max_keys=3)
+        self.addCleanup(self.hit_counters.stop)
+
+    def test_flush(self):
+        for short_id in ['a', 'b', 'a']:
+            self.hit_counters.add(short_id)
+        self.assertEqual(self.hit_counters.pending('a'), 2)
+        self.assertFalse(self.hit_counters.flush_event.is_set())
+        self.hit_counters.add('c')
+        self.assertTrue(self.hit_counters.flush_event.is_set())
+
+        self.hit_counters.flush()
+        self.assertEqual([call.args for call in self.update.call_args_list], [('a', 2), ('b', 1),
+                                                                              ('c', 1)])
+        self.assertEqual(self.hit_counters.pending('a'), 0)
+
+    def test_flush_failure(self):
+        for short_id in ['a', 'b', 'b', 'c']:
+            self.hit_counters.add(short_id)
+        # 'a' not yet in DynamoDB, then DynamoDB not available
+        self.update.side_effect = [False, CircuitOpenError('dynamodb', 10)]
+        self.hit_counters.flush()
+        self.assertEqual(self.update.call_count, 2)
+        self.assertEqual(self.hit_counters.counts, {'a': 1, 'b': 2, 'c': 1})
+
+        # The memory is bounded
+        self.update.side_effect = None
+        self.hit_counters.counts = {'d': 1}
+        self.hit_counters.requeue({'a': 1, 'b': 2, 'c': 1})
+        self.assertEqual(self.hit_counters.counts, {'d': 1, 'a': 1, 'b': 2})
+
+    def test_max_keys(self):
+        for short_id in ['a', 'b', 'c', 'd', 'a']:
+            self.hit_counters.add(short_id)
+        # The hits of new shortlinks are dropped until the flush
+        self.assertEqual(self.hit_counters.counts, {'a': 2, 'b': 1, 'c': 1})
+        self.hit_counters.flush()
+        self.hit_counters.add('d')
+        self.assertEqual(self.hit_counters.counts, {'d': 1})
+
+    def test_run_survives_errors(self):
+        self.update.side_effect = [ValueError('unexpected'), True]
+        self.hit_counters.flush_interval = 0
+        self.hit_counters.add('a')
+        gevent.sleep(0.01)
+        self.assertFalse(self.hit_counters.greenlet.dead)
+        self.assertEqual(self.update.call_count, 2)
+        self.assertEqual(self.hit_counters.pending('a'), 0)
+
+
+class TestHitCountersRoutes(BaseShortlinkTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.hit_counters = HitCounters(add_hits, flush_interval=60, max_keys=100)
+        for patcher in (
+            patch('app.helpers.hit_counters.hit_counters', self.hit_counters),
+            patch('app.routes.HIT_COUNTERS', True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.hit_counters.stop)
+
+    def test_hits(self):
+        short_id, other_short_id, *_ = self.uuid_to_url_dict.keys()
+        for _ in range(2):
+            self.app.get(url_for('get_shortlink', shortlink_id=short_id))
+        response = self.get_info(short_id)
+        self.assertEqual(response.json['hits'], 3)
+        etag = response.headers['ETag']
+
+        self.hit_counters.flush()
+        self.assertEqual(self.hit_counters.pending(short_id), 0)
+        self.assertEqual(self.table.get_item(Key={'shortlink_id': short_id})['Item']['hits'], 3)
+        self.assertNotIn('hits', self.table.get_item(Key={'shortlink_id': other_short_id})['Item'])
+
+        # The ETag changes with the hits
+        response = self.get_info(short_id, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['hits'], 4)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_hits_not_yet_written(self):
+        self.assertFalse(add_hits('abcdefghijkl', 1))
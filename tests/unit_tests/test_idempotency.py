@@ -0,0 +1,147 @@
+import unittest
+from unittest.mock import patch
+
+import gevent
+from nose2.tools import params
+
+from flask import url_for
+
+from app.helpers.idempotency import PENDING
+from app.helpers.idempotency import IdempotencyStore
+from app.helpers.idempotency import SharedIdempotencyStore
+from app.helpers.idempotency import get_request_fingerprint
+from tests.unit_tests.base import BaseShortlinkTestCase
+
+URL = 'https://map.geo.admin.ch/?topic=ech&lang=fr'
+
+
+class TestIdempotencyStore(unittest.TestCase):
+
+    @params(IdempotencyStore, SharedIdempotencyStore)
+    def test_complete_and_replay(self, store_class):
+        store = store_class(10, ttl=60, wait_timeout=1)
+        self.assertIsNone(store.begin('key', 'fingerprint'))
+        store.complete('key', 'fingerprint', 201, 'abcdefghijkl')
+        self.assertEqual(store.begin('key', 'fingerprint'), ('fingerprint', 201, 'abcdefghijkl'))
+        self.assertIsNone(store.begin('other-key', 'fingerprint'))
+
+    @params(IdempotencyStore, SharedIdempotencyStore)
+    def test_expired(self, store_class):
+        store = store_class(10, ttl=-1, wait_timeout=1)
+        self.assertIsNone(store.begin('key', 'fingerprint'))
+        store.complete('key', 'fingerprint', 201, 'abcdefghijkl')
+        self.assertIsNone(store.begin('key', 'fingerprint'))
+
+    @params(IdempotencyStore, SharedIdempotencyStore)
+    def test_release(self, store_class):
+        store = store_class(10, ttl=60, wait_timeout=0)
+        self.assertIsNone(store.begin('key', 'fingerprint'))
+        self.assertEqual(store.begin('key', 'fingerprint'), ('fingerprint', PENDING, ''))
+        store.release('key')
+        self.assertIsNone(store.begin('key', 'fingerprint'))
+
+    @params(IdempotencyStore, SharedIdempotencyStore)
+    def test_concurrent_duplicate_waits(self, store_class):
+        store = store_class(10, ttl=60, wait_timeout=1)
+        self.assertIsNone(store.begin('key', 'fingerprint'))
+        duplicate = gevent.spawn(store.begin, 'key', 'fingerprint')
+        gevent.sleep(0.05)
+        self.assertFalse(duplicate.ready())
+        store.complete('key', 'fingerprint', 201, 'abcdefghijkl')
+        self.assertEqual(duplicate.get(timeout=1), ('fingerprint', 201, 'abcdefghijkl'))
+
+    def test_shared_lock_does_not_block_the_worker(self):
+        store = SharedIdempotencyStore(10, ttl=60, wait_timeout=1)
+        store.lock.acquire()  # pylint: disable=consider-using-with
+        claim = gevent.spawn(store.begin, 'key', 'fingerprint')
+        gevent.sleep(0.01)
+        # The greenlet waits for the lock (held by another worker) without blocking the hub
+        self.assertFalse(claim.ready())
+        store.lock.release()
+        self.assertIsNone(claim.get(timeout=1))
+
+    def test_max_keys(self):
+        store = IdempotencyStore(2, ttl=60, wait_timeout=1)
+        for key in ['a', 'b', 'c']:
+            store.begin(key, 'fingerprint')
+            store.complete(key, 'fingerprint', 201, key)
+        self.assertEqual(list(store.records), ['b', 'c'])
+
+
+class TestIdempotentCreate(BaseShortlinkTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.store = IdempotencyStore(10, ttl=60, wait_timeout=0.1)
+        patcher = patch('app.helpers.idempotency.idempotency_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create(self, url=URL, key='key'):
+        return self.app.post(
+            url_for('create_shortlink'),
+            json={"url": url},
+            headers={
+                "Origin": "https://map.geo.admin.ch", "Idempotency-Key": key
+            }
+        )
+
+    def test_replay(self):
+        response = self.create()
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        with patch('app.helpers.dynamo_db.DynamoDB.get_entry_by_url') as mock_get_entry, \
+            patch('app.routes.get_url') as mock_get_url:
+            replayed = self.create()
+            mock_get_entry.assert_not_called()
+            mock_get_url.assert_not_called()
+        self.assertEqual(replayed.status_code, 201)
+        self.assertEqual(replayed.json, response.json)
+        self.assertEqual(replayed.headers['Idempotent-Replayed'], 'true')
+        self.assertCors(replayed, ['POST', 'OPTIONS'])
+
+        # Without key the existing shortlink is returned
+        response = self.app.post(
+            url_for('create_shortlink'),
+            json={"url": URL},
+            headers={"Origin": "https://map.geo.admin.ch"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, replayed.json)
+
+    def test_key_scoped_by_client(self):
+        self.assertEqual(self.create().status_code, 201)
+        response = self.app.post(
+            url_for('create_shortlink'),
+            json={"url": URL},
+            headers={
+                "Origin": "https://map.geo.admin.ch", "Idempotency-Key": 'key'
+            },
+            environ_base={'REMOTE_ADDR': '192.0.2.1'}
+        )
+        # Processed as a new request of the other client
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+
+    def test_key_reused_with_another_url(self):
+        self.assertEqual(self.create().status_code, 201)
+        response = self.create(url='https://map.geo.admin.ch/?topic=ech&lang=de')
+        self.assertEqual(response.status_code, 422)
+
+    def test_pending_request_conflict(self):
+        self.store.begin('127.0.0.1 key', self.store_fingerprint())
+        response = self.create()
+        self.assertEqual(response.status_code, 409)
+
+    def test_failed_request_retried(self):
+        response = self.create(url='not an url')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.store.records, {})
+
+    def test_key_too_long(self):
+        response = self.create(key='k' * 256)
+        self.assertEqual(response.status_code, 400)
+
+    def store_fingerprint(self):
+        with self.app.application.test_request_context(json={"url": URL}):
+            return get_request_fingerprint()
@@ -0,0 +1,80 @@
+import logging
+import unittest
+
+from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import NotFound
+
+from app.helpers.logging_filters import DeduplicationFilter
+
+
+def make_record(msg, *args, name='app.test', level=logging.ERROR, created=0.0, **extra):
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    record.created = created
+    record.__dict__.update(extra)
+    return record
+
+
+class TestDeduplicationFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.filter = DeduplicationFilter(window=10, level='WARNING', max_keys=2)
+
+    def test_deduplicate_by_template(self):
+        self.assertTrue(self.filter.filter(make_record('Not found: %s', 'a')))
+        self.assertFalse(self.filter.filter(make_record('Not found: %s', 'b', created=1)))
+        self.assertFalse(self.filter.filter(make_record('Not found: %s', 'c', created=9)))
+        # Other logger or template
+        self.assertTrue(self.filter.filter(make_record('Not found: %s', 'a', name='app.other')))
+        self.assertTrue(self.filter.filter(make_record('Denied: %s', 'a', created=1)))
+
+    def test_summary_after_window(self):
+        self.filter.filter(make_record('Not found: %s', 'a'))
+        self.filter.filter(make_record('Not found: %s', 'b', created=1))
+        self.filter.filter(make_record('Not found: %s', 'c', created=2))
+        with self.assertLogs('app.test', level='ERROR') as logs:
+            # Any record after the window, even of another key or level
+            self.assertTrue(
+                self.filter.filter(make_record('Request', level=logging.INFO, created=10))
+            )
+        self.assertEqual(
+            logs.output,
+            ['ERROR:app.test:Not found: %s [2 similar messages suppressed in the last 10s]']
+        )
+        self.assertEqual(len(self.filter.keys), 0)
+        record = make_record('Not found: %s', 'd', created=10)
+        self.assertTrue(self.filter.filter(record))
+        self.assertEqual(record.getMessage(), 'Not found: d')
+
+    def test_no_summary_without_suppressed_records(self):
+        self.filter.filter(make_record('Not found: %s', 'a'))
+        with self.assertNoLogs('app.test'):
+            self.filter.filter(make_record('Not found: %s', 'b', created=20))
+
+    def test_deduplicate_exceptions(self):
+        self.assertTrue(self.filter.filter(make_record(NotFound('No short url found for a'))))
+        self.assertFalse(self.filter.filter(make_record(NotFound('No short url found for b'))))
+        self.assertTrue(self.filter.filter(make_record(BadRequest('Invalid id b'))))
+
+    def test_key_fields(self):
+        dedup = DeduplicationFilter(key_fields=['flask_request_path'])
+        self.assertTrue(dedup.filter(make_record('Denied', flask_request_path='/a')))
+        self.assertTrue(dedup.filter(make_record('Denied', flask_request_path='/b')))
+        self.assertFalse(dedup.filter(make_record('Denied', flask_request_path='/a')))
+
+    def test_lower_levels_not_deduplicated(self):
+        for _ in range(3):
+            self.assertTrue(self.filter.filter(make_record('Request', level=logging.INFO)))
+
+    def test_decision_shared_by_handlers(self):
+        record = make_record('Not found: %s', 'a')
+        self.assertTrue(self.filter.filter(record))
+        # Same record filtered by the next handler
+        self.assertTrue(self.filter.filter(record))
+        self.assertFalse(self.filter.filter(make_record('Not found: %s', 'a')))
+
+    def test_max_keys(self):
+        for template in ['a', 'b', 'c']:
+            self.filter.filter(make_record(template))
+        self.assertEqual(len(self.filter.keys), 2)
+        # The oldest key has been evicted
+        self.assertTrue(self.filter.filter(make_record('a')))
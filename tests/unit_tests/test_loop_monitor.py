@@ -0,0 +1,41 @@
+import time
+import unittest
+
+import gevent
+
+from app.helpers.loop_monitor import LoopMonitor
+
+
+def block_hub(duration):
+    # Not monkey patched, therefore blocks the hub
+    time.sleep(duration)
+
+
+class TestLoopMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.monitor = LoopMonitor(interval=0.01, blocking_threshold=0.05)
+        self.addCleanup(self.monitor.stop)
+
+    def test_percentiles(self):
+        self.assertEqual(self.monitor.percentiles(), {})
+        for lag in range(100):
+            self.monitor.record_lag(lag / 1000)
+        self.assertEqual(self.monitor.percentiles(), {50: 0.05, 95: 0.095, 99: 0.099})
+
+    def test_loop_lag(self):
+        self.monitor.start()
+        gevent.sleep(0.05)
+        block_hub(0.1)
+        gevent.sleep(0.05)
+        self.assertGreaterEqual(max(self.monitor.lags), 0.05)
+
+    def test_blocking_greenlet_logged(self):
+        self.monitor.start()
+        gevent.sleep(0.05)
+        with self.assertLogs('app.helpers.loop_monitor', level='WARNING') as logs:
+            greenlet = gevent.spawn(block_hub, 0.3)
+            greenlet.join()
+            gevent.sleep(0.05)
+        self.assertIn('blocked the gevent hub for more than 0.050s', logs.output[0])
+        self.assertIn('block_hub', logs.output[0])
@@ -0,0 +1,132 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from flask import url_for
+
+from app.helpers.profiler import SamplingProfiler
+from tests.unit_tests.base import BaseShortlinkTestCase
+
+TOKEN = 'secret'
+
+
+def busy_loop(duration=0.2):
+    started = time.process_time()
+    while time.process_time() - started < duration:
+        pass
+
+
+class TestSamplingProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.directory.cleanup)
+
+    def create_profiler(self, **kwargs):
+        profiler = SamplingProfiler(
+            self.directory.name,
+            **{
+                'sample_rate': 0,
+                'header': 'X-Shortlink-Profile',
+                'token': TOKEN,
+                'interval': 0.001,
+                'max_overhead': 0.5,
+                'flush_interval': 60,
+                'max_disk': 1024 * 1024,
+                'max_stacks': 100,
+                **kwargs
+            }
+        )
+        self.addCleanup(profiler.stop)
+        return profiler
+
+    def profile(self, profiler, endpoint='endpoint'):
+        self.assertTrue(profiler.start_request(endpoint, {'X-Shortlink-Profile': TOKEN}))
+        busy_loop()
+        profiler.stop_request()
+
+    def test_request_selection(self):
+        profiler = self.create_profiler()
+        self.assertFalse(profiler.start_request('endpoint', {}))
+        self.assertFalse(profiler.start_request('endpoint', {'X-Shortlink-Profile': 'wrong'}))
+        self.assertTrue(profiler.start_request('endpoint', {'X-Shortlink-Profile': TOKEN}))
+        profiler.stop_request()
+        self.assertFalse(profiler.armed)
+
+        profiler = self.create_profiler(sample_rate=1, token='')
+        self.assertTrue(profiler.start_request('endpoint', {'X-Shortlink-Profile': ''}))
+        profiler.stop_request()
+
+    def test_collapsed_stacks(self):
+        profiler = self.create_profiler()
+        self.profile(profiler)
+        profiler.flush()
+        path = Path(self.directory.name) / f'endpoint-{profiler.pid}.folded'
+        lines = path.read_text(encoding='utf-8').splitlines()
+        self.assertGreater(len(lines), 0)
+        stacks = dict(line.rsplit(' ', 1) for line in lines)
+        self.assertTrue(any('busy_loop (test_profiler.py:' in stack for stack in stacks))
+        # Root frame first
+        self.assertTrue(
+            all(stack.index('profile ') < stack.index('busy_loop ') for stack in stacks)
+        )
+
+    def test_max_stacks(self):
+        profiler = self.create_profiler(max_stacks=1)
+        self.profile(profiler)
+        self.assertLessEqual(len(profiler.stacks['endpoint']), 2)
+
+    def test_overhead_cap(self):
+        profiler = self.create_profiler(max_overhead=0)
+        self.assertTrue(profiler.start_request('endpoint', {'X-Shortlink-Profile': TOKEN}))
+        busy_loop()
+        # The first sample exceeded the overhead budget
+        self.assertEqual(profiler.active, {})
+        self.assertFalse(profiler.armed)
+        self.assertFalse(profiler.start_request('endpoint', {'X-Shortlink-Profile': TOKEN}))
+
+    def test_default_directory(self):
+        profiler = self.create_profiler()
+        profiler.configured_directory = ''
+        with patch.dict('os.environ', {'LOGS_DIR': self.directory.name}):
+            profiler.start()
+        self.assertEqual(profiler.directory, Path(self.directory.name) / 'profiles')
+
+    def test_disk_cap(self):
+        profiler = self.create_profiler(max_disk=10)
+        self.profile(profiler)
+        profiler.flush()
+        self.assertEqual(list(Path(self.directory.name).glob('*.folded')), [])
+
+
+class TestProfilerHooks(BaseShortlinkTestCase):
+
+    def test_profile_request(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = SamplingProfiler(
+                directory,
+                sample_rate=0,
+                header='X-Shortlink-Profile',
+                token=TOKEN,
+                interval=0.001,
+                max_overhead=0.5,
+                flush_interval=60,
+                max_disk=1024 * 1024,
+                max_stacks=100
+            )
+            with patch('app.app.profiler', profiler), \
+                patch.object(profiler, 'start_request', wraps=profiler.start_request) as mock_start:
+                response = self.app.get(
+                    url_for('checker'),
+                    headers={
+                        'X-Shortlink-Profile': TOKEN, 'Origin': 'https://map.geo.admin.ch'
+                    }
+                )
+                self.assertEqual(response.status_code, 200)
+                mock_start.assert_called_once()
+                self.assertEqual(mock_start.call_args.args[0], 'checker')
+            self.assertEqual(profiler.active, {})
+            self.assertFalse(profiler.armed)
+            profiler.stop()
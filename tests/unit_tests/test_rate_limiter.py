@@ -0,0 +1,103 @@
+import unittest
+from unittest.mock import patch
+
+from flask import url_for
+
+from app.app import app
+from app.helpers.rate_limiter import SharedTokenBucketRateLimiter
+from app.helpers.rate_limiter import TokenBucketRateLimiter
+from app.helpers.rate_limiter import get_client_ip
+from tests.unit_tests.base import BaseShortlinkTestCase
+
+
+class TestTokenBucketRateLimiter(unittest.TestCase):
+
+    def assert_bucket(self, limiter):
+        # The burst is allowed
+        self.assertEqual(limiter.acquire('client-1', now=100), 0)
+        self.assertEqual(limiter.acquire('client-1', now=100), 0)
+        # Then the client has to wait for a new token
+        self.assertAlmostEqual(limiter.acquire('client-1', now=100), 2)
+        self.assertAlmostEqual(limiter.acquire('client-1', now=101), 1)
+        self.assertEqual(limiter.acquire('client-1', now=102), 0)
+        # Other clients are not affected
+        self.assertEqual(limiter.acquire('client-2', now=102), 0)
+
+    def test_token_bucket(self):
+        self.assert_bucket(TokenBucketRateLimiter(rate=0.5, burst=2, max_clients=10))
+
+    def test_token_bucket_bounded_clients(self):
+        limiter = TokenBucketRateLimiter(rate=0.5, burst=1, max_clients=2)
+        for i in range(10):
+            limiter.acquire(f'client-{i}', now=100)
+        self.assertEqual(len(limiter.buckets), 2)
+        self.assertEqual(list(limiter.buckets.keys()), ['client-8', 'client-9'])
+
+    def test_shared_token_bucket(self):
+        self.assert_bucket(SharedTokenBucketRateLimiter(rate=0.5, burst=2, max_clients=10))
+
+
+class TestClientIp(unittest.TestCase):
+
+    def test_client_ip_forwarded(self):
+        with app.test_request_context(
+            environ_base={'REMOTE_ADDR': '10.0.0.1'},
+            headers={'X-Forwarded-For': '192.0.2.1, 10.0.0.2'}
+        ):
+            with patch('app.helpers.rate_limiter.FORWARDED_ALLOW_IPS', ['10.0.0.0/8']):
+                self.assertEqual(get_client_ip(), '192.0.2.1')
+            with patch('app.helpers.rate_limiter.FORWARDED_ALLOW_IPS', ['*']), \
+                patch('app.helpers.rate_limiter.FORWARDED_TRUSTED_HOPS', 2):
+                self.assertEqual(get_client_ip(), '192.0.2.1')
+
+    def test_client_ip_forwarded_any_proxy(self):
+        # The left most addresses are set by the client
+        with app.test_request_context(
+            environ_base={'REMOTE_ADDR': '10.0.0.1'},
+            headers={'X-Forwarded-For': '198.51.100.1, 192.0.2.1'}
+        ):
+            with patch('app.helpers.rate_limiter.FORWARDED_ALLOW_IPS', ['*']):
+                self.assertEqual(get_client_ip(), '192.0.2.1')
+                with patch('app.helpers.rate_limiter.FORWARDED_TRUSTED_HOPS', 5):
+                    self.assertEqual(get_client_ip(), '198.51.100.1')
+            with patch('app.helpers.rate_limiter.FORWARDED_ALLOW_IPS', ['10.0.0.0/8']):
+                self.assertEqual(get_client_ip(), '192.0.2.1')
+
+    def test_client_ip_all_hops_trusted(self):
+        with app.test_request_context(
+            environ_base={'REMOTE_ADDR': '10.0.0.1'}, headers={'X-Forwarded-For': '10.0.0.2'}
+        ):
+            with patch('app.helpers.rate_limiter.FORWARDED_ALLOW_IPS', ['10.0.0.0/8']):
+                self.assertEqual(get_client_ip(), '10.0.0.1')
+
+    def test_client_ip_untrusted_proxy(self):
+        with app.test_request_context(
+            environ_base={'REMOTE_ADDR': '192.0.2.10'}, headers={'X-Forwarded-For': '192.0.2.1'}
+        ):
+            with patch('app.helpers.rate_limiter.FORWARDED_ALLOW_IPS', ['10.0.0.0/8']):
+                self.assertEqual(get_client_ip(), '192.0.2.10')
+
+
+class TestCreateRateLimit(BaseShortlinkTestCase):
+
+    @patch(
+        'app.helpers.rate_limiter.create_rate_limiter',
+        TokenBucketRateLimiter(rate=0.1, burst=2, max_clients=10)
+    )
+    def test_create_shortlink_rate_limited(self):
+        for i in range(2):
+            response = self.app.post(
+                url_for('create_shortlink'),
+                json={"url": f"https://map.geo.admin.ch/?rate-limit={i}"},
+                headers={"Origin": "https://map.geo.admin.ch"}
+            )
+            self.assertEqual(response.status_code, 201)
+        response = self.app.post(
+            url_for('create_shortlink'),
+            json={"url": "https://map.geo.admin.ch/?rate-limit=3"},
+            headers={"Origin": "https://map.geo.admin.ch"}
+        )
+        self.assertEqual(response.status_code, 429)
+        self.assertCors(response, ['POST', 'OPTIONS'])
+        self.assertEqual(response.headers['Retry-After'], '10')
+        self.assertEqual(response.json['error']['code'], 429)
@@ -0,0 +1,115 @@
+import json
+import os
+import tempfile
+import threading
+
+from werkzeug.serving import make_server
+
+from app.app import app
+from scripts.replay_traffic import Replay
+from scripts.replay_traffic import parse_record
+from scripts.replay_traffic import percentile
+from scripts.replay_traffic import read_requests
+from tests.unit_tests.base import BaseShortlinkTestCase
+
+ORIGIN = 'https://map.geo.admin.ch'
+
+
+def log_record(method, path, status_code, time='2024-06-10T12:00:00.000000Z', **kwargs):
+    '''Returns a record of the JSON access logs'''
+    return {
+        'time': time,
+        'level': 'INFO',
+        'logger': 'app.app',
+        'request': {
+            'path': path,
+            'method': method,
+            'headers': {
+                'Origin': ORIGIN, 'Host': 's.geo.admin.ch'
+            },
+            **kwargs.get('request', {})
+        },
+        'response': {
+            'statusCode': status_code, 'duration': '0.01', **kwargs.get('response', {})
+        },
+        'message': f'{method} {path} - {status_code}'
+    }
+
+
+class TestReplayRecords(BaseShortlinkTestCase):
+
+    def test_parse_log_record(self):
+        request = parse_record(
+            log_record(
+                'POST',
+                '/',
+                201,
+                request={'payload': "{'url': 'https://map.geo.admin.ch/?topic=ech'}"}
+            )
+        )
+        self.assertEqual(request['method'], 'POST')
+        self.assertEqual(request['json'], {'url': 'https://map.geo.admin.ch/?topic=ech'})
+        self.assertEqual(request['status_code'], 201)
+        self.assertAlmostEqual(request['time'], 1718020800 - 0.01)
+        # Not an access log record
+        self.assertIsNone(parse_record({'message': 'Started', 'request': {}}))
+
+    def test_parse_truncated_payload(self):
+        with self.assertRaises(ValueError):
+            parse_record(
+                log_record('POST', '/', 201, request={'payload': "{'url': 'https://map.geo"})
+            )
+
+    def test_parse_request_record(self):
+        request = parse_record({'method': 'GET', 'path': '/abc'})
+        self.assertEqual(request['headers'], {})
+        self.assertIsNone(request['time'])
+        self.assertIsNone(parse_record({'path': '/abc'}))
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99.9), 100)
+        self.assertIsNone(percentile([], 50))
+
+    def test_replay(self):
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.shutdown)
+
+        short_id, url = next(iter(self.uuid_to_url_dict.items()))
+        records = [
+            log_record(
+                'GET',
+                f'/{short_id}',
+                301,
+                time='2024-06-10T12:00:00.000000Z',
+                response={'headers': {
+                    'Location': url
+                }}
+            ),
+            log_record('GET', '/checker', 200, time='2024-06-10T12:00:00.050000Z'),
+            log_record('GET', '/abcdefghijkl', 301, time='2024-06-10T12:00:00.100000Z'),
+            {
+                'time': '2024-06-10T12:00:01.000000Z', 'message': 'Not an access log'
+            },
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'logs.json')
+            with open(path, 'w', encoding='utf-8') as fd:
+                for record in records:
+                    fd.write(json.dumps(record) + '\n')
+                fd.write('invalid\n')
+            skipped = {'skipped': 0}
+            replay = Replay(f'http://127.0.0.1:{server.server_port}', concurrency=2)
+            report = replay.run(read_requests([path], skipped), speed=10)
+
+        self.assertEqual(skipped['skipped'], 1)
+        self.assertEqual(report['requests'], 3)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(report['statuses'], {301: 1, 200: 1, 404: 1})
+        self.assertEqual(report['diffs'], {'status': 1})
+        self.assertIn('GET /abcdefghijkl: status 301 != 404', report['diff_examples'])
+        self.assertGreaterEqual(report['duration'], 0.01)
+        self.assertIsNotNone(report['latency']['p99'])
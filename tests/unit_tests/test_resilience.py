@@ -0,0 +1,161 @@
+import time
+import unittest
+from unittest.mock import patch
+
+from botocore.exceptions import ClientError
+from botocore.exceptions import ReadTimeoutError
+from gevent import GreenletExit
+
+from flask import url_for
+
+from app.helpers.cache import LRUCache
+from app.helpers.dynamo_db import entry_cache
+from app.helpers.resilience import CLOSED
+from app.helpers.resilience import OPEN
+from app.helpers.resilience import CircuitBreaker
+from app.helpers.resilience import CircuitOpenError
+from app.helpers.resilience import dynamodb_background_circuit_breaker
+from app.helpers.resilience import dynamodb_circuit_breaker
+from tests.unit_tests.base import BaseShortlinkTestCase
+
+
+def client_error(code, operation):
+    error_response = {'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': 400}}
+    return ClientError(error_response, operation)
+
+
+def throttled_call():
+    raise client_error('ProvisionedThroughputExceededException', 'GetItem')
+
+
+def failing_call():
+    raise ReadTimeoutError(endpoint_url='http://localhost')
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    @patch('app.helpers.cache.time.monotonic')
+    def test_ttl(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        cache = LRUCache(2, ttl=10)
+        cache.set('a', 1)
+        mock_monotonic.return_value = 111
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('a', stale=True), 1)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(
+            'test', failure_rate=0.5, min_calls=4, window=10, open_duration=5
+        )
+
+    def test_circuit_opens_on_failure_rate(self):
+        self.breaker.call(lambda: None)
+        self.breaker.call(lambda: None)
+        for _ in range(2):
+            with self.assertRaises(ReadTimeoutError):
+                self.breaker.call(failing_call)
+        self.assertEqual(self.breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError) as context:
+            self.breaker.call(lambda: None)
+        self.assertGreaterEqual(context.exception.retry_after, 1)
+
+    def test_business_errors_do_not_open_circuit(self):
+
+        def conditional_check_failed():
+            raise client_error('ConditionalCheckFailedException', 'PutItem')
+
+        for _ in range(10):
+            with self.assertRaises(ClientError):
+                self.breaker.call(conditional_check_failed)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    @patch('app.helpers.resilience.time.monotonic')
+    def test_half_open(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        for _ in range(4):
+            with self.assertRaises(ClientError):
+                self.breaker.call(throttled_call)
+        self.assertEqual(self.breaker.state, OPEN)
+
+        # Failed trial call re-opens the circuit
+        mock_monotonic.return_value = 106
+        with self.assertRaises(ReadTimeoutError):
+            self.breaker.call(failing_call)
+        self.assertEqual(self.breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.call(lambda: None)
+
+        # Successful trial call closes the circuit
+        mock_monotonic.return_value = 112
+        self.assertEqual(self.breaker.call(lambda: 'ok'), 'ok')
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    @patch('app.helpers.resilience.time.monotonic')
+    def test_half_open_trial_interrupted(self, mock_monotonic):
+
+        def interrupted_call():
+            raise GreenletExit()
+
+        mock_monotonic.return_value = 100
+        self.breaker.open(100)
+        mock_monotonic.return_value = 106
+        with self.assertRaises(GreenletExit):
+            self.breaker.call(interrupted_call)
+        self.assertFalse(self.breaker.trial_running)
+        # The next trial call is let through
+        self.assertEqual(self.breaker.call(lambda: 'ok'), 'ok')
+        self.assertEqual(self.breaker.state, CLOSED)
+
+
+class TestStaleServe(BaseShortlinkTestCase):
+
+    def open_circuit(self):
+        dynamodb_circuit_breaker.open(time.monotonic())
+
+    def test_redirect_stale_entry_when_circuit_open(self):
+        short_id, url = next(iter(self.uuid_to_url_dict.items()))
+        # Expire the cached entry
+        entry_cache.set(short_id, entry_cache.get(short_id))
+        entry_cache.items[short_id] = (entry_cache.items[short_id][0], 0)
+        self.open_circuit()
+        response = self.app.get(url_for('get_shortlink', shortlink_id=short_id))
+        self.assertRedirects(response, url)
+
+    def test_redirect_not_cached_when_circuit_open(self):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        entry_cache.clear()
+        self.open_circuit()
+        response = self.app.get(url_for('get_shortlink', shortlink_id=short_id))
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+        self.assertCors(response, ['GET', 'HEAD', 'OPTIONS'], all_origin=True)
+        self.assertEqual(response.json['error']['code'], 503)
+
+    def test_create_when_circuit_open(self):
+        self.open_circuit()
+        response = self.app.post(
+            url_for('create_shortlink'),
+            json={"url": "https://map.geo.admin.ch/?circuit=open"},
+            headers={"Origin": "https://map.geo.admin.ch"}
+        )
+        self.assertEqual(response.status_code, 503)
+
+    def test_redirect_when_background_circuit_open(self):
+        short_id, url = next(iter(self.uuid_to_url_dict.items()))
+        entry_cache.clear()
+        dynamodb_background_circuit_breaker.open(time.monotonic())
+        response = self.app.get(url_for('get_shortlink', shortlink_id=short_id))
+        self.assertRedirects(response, url)
@@ -1,11 +1,16 @@
 import logging
 import logging.config
 import re
+from unittest.mock import patch
 
 from nose2.tools import params
 
 from flask import url_for
 
+from app.app import app
+from app.helpers.resilience import CircuitOpenError
+from app.middlewares import ResponseCacheMiddleware
+from app.middlewares import response_cache
 from app.settings import SHORT_ID_ALPHABET
 from app.settings import SHORT_ID_SIZE
 from app.version import APP_VERSION
@@ -240,8 +245,8 @@ class TestRoutes(BaseShortlinkTestCase):
         }
         self.assertEqual(response.status_code, 404)
         self.assertCors(response, ['GET', 'HEAD', 'OPTIONS'], all_origin=True)
-        self.assertIn('Cache-Control', response.headers)
-        self.assertIn('max-age=3600', response.headers['Cache-Control'])
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=60')
+        self.assertEqual(response.headers['Surrogate-Key'], 'nonexistent not_found')
         self.assertIn('application/json', response.content_type)
         self.assertEqual(response.json, expected_json)
 
@@ -285,8 +290,7 @@ class TestRoutes(BaseShortlinkTestCase):
         )
         self.assertEqual(response.status_code, 404)
         self.assertCors(response, ['GET', 'HEAD', 'OPTIONS'])
-        self.assertIn('Cache-Control', response.headers)
-        self.assertIn('max-age=3600', response.headers['Cache-Control'])
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=60')
         self.assertIn('application/json', response.content_type)
         expected_json = {
             'error': {
@@ -423,3 +427,333 @@ class TestRoutes(BaseShortlinkTestCase):
         )
         self.assertEqual(response.status_code, 200)
         self.assertCors(response, ['GET', 'HEAD', 'OPTIONS'])
+
+
+class TestRedirectFastPath(BaseShortlinkTestCase):
+
+    def test_redirect_bypass_flask_dispatch(self):
+        short_id, url = next(iter(self.uuid_to_url_dict.items()))
+        with patch.object(app, 'full_dispatch_request') as mock_dispatch:
+            response = self.app.get(url_for('get_shortlink', shortlink_id=short_id))
+            mock_dispatch.assert_not_called()
+        self.assertRedirects(response, url)
+        self.assertCors(response, ['GET', 'HEAD', 'OPTIONS'], all_origin=True)
+        self.assertEqual(response.headers['Vary'], 'Origin')
+        self.assertEqual(
+            response.headers['Cache-Control'],
+            'public, max-age=31536000, stale-while-revalidate=3600, stale-if-error=604800'
+        )
+        self.assertEqual(response.headers['Surrogate-Key'], f'{short_id} redirect')
+        self.assertEqual(response.content_type, "text/html; charset=utf-8")
+
+    def test_not_found_bypass_flask_dispatch(self):
+        with patch.object(app, 'full_dispatch_request') as mock_dispatch:
+            response = self.app.get(url_for('get_shortlink', shortlink_id='nonexistent'))
+            mock_dispatch.assert_not_called()
+        self.assertEqual(response.status_code, 404)
+        self.assertCors(response, ['GET', 'HEAD', 'OPTIONS'], all_origin=True)
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=60')
+        self.assertEqual(response.headers['Surrogate-Key'], 'nonexistent not_found')
+        self.assertEqual(response.content_type, "application/json; charset=utf-8")
+        self.assertEqual(
+            response.json,
+            {
+                'success': False,
+                'error': {
+                    'code': 404, 'message': "No short url found for nonexistent"
+                }
+            }
+        )
+
+    @params(
+        (ValueError('bug'), 500),
+        (CircuitOpenError('dynamodb', 10), 503),
+    )
+    def test_db_error_not_dispatched_to_flask(self, error, status):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        with patch(
+            'app.helpers.dynamo_db.DynamoDB.get_entry_by_shortlink', side_effect=error
+        ) as db_mock, patch.object(app, 'full_dispatch_request') as dispatch_mock:
+            response = self.app.get(url_for('get_shortlink', shortlink_id=short_id))
+        db_mock.assert_called_once()
+        dispatch_mock.assert_not_called()
+        self.assertEqual(response.status_code, status)
+        self.assertEqual(response.json['error']['code'], status)
+        if status == 503:
+            self.assertEqual(response.headers['Retry-After'], '10')
+        self.assertEqual(response.headers['Cache-Control'], 'no-store')
+        self.assertCors(response, ['GET', 'HEAD', 'OPTIONS'], all_origin=True)
+
+    @params(
+        ('GET', '/checker', {}),
+        ('GET', '/', {}),
+        ('HEAD', '/{short_id}', {}),
+        ('GET', '/{short_id}', {
+            'redirect': 'false'
+        }),
+        ('GET', '/{short_id}', {
+            'redirect': 'banana'
+        }),
+    )
+    def test_fall_through_to_flask(self, method, path, query_string):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        with patch.object(app, 'full_dispatch_request', wraps=app.full_dispatch_request) as mock:
+            self.app.open(
+                path.format(short_id=short_id),
+                method=method,
+                query_string=query_string,
+                headers={"Origin": "https://map.geo.admin.ch"}
+            )
+            mock.assert_called_once()
+
+
+class TestResponseCache(BaseShortlinkTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch.object(app, 'wsgi_app', ResponseCacheMiddleware(app, app.wsgi_app))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, short_id, query_string=None, headers=None):
+        return self.app.get(
+            url_for('get_shortlink', shortlink_id=short_id),
+            query_string=query_string,
+            headers={
+                "Origin": "https://map.geo.admin.ch", **(headers or {})
+            }
+        )
+
+    @params({}, {'redirect': 'false'})
+    def test_replay_cached_response(self, query_string):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        response = self.get(short_id, query_string)
+        self.assertIn(response.status_code, [200, 301])
+        self.assertEqual(len(response_cache), 1)
+        with patch('app.helpers.dynamo_db.DynamoDB.get_entry_by_shortlink') as mock_get_entry, \
+            patch('app.middlewares.record_hit') as mock_record_hit, \
+            self.assertLogs('app.middlewares', level='INFO') as logs:
+            replayed = self.get(short_id, query_string)
+            mock_get_entry.assert_not_called()
+            mock_record_hit.assert_called_once_with(short_id)
+        self.assertEqual(logs.records[-1].response['status_code'], response.status_code)
+        self.assertEqual(logs.records[-1].response['length'], len(response.data))
+        self.assertEqual(replayed.status, response.status)
+        self.assertEqual(replayed.data, response.data)
+        self.assertEqual(list(replayed.headers.items()), list(response.headers.items()))
+
+    def test_cache_key_origin_class(self):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        self.get(short_id, {'redirect': 'false'})
+        response = self.get(
+            short_id, {'redirect': 'false'}, headers={'Origin': 'https://test.geo.admin.ch'}
+        )
+        self.assertEqual(
+            response.headers['Access-Control-Allow-Origin'], 'https://test.geo.admin.ch'
+        )
+        # The redirect response is shared by all origins
+        self.get(short_id)
+        self.get(short_id, headers={'Origin': 'https://test.geo.admin.ch'})
+        self.assertEqual(len(response_cache), 3)
+
+    @params(
+        ({
+            'redirect': 'false'
+        }, {
+            'Origin': 'https://www.example.com'
+        }),
+        ({
+            'redirect': 'false'
+        }, {
+            'If-None-Match': '*'
+        }),
+        ({
+            'redirect': 'banana'
+        }, {}),
+    )
+    def test_not_cached_requests(self, query_string, headers):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        self.get(short_id, query_string, headers)
+        self.assertEqual(len(response_cache), 0)
+
+    def test_not_found_not_cached(self):
+        response = self.get('nonexistent')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(len(response_cache), 0)
+
+    def test_info_not_cached_with_hit_counters(self):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        with patch('app.middlewares.HIT_COUNTERS', True):
+            self.get(short_id, {'redirect': 'false'})
+            self.assertEqual(len(response_cache), 0)
+            self.get(short_id)
+            self.assertEqual(len(response_cache), 1)
+
+
+class TestShortlinkConditionalRequest(BaseShortlinkTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch('app.helpers.utils.ETAG_SECRET', 'secret')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fetch_full_url_from_shortlink_etag(self):
+        for short_id, _ in self.uuid_to_url_dict.items():
+            response = self.get_info(short_id)
+            self.assertEqual(response.status_code, 200)
+            etag, weak = response.get_etag()
+            self.assertFalse(weak)
+            self.assertTrue(etag.startswith(f'{short_id}-'))
+            # The ETag is stable
+            self.assertEqual(self.get_info(short_id).get_etag(), (etag, False))
+
+    def test_fetch_full_url_from_shortlink_not_modified(self):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        etag = self.get_info(short_id).headers['ETag']
+        with patch('app.helpers.dynamo_db.DynamoDB.get_entry_by_shortlink') as mock_get_entry:
+            response = self.get_info(short_id, headers={'If-None-Match': etag})
+            mock_get_entry.assert_not_called()
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertCors(response, ['GET', 'HEAD', 'OPTIONS'])
+        self.assertIn('max-age=', response.headers['Cache-Control'])
+
+    def test_forged_etag(self):
+        with patch('app.routes.record_hit') as mock_record_hit:
+            response = self.get_info(
+                'abcdefghijkl', headers={'If-None-Match': '"abcdefghijkl-0000000000000000"'}
+            )
+            mock_record_hit.assert_not_called()
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=60')
+
+    def test_not_modified_without_secret(self):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        with patch('app.helpers.utils.ETAG_SECRET', ''):
+            etag = self.get_info(short_id).headers['ETag']
+            with patch(
+                'app.helpers.dynamo_db.DynamoDB.get_entry_by_shortlink',
+                wraps=self.db_client.get_entry_by_shortlink
+            ) as mock_get_entry:
+                response = self.get_info(short_id, headers={'If-None-Match': etag})
+                mock_get_entry.assert_called_once()
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_fetch_full_url_from_shortlink_etag_mismatch(self):
+        short_id, other_short_id, *_ = self.uuid_to_url_dict.keys()
+        etag = self.get_info(other_short_id).headers['ETag']
+        response = self.get_info(short_id, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['shorturl'], short_id)
+
+        response = self.get_info(short_id, headers={'If-None-Match': '*'})
+        self.assertEqual(response.status_code, 304)
+
+    def test_fetch_full_url_from_shortlink_not_found_with_etag(self):
+        response = self.get_info('nonexistent', headers={'If-None-Match': '*'})
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('ETag', response.headers)
+
+
+class TestCachePolicies(BaseShortlinkTestCase):
+
+    def test_info_policy(self):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        response = self.get_info(short_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.headers['Cache-Control'],
+            'public, max-age=31536000, stale-while-revalidate=3600, stale-if-error=604800'
+        )
+        self.assertEqual(response.headers['Surrogate-Key'], f'{short_id} info')
+        self.assertNotIn('Surrogate-Control', response.headers)
+
+    def test_surrogate_control(self):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        policies = {
+            'redirect': ('public, max-age=3600', 'max-age=31536000'),
+            'not_found': ('public, max-age=10', 'max-age=60'),
+        }
+        with patch.dict('app.helpers.utils.CACHE_POLICIES', policies):
+            response = self.app.get(url_for('get_shortlink', shortlink_id=short_id))
+            self.assertEqual(response.status_code, 301)
+            self.assertEqual(response.headers['Cache-Control'], 'public, max-age=3600')
+            self.assertEqual(response.headers['Surrogate-Control'], 'max-age=31536000')
+
+            response = self.get_info('nonexistent')
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(response.headers['Cache-Control'], 'public, max-age=10')
+            self.assertEqual(response.headers['Surrogate-Control'], 'max-age=60')
+            self.assertEqual(response.headers['Surrogate-Key'], 'nonexistent not_found')
+
+    def test_server_error_not_cached(self):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        with patch(
+            'app.helpers.dynamo_db.DynamoDB.get_entry_by_shortlink',
+            side_effect=CircuitOpenError('dynamodb', 10)
+        ):
+            response = self.get_info(short_id)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Cache-Control'], 'no-store')
+
+    def test_unsafe_shortlink_id_without_surrogate_key(self):
+        response = self.get_info('non existent')
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('Surrogate-Key', response.headers)
+
+
+class TestCorsPreflight(BaseShortlinkTestCase):
+
+    def preflight(self, path, headers, query_string=None):
+        return self.app.options(
+            path,
+            query_string=query_string,
+            headers={
+                'Access-Control-Request-Method': 'POST', **headers
+            }
+        )
+
+    def test_preflight_create_shortlink(self):
+        with patch.object(app, 'full_dispatch_request') as mock_dispatch:
+            response = self.preflight('/', {'Origin': 'https://map.geo.admin.ch'})
+            mock_dispatch.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertCors(response, ['POST', 'OPTIONS'])
+        self.assertEqual(
+            response.headers['Access-Control-Allow-Origin'], 'https://map.geo.admin.ch'
+        )
+        self.assertEqual(response.headers['Access-Control-Max-Age'], '7200')
+        self.assertEqual(response.headers['Vary'], 'Origin')
+        self.assertNotIn('Cache-Control', response.headers)
+
+    def test_preflight_get_shortlink(self):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        with patch.object(app, 'full_dispatch_request') as mock_dispatch:
+            response = self.preflight(f'/{short_id}', {'Origin': 'https://www.example.com'})
+            mock_dispatch.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertCors(response, ['GET', 'HEAD', 'OPTIONS'], all_origin=True)
+        self.assertEqual(response.headers['Access-Control-Max-Age'], '7200')
+
+        response = self.preflight(
+            f'/{short_id}', {'Origin': 'https://map.geo.admin.ch'}, {'redirect': 'false'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertCors(response, ['GET', 'HEAD', 'OPTIONS'])
+
+    def test_preflight_origin_not_allowed(self):
+        with patch.object(app, 'full_dispatch_request', wraps=app.full_dispatch_request) as mock:
+            response = self.preflight('/', {'Origin': 'https://www.example.com'})
+            mock.assert_called_once()
+        self.assertEqual(response.status_code, 403)
+
+    def test_options_without_preflight(self):
+        with patch.object(app, 'full_dispatch_request', wraps=app.full_dispatch_request) as mock:
+            response = self.app.options('/', headers={'Origin': 'https://map.geo.admin.ch'})
+            mock.assert_called_once()
+        self.assertEqual(response.status_code, 200)
+        self.assertCors(response, ['POST', 'OPTIONS'])
+        self.assertEqual(response.headers['Access-Control-Max-Age'], '7200')
@@ -0,0 +1,143 @@
+import gzip
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from flask import url_for
+
+from app.helpers.dynamo_db import entry_cache
+from app.helpers.resilience import dynamodb_circuit_breaker
+from app.helpers.snapshot import Snapshot
+from app.helpers.snapshot import SnapshotIndex
+from app.helpers.snapshot import build_dictionary
+from app.helpers.snapshot import write_snapshot
+from scripts.build_snapshot import read_export
+from tests.unit_tests.base import BaseShortlinkTestCase
+
+ENTRIES = [{
+    'shortlink_id': f'{index:010x}',
+    'url': f'https://map.geo.admin.ch/?lang=de&topic=ech&layers=ch.swisstopo.layer-{index}',
+    'created': f'2024-01-01T00:00:{index % 60:02d}.000+00:00'
+} for index in range(0, 2000, 7)]
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'snapshot.idx')
+
+    def test_build_dictionary(self):
+        dictionary = build_dictionary(entry['url'] for entry in ENTRIES)
+        self.assertEqual(len(dictionary), len(b'https://map.geo.admin.ch/?lang=de&topic=ech'))
+        # Equally common tokens, the first seen is at the end
+        self.assertTrue(dictionary.endswith(b'https://map.geo.admin.ch/'))
+        self.assertNotIn(b'layer-7', dictionary)
+        self.assertEqual(build_dictionary(entry['url'] for entry in ENTRIES[:1]), b'')
+
+    def test_lookup(self):
+        self.assertEqual(write_snapshot(self.path, reversed(ENTRIES)), len(ENTRIES))
+        snapshot = Snapshot(self.path)
+        self.addCleanup(snapshot.close)
+        self.assertEqual(len(snapshot), len(ENTRIES))
+        for entry in ENTRIES:
+            self.assertEqual(snapshot.get(entry['shortlink_id']), entry)
+        for short_id in ['0000000001', '00000000', '0000000000a', 'zzzzzzzzzz', 'ëëëëëëëëëë']:
+            self.assertIsNone(snapshot.get(short_id))
+
+    def test_mixed_key_width(self):
+        entries = [{
+            'shortlink_id': 'abc', 'url': 'https://map.geo.admin.ch', 'created': ''
+        }, {
+            'shortlink_id': 'abcd', 'url': 'https://map.geo.admin.ch/?x', 'created': ''
+        }]
+        write_snapshot(self.path, entries)
+        snapshot = Snapshot(self.path)
+        self.addCleanup(snapshot.close)
+        self.assertEqual(snapshot.get('abc')['url'], 'https://map.geo.admin.ch')
+        self.assertEqual(snapshot.get('abcd')['url'], 'https://map.geo.admin.ch/?x')
+        self.assertIsNone(snapshot.get('ab'))
+
+    def test_empty_snapshot(self):
+        write_snapshot(self.path, [])
+        snapshot = Snapshot(self.path)
+        self.addCleanup(snapshot.close)
+        self.assertIsNone(snapshot.get('0000000000'))
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as fd:
+            fd.write(b'not a snapshot file at all, really not' * 2)
+        with self.assertRaises(ValueError):
+            Snapshot(self.path)
+
+    def test_index_reload(self):
+        index = SnapshotIndex(self.path, reload_interval=0)
+        self.addCleanup(index.close)
+        self.assertIsNone(index.get(ENTRIES[0]['shortlink_id']))
+        write_snapshot(self.path, ENTRIES[:1])
+        self.assertEqual(index.get(ENTRIES[0]['shortlink_id']), ENTRIES[0])
+        self.assertIsNone(index.get(ENTRIES[1]['shortlink_id']))
+        # Replaced snapshot, the mtime resolution might be too coarse
+        time.sleep(0.01)
+        write_snapshot(self.path, ENTRIES[:2])
+        self.assertEqual(index.get(ENTRIES[1]['shortlink_id']), ENTRIES[1])
+
+    def test_read_export(self):
+        path = os.path.join(self.directory.name, 'export.json.gz')
+        with gzip.open(path, 'wt', encoding='utf-8') as fd:
+            fd.write(json.dumps({'Item': {key: {'S': value} for key, value in ENTRIES[0].items()}}))
+            fd.write('\n\n{"Item": {"url": {"S": "https://map.geo.admin.ch"}}}\ninvalid\n')
+            fd.write(json.dumps({**ENTRIES[1], 'staging': False}) + '\n')
+        self.assertEqual(list(read_export([path])), ENTRIES[:2])
+
+
+class TestSnapshotLookup(BaseShortlinkTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.directory.cleanup)
+        path = os.path.join(self.directory.name, 'snapshot.idx')
+        write_snapshot(path, ENTRIES)
+        self.snapshot = SnapshotIndex(path, reload_interval=60)
+        self.addCleanup(self.snapshot.close)
+        patcher = patch('app.helpers.dynamo_db.snapshot', self.snapshot)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_first_mode(self):
+        entry = ENTRIES[0]
+        with patch('app.helpers.dynamo_db.SNAPSHOT_MODE', 'first'), \
+            patch('app.helpers.dynamo_db.DynamoDB.get_item') as mock_get_item:
+            response = self.app.get(url_for('get_shortlink', shortlink_id=entry['shortlink_id']))
+            mock_get_item.assert_not_called()
+        self.assertRedirects(response, entry['url'])
+
+    def test_first_mode_delta_fallthrough(self):
+        # Entries created after the snapshot are read from DynamoDB
+        short_id, url = next(iter(self.uuid_to_url_dict.items()))
+        entry_cache.clear()
+        with patch('app.helpers.dynamo_db.SNAPSHOT_MODE', 'first'):
+            response = self.app.get(url_for('get_shortlink', shortlink_id=short_id))
+        self.assertRedirects(response, url)
+
+    def test_fallback_mode(self):
+        entry = ENTRIES[0]
+        # Not used while DynamoDB is available
+        response = self.app.get(url_for('get_shortlink', shortlink_id=ENTRIES[1]['shortlink_id']))
+        self.assertEqual(response.status_code, 404)
+
+        dynamodb_circuit_breaker.open(time.monotonic())
+        response = self.app.get(url_for('get_shortlink', shortlink_id=entry['shortlink_id']))
+        self.assertRedirects(response, entry['url'])
+        response = self.app.get(
+            url_for('get_shortlink', shortlink_id=entry['shortlink_id']),
+            query_string={'redirect': 'false'},
+            headers={"Origin": "https://map.geo.admin.ch"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['created'], entry['created'])
@@ -0,0 +1,122 @@
+from unittest.mock import patch
+
+import boto3
+
+from flask import url_for
+
+from app.helpers.dynamo_db import entry_cache
+from app.helpers.dynamo_db import get_cold_entry
+from app.helpers.dynamo_db import get_tiering_attributes
+from app.helpers.dynamo_db import touch_entry
+from app.settings import AWS_DEFAULT_REGION
+from app.settings import AWS_DYNAMODB_COLD_TABLE_NAME
+from app.settings import AWS_ENDPOINT_URL
+from app.settings import TIERING_TTL
+from scripts.archive_entries import archive
+from tests.unit_tests.base import BaseShortlinkTestCase
+
+
+def create_cold_table():
+    dynamodb = boto3.resource(
+        'dynamodb', region_name=AWS_DEFAULT_REGION, endpoint_url=AWS_ENDPOINT_URL
+    )
+    return dynamodb.create_table(
+        TableName=AWS_DYNAMODB_COLD_TABLE_NAME,
+        KeySchema=[{
+            'AttributeName': 'shortlink_id', 'KeyType': 'HASH'
+        }],
+        AttributeDefinitions=[{
+            'AttributeName': 'shortlink_id', 'AttributeType': 'S'
+        }],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+class TestTiering(BaseShortlinkTestCase):
+
+    def setUp(self):
+        patcher = patch('app.helpers.dynamo_db.TIERING', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cold_table = create_cold_table()
+        self.addCleanup(self.cold_table.delete)
+        super().setUp()
+
+    def test_tiering_attributes(self):
+        attributes = get_tiering_attributes(now=86400 * 10 + 3600)
+        self.assertEqual(attributes['last_access'], 86400 * 10)
+        self.assertEqual(attributes['expires'], 86400 * 10 + TIERING_TTL)
+
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        item = self.table.get_item(Key={'shortlink_id': short_id})['Item']
+        self.assertEqual(item['expires'], item['last_access'] + TIERING_TTL)
+
+    def test_touch_entry(self):
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        self.table.update_item(
+            Key={'shortlink_id': short_id},
+            UpdateExpression='SET last_access = :zero, expires = :zero',
+            ExpressionAttributeValues={':zero': 0}
+        )
+        self.assertTrue(touch_entry(short_id, 1))
+        item = self.table.get_item(Key={'shortlink_id': short_id})['Item']
+        self.assertGreater(item['last_access'], 0)
+        self.assertFalse(touch_entry('abcdefghijkl', 1))
+
+    def test_archive_and_promote(self):
+        self.assertEqual(archive(horizon=0)['archived'], 0)
+        stats = archive(horizon=TIERING_TTL + 86400, delete=True)
+        self.assertEqual(stats, {'scanned': 3, 'archived': 3, 'deleted': 3})
+        self.assertEqual(self.table.scan()['Items'], [])
+        entry_cache.clear()
+
+        for short_id, url in self.uuid_to_url_dict.items():
+            response = self.app.get(url_for('get_shortlink', shortlink_id=short_id))
+            self.assertRedirects(response, url)
+            # Promoted back to the table
+            item = self.table.get_item(Key={'shortlink_id': short_id})['Item']
+            self.assertEqual(item['url'], url)
+            self.assertGreater(item['expires'], item['last_access'])
+
+        response = self.app.get(url_for('get_shortlink', shortlink_id='abcdefghijkl'))
+        self.assertEqual(response.status_code, 404)
+
+    def test_archive_legacy_entry(self):
+        self.table.put_item(
+            Item={
+                'shortlink_id': '18a0c3f5e2b',
+                'url': 'https://map.geo.admin.ch/?topic=ech',
+                'created': '2015-01-01T00:00:00.000+00:00'
+            }
+        )
+        stats = archive(horizon=0)
+        self.assertEqual(stats['archived'], 1)
+        entry = get_cold_entry('18a0c3f5e2b')
+        self.assertEqual(entry['url'], 'https://map.geo.admin.ch/?topic=ech')
+        item = self.table.get_item(Key={'shortlink_id': '18a0c3f5e2b'})['Item']
+        self.assertEqual(item['expires'], entry['expires'])
+
+    def test_archived_id_not_reused(self):
+        archived_id = next(iter(self.uuid_to_url_dict.keys()))
+        archive(horizon=TIERING_TTL + 86400, delete=True)
+        with patch(
+            'app.helpers.dynamo_db.generate_short_id', side_effect=[archived_id, 'abcdefghijkl']
+        ):
+            entry = self.db_client.add_url_to_table('https://map.geo.admin.ch/?topic=inspire')
+        self.assertEqual(entry['shortlink_id'], 'abcdefghijkl')
+
+    def test_archive_failure_legacy_entry(self):
+        self.table.put_item(
+            Item={
+                'shortlink_id': '18a0c3f5e2b',
+                'url': 'https://map.geo.admin.ch/?topic=ech',
+                'created': '2015-01-01T00:00:00.000+00:00'
+            }
+        )
+        # The expiration time is only set once the entry is archived
+        with patch('scripts.archive_entries.archive_entries', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                archive(horizon=0, delete=True)
+        item = self.table.get_item(Key={'shortlink_id': '18a0c3f5e2b'})['Item']
+        self.assertNotIn('expires', item)
+        self.assertIsNone(get_cold_entry('18a0c3f5e2b'))
@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+from unittest.mock import patch
+
+from app.helpers.utils import get_url_digest
+from scripts.backfill_url_digests import backfill
+from tests.unit_tests.base import BaseShortlinkTestCase
+
+
+class TestUrlDigestIndex(BaseShortlinkTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch('app.helpers.dynamo_db.URL_DIGEST_INDEX', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def remove_url_digests(self):
+        for short_id in self.uuid_to_url_dict:
+            self.table.update_item(
+                Key={'shortlink_id': short_id}, UpdateExpression='REMOVE url_digest'
+            )
+
+    def test_url_digest_written(self):
+        for short_id, url in self.uuid_to_url_dict.items():
+            item = self.table.get_item(Key={'shortlink_id': short_id})['Item']
+            self.assertEqual(item['url_digest'], get_url_digest(url))
+            self.assertEqual(len(item['url_digest']), 32)
+
+    def test_get_entry_by_url(self):
+        for short_id, url in self.uuid_to_url_dict.items():
+            with patch.object(self.db_client, 'query_url_index') as mock_query_url_index:
+                entry = self.db_client.get_entry_by_url(url)
+                mock_query_url_index.assert_not_called()
+            self.assertEqual(entry, {'shortlink_id': short_id, 'url': url})
+        self.assertIsNone(self.db_client.get_entry_by_url('https://map.geo.admin.ch/?topic=ech'))
+
+    def test_url_verified(self):
+        url = next(iter(self.uuid_to_url_dict.values()))
+        # Another URL with the same digest (collision)
+        with patch('app.helpers.dynamo_db.get_url_digest', return_value=get_url_digest(url)), \
+            patch('app.helpers.dynamo_db.URL_DIGEST_BACKFILLED', True):
+            self.assertIsNone(self.db_client.get_entry_by_url(f'{url}&lang=de'))
+
+    def test_url_index_fallback(self):
+        self.remove_url_digests()
+        short_id, url = next(iter(self.uuid_to_url_dict.items()))
+        entry = self.db_client.get_entry_by_url(url)
+        self.assertEqual(entry['shortlink_id'], short_id)
+        with patch('app.helpers.dynamo_db.URL_DIGEST_BACKFILLED', True):
+            self.assertIsNone(self.db_client.get_entry_by_url(url))
+
+    def test_backfill(self):
+        self.remove_url_digests()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'checkpoint.json')
+            checkpoint = backfill(path, total_segments=2, page_size=1)
+            self.assertTrue(checkpoint.is_done())
+            self.assertEqual(checkpoint.updated(), 3)
+            with self.assertRaises(ValueError):
+                backfill(path, total_segments=4)
+
+        with patch('app.helpers.dynamo_db.URL_DIGEST_BACKFILLED', True):
+            for short_id, url in self.uuid_to_url_dict.items():
+                entry = self.db_client.get_entry_by_url(url)
+                self.assertEqual(entry['shortlink_id'], short_id)
+
+    def test_backfill_resumed(self):
+        self.remove_url_digests()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'checkpoint.json')
+            state = {'last_key': None, 'done': True, 'updated': 5}
+            with open(path, 'w', encoding='utf-8') as fd:
+                json.dump({'total_segments': 1, 'segments': {'0': state}}, fd)
+            checkpoint = backfill(path, total_segments=1)
+        self.assertEqual(checkpoint.updated(), 5)
+        short_id = next(iter(self.uuid_to_url_dict.keys()))
+        item = self.table.get_item(Key={'shortlink_id': short_id})['Item']
+        self.assertNotIn('url_digest', item)
@@ -0,0 +1,155 @@
+import json
+import tempfile
+from unittest.mock import patch
+
+from app.helpers.dynamo_db import entry_cache
+from app.helpers.dynamo_db import generate_short_id
+from app.helpers.dynamo_db import get_existing_ids
+from app.helpers.dynamo_db import write_entries
+from app.helpers.write_behind import WriteBehindJournal
+from app.helpers.write_behind import read_journal
+from tests.unit_tests.base import BaseShortlinkTestCase
+
+
+class TestWriteBehind(BaseShortlinkTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.journal_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.journals = []
+        self.journal = self.create_journal()
+        patcher = patch('app.helpers.dynamo_db.write_behind_journal', self.journal)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for journal in self.journals:
+            journal.close(flush=False)
+        self.journal_dir.cleanup()
+        super().tearDown()
+
+    def create_journal(self):
+        journal = WriteBehindJournal(
+            self.journal_dir.name,
+            generate_short_id,
+            write_entries,
+            get_existing_ids,
+            flush_interval=60,
+            flush_size=25,
+            reserved_ids=10
+        )
+        self.journals.append(journal)
+        return journal
+
+    def create_shortlink(self, url):
+        self.journal.reserve_ids()
+        response = self.app.post(
+            "/", json={"url": url}, headers={"Origin": "https://map.geo.admin.ch"}
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.json['shorturl'].split('/')[-1]
+
+    def assertInTable(self, short_id, url):  # pylint: disable=invalid-name
+        item = self.table.get_item(Key={'shortlink_id': short_id}).get('Item')
+        if url is None:
+            self.assertIsNone(item)
+        else:
+            self.assertEqual(item['url'], url)
+
+    def test_write_behind_create(self):
+        url = 'https://map.geo.admin.ch/?topic=test-write-behind'
+        short_id = self.create_shortlink(url)
+        self.assertInTable(short_id, None)
+        self.assertEqual(list(read_journal(self.journal.path).keys()), [short_id])
+
+        # Pending entries are served from the journal
+        entry_cache.clear()
+        response = self.app.get(f"/{short_id}", headers={"Origin": "https://map.geo.admin.ch"})
+        self.assertRedirects(response, url)
+        response = self.app.post(
+            "/", json={"url": url}, headers={"Origin": "https://map.geo.admin.ch"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json['shorturl'].endswith(f'/{short_id}'))
+
+        self.assertTrue(self.journal.flush())
+        self.assertInTable(short_id, url)
+        self.assertEqual(self.journal.path.stat().st_size, 0)
+        self.assertIsNone(self.journal.get(short_id))
+
+    def test_write_behind_reserved_ids(self):
+        existing_id = next(iter(self.uuid_to_url_dict))
+        with patch.object(
+            self.journal.reserved, 'generate_id', side_effect=[existing_id, 'new-id']
+        ):
+            self.journal.reserved.size = 2
+            self.journal.reserve_ids()
+        self.assertEqual(list(self.journal.reserved.ids), ['new-id'])
+        self.assertEqual(self.journal.reserve_short_id(), 'new-id')
+        self.assertIsNone(self.journal.reserve_short_id())
+
+    def test_write_behind_without_reserved_id(self):
+        url = 'https://map.geo.admin.ch/?topic=test-write-behind-synchronous'
+        response = self.app.post(
+            "/", json={"url": url}, headers={"Origin": "https://map.geo.admin.ch"}
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertInTable(response.json['shorturl'].split('/')[-1], url)
+
+    def test_write_behind_other_worker(self):
+        url = 'https://map.geo.admin.ch/?topic=test-write-behind-other-worker'
+        short_id = self.create_shortlink(url)
+        entry_cache.clear()
+        with patch('app.helpers.dynamo_db.write_behind_journal', self.create_journal()):
+            response = self.app.get(f"/{short_id}", headers={"Origin": "https://map.geo.admin.ch"})
+        self.assertRedirects(response, url)
+
+    def test_write_behind_replay(self):
+        url = 'https://map.geo.admin.ch/?topic=test-write-behind-replay'
+        short_id = self.create_shortlink(url)
+        # Simulate a worker crash after a partially written record
+        self.journal.fd.write('{"put": {"shortlink_id"')
+        self.journal.close(flush=False)
+
+        journal = self.create_journal()
+        journal.open()
+        self.assertFalse(self.journal.path.exists())
+        self.assertEqual(journal.get(short_id)['url'], url)
+        with open(journal.path, 'rt', encoding='utf-8') as fd:
+            self.assertEqual(json.loads(fd.readline())['put']['shortlink_id'], short_id)
+        self.assertTrue(journal.flush())
+        self.assertInTable(short_id, url)
+
+    def test_write_behind_journal_not_replayed_while_opened(self):
+        self.journal.open()
+        journal = self.create_journal()
+        journal.open()
+        # The journals of the living workers are locked before they are visible
+        self.assertTrue(self.journal.path.exists())
+        self.assertEqual(
+            sorted(path.name for path in self.journal.path.parent.iterdir()),
+            sorted([self.journal.path.name, journal.path.name])
+        )
+
+    def test_write_behind_id_used_on_flush(self):
+        url = 'https://map.geo.admin.ch/?topic=test-write-behind-used-id'
+        short_id = self.create_shortlink(url)
+        # The id is used by another instance before the flush
+        other_url = 'https://map.geo.admin.ch/?topic=test-write-behind-other-instance'
+        self.table.put_item(Item={'shortlink_id': short_id, 'url': other_url})
+        with self.assertLogs('app.helpers.write_behind', level='ERROR'):
+            self.assertTrue(self.journal.flush())
+        # The entry is not written with another id than the one answered to the client
+        self.assertInTable(short_id, other_url)
+        self.assertIsNone(self.journal.get(short_id))
+        self.assertEqual(self.journal.path.stat().st_size, 0)
+
+    def test_write_behind_flushed_twice(self):
+        url = 'https://map.geo.admin.ch/?topic=test-write-behind-flushed-twice'
+        short_id = self.create_shortlink(url)
+        entry = self.journal.get(short_id)
+        self.assertEqual(write_entries([entry]), set())
+        # A replayed entry already written is not a conflict
+        self.assertEqual(write_entries([entry]), set())
+        self.assertTrue(self.journal.flush())
+        self.assertInTable(short_id, url)
@@ -21,7 +21,8 @@ gevent.monkey.patch_all()
 # The order has a impact on how the libraries are instrumented. If called after app import,
 # e.g. the flask instrumentation has no effect. See:
 # https://github.com/open-telemetry/opentelemetry.io/blob/main/content/en/docs/zero-code/python/troubleshooting.md#use-programmatic-auto-instrumentation
-from app.helpers.otel import initialize, initialize_flask, setup_trace_provider
+from app.helpers.otel import initialize, initialize_flask
+from app.helpers.otel import setup_meter_provider, setup_trace_provider
 
 initialize()
 
@@ -30,7 +31,14 @@ import os
 from gunicorn.app.base import BaseApplication
 
 from app.app import app as application
+from app.helpers.dynamo_db import write_behind_journal
+from app.helpers.heavy_hitters import heavy_hitters
+from app.helpers.hit_counters import access_counters
+from app.helpers.hit_counters import hit_counters
+from app.helpers.loop_monitor import loop_monitor
+from app.helpers.profiler import profiler
 from app.helpers.utils import get_logging_cfg
+from app.settings import FORWARDED_ALLOW_IPS
 from app.settings import GUNICORN_WORKER_TMP_DIR
 from app.settings import GUNICORN_KEEPALIVE
 
@@ -62,6 +70,41 @@ def post_fork(server, worker):
 
     # Setup OTEL providers for this worker
     setup_trace_provider()
+    setup_meter_provider()
+
+
+def post_worker_init(worker):
+    # Start the gevent hub monitor of the worker
+    if loop_monitor is not None:
+        loop_monitor.start()
+
+
+def worker_exit(server, worker):
+    server.log.info("Worker exiting (pid: %s)", worker.pid)
+
+    # Flush the entries pending in the write-behind journal
+    if write_behind_journal is not None:
+        write_behind_journal.close()
+
+    # Write the pending hits
+    if hit_counters is not None:
+        hit_counters.stop()
+
+    # Write the pending last accesses (tiering mode)
+    if access_counters is not None:
+        access_counters.stop()
+
+    # Persist the heavy hitters sketch
+    if heavy_hitters is not None:
+        heavy_hitters.stop()
+
+    # Write the pending profiles
+    if profiler is not None:
+        profiler.stop()
+
+    # Stop the gevent hub monitor
+    if loop_monitor is not None:
+        loop_monitor.stop()
 
 
 # We use the port 5000 as default, otherwise we set the HTTP_PORT env variable within the container.
@@ -77,10 +120,12 @@ if __name__ == '__main__':
         'keepalive': GUNICORN_KEEPALIVE,
         'timeout': 60,
         'logconfig_dict': get_logging_cfg(),
-        'forwarded_allow_ips': os.getenv('FORWARED_ALLOW_IPS', '*'),
+        'forwarded_allow_ips': ','.join(FORWARDED_ALLOW_IPS),
         'secure_scheme_headers': {
             os.getenv('FORWARDED_PROTO_HEADER_NAME', 'X-Forwarded-Proto').upper(): 'https'
         },
         'post_fork': post_fork,
+        'post_worker_init': post_worker_init,
+        'worker_exit': worker_exit,
     }
     StandaloneApplication(application, options).run()